@@ -0,0 +1,165 @@
+import time
+import datetime
+import threading
+
+import progress
+
+from constants import autotune_config, sync_config, session
+from models import UploadTuning
+from ratelimit import service_names
+
+
+# Completed uploads per tuning window, as a multiple of the current limit
+WINDOW = 2
+# Latency above this multiple of the best seen means uploads queue on the link
+LATENCY_FACTOR = 1.5
+# Throughput gain that justifies the extra uploads of the last increase
+MIN_GAIN = 1.05
+
+
+
+class AdaptiveConcurrency(object):
+    '''
+    Limit the uploads in flight to a service, adjusting the limit AIMD-style:
+    one more after each window without trouble, halved after errors and cut
+    back when latency grows without a matching gain in throughput
+    '''
+    def __init__(self, service, workers, minimum=1, maximum=None, bytes_per_sec=None):
+        self.service = service
+        self.name = service_names.get(service, service)
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum or workers, self.minimum)
+        self.limit = float(min(max(workers, self.minimum), self.maximum))
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.best_latency = None
+        self.last_rate = None
+        self.best_rate = bytes_per_sec
+        self.reset_window()
+
+    def reset_window(self):
+        self.window_started = time.monotonic()
+        self.window_done = 0
+        self.window_bytes = 0
+        self.window_errors = 0
+        self.window_latency = 0.0
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, nbytes, latency, ok):
+        with self.condition:
+            self.in_flight -= 1
+            self.window_done += 1
+            self.window_latency += latency
+            if ok:
+                self.window_bytes += nbytes
+            else:
+                self.window_errors += 1
+
+            if self.window_done >= int(self.limit) * WINDOW:
+                self.adjust()
+            self.condition.notify_all()
+
+    def adjust(self):
+        elapsed = max(time.monotonic() - self.window_started, 0.001)
+        rate = self.window_bytes / elapsed
+        latency = self.window_latency / self.window_done
+
+        if self.window_errors:
+            self.limit = self.limit / 2
+        elif self.best_latency and latency > self.best_latency * LATENCY_FACTOR and \
+                self.last_rate and rate < self.last_rate * MIN_GAIN:
+            self.limit = self.limit * 0.75
+        else:
+            self.limit += 1
+
+        self.limit = min(max(self.limit, self.minimum), self.maximum)
+        if not self.window_errors:
+            self.best_latency = min(latency, self.best_latency or latency)
+        if rate and not self.window_errors:
+            self.best_rate = max(rate, self.best_rate or 0)
+        self.last_rate = rate
+        self.reset_window()
+
+    def run(self, nbytes, func, *args, **kwargs):
+        '''
+        Call <func> once a slot is free; falsy results and exceptions count as errors
+        '''
+        self.acquire()
+        started = time.monotonic()
+        ok = False
+        try:
+            result = func(*args, **kwargs)
+            ok = bool(result)
+            return result
+        finally:
+            self.release(nbytes, time.monotonic() - started, ok)
+            progress.counter(self.name).update(nbytes=nbytes if ok else 0, failed=0 if ok else 1)
+
+
+tuners = {}
+tuners_lock = threading.Lock()
+
+
+def get_tuner(service):
+    '''
+    Return the process-wide upload concurrency of a service, starting
+    where the last run left off
+    '''
+    with tuners_lock:
+        tuner = tuners.get(service)
+        if not tuner:
+            if autotune_config['enabled']:
+                history = session.query(UploadTuning).filter(UploadTuning.service == service).first()
+                tuner = AdaptiveConcurrency(
+                    service,
+                    history.workers if history else sync_config['workers'],
+                    autotune_config['min_workers'],
+                    autotune_config['max_workers'],
+                    history.bytes_per_sec if history else None
+                )
+            else:
+                workers = sync_config['workers']
+                tuner = AdaptiveConcurrency(service, workers, workers, workers)
+            tuners[service] = tuner
+
+    return tuner
+
+
+def upload_workers():
+    '''
+    Upper bound of concurrent uploads per service
+    '''
+    if autotune_config['enabled']:
+        return autotune_config['max_workers']
+
+    return sync_config['workers']
+
+
+def save_tuning():
+    '''
+    Keep the concurrency and best throughput reached per service for the next run
+    '''
+    if not autotune_config['enabled']:
+        return None
+
+    for service, tuner in tuners.items():
+        if tuner.last_rate is None:
+            continue
+
+        history = session.query(UploadTuning).filter(UploadTuning.service == service).first()
+        if not history:
+            history = UploadTuning(service=service)
+        history.workers = int(tuner.limit)
+        history.bytes_per_sec = tuner.best_rate
+        history.latency = tuner.best_latency
+        history.updated = datetime.datetime.now()
+        session.add(history)
+
+        print('{}: Finished at {} concurrent uploads'.format(tuner.name, int(tuner.limit)))
+
+    session.commit()
@@ -0,0 +1,511 @@
+import re
+import json
+import time
+import random
+import hashlib
+import datetime
+import threading
+import itertools
+import email.parser
+import email.policy
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import click
+
+
+# gRPC status codes used in the results of Street View batch requests
+OK = 0
+NOT_FOUND = 5
+
+
+
+class Faults(object):
+    '''
+    Latency, server errors and throttling added to every request of a fake server
+    '''
+    def __init__(self, latency=0, jitter=0, error_rate=0, throttle_rate=0, retry_after=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def inject(self):
+        '''
+        Sleep as long as the request takes, returns the status of a failure to answer with, if any
+        '''
+        with self.lock:
+            delay = max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0)
+            roll = self.random.random()
+
+        time.sleep(delay)
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 503
+        return None
+
+
+class Request(object):
+    def __init__(self, method, url, headers, body):
+        parts = urlsplit(url)
+        self.method = method
+        self.path = parts.path
+        self.query = parse_qs(parts.query)
+        self.headers = headers
+        self.body = body
+        self.base_url = 'http://' + headers.get('Host', 'localhost')
+
+    def json(self):
+        return json.loads(self.body or b'{}')
+
+    def form(self):
+        '''
+        Fields of a urlencoded or multipart body, with the sizes of uploaded files
+        '''
+        ctype = self.headers.get('Content-Type', '')
+        if not ctype.startswith('multipart/'):
+            return {k: v[-1] for k, v in parse_qs(self.body.decode()).items()}, {}
+
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + ctype.encode() + b'\r\n\r\n' + self.body)
+        fields, files = {}, {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            payload = part.get_payload(decode=True) or b''
+            if part.get_filename():
+                files[name] = len(payload)
+            else:
+                fields[name] = payload.decode()
+
+        return fields, files
+
+
+class Api(object):
+    '''
+    In-memory state and routes of a fake API, routes are (method, path pattern, handler name)
+    '''
+    name = None
+    routes = []
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.requests = 0
+
+    def handle(self, request):
+        with self.lock:
+            self.requests += 1
+
+        for method, pattern, handler in self.routes:
+            match = re.match(pattern + '$', request.path)
+            if match and method == request.method:
+                with self.lock:
+                    return getattr(self, handler)(request, *match.groups())
+
+        return 404, {'error': 'Not found'}, {}
+
+
+class StreetViewApi(Api):
+    '''
+    The Street View Publish REST endpoints used by tourer and the resumable upload protocol
+    '''
+    name = 'gsv'
+    routes = [
+        ('POST', r'/v1/photo:startUpload', 'start_upload'),
+        ('POST', r'/upload/(\d+)', 'upload'),
+        ('POST', r'/v1/photo', 'create_photo'),
+        ('DELETE', r'/v1/photo/([^/]+)', 'delete_photo'),
+        ('GET', r'/v1/photos:batchGet', 'batch_get'),
+        ('POST', r'/v1/photos:batchUpdate', 'batch_update'),
+        ('POST', r'/v1/photos:batchDelete', 'batch_delete')
+    ]
+
+    def __init__(self):
+        super().__init__()
+        self.uploads = {}
+        self.photos = {}
+
+    def handle(self, request):
+        if not request.headers.get('Authorization', '').startswith('Bearer '):
+            return 401, {'error': {'code': 401, 'message': 'Missing access token'}}, {}
+
+        return super().handle(request)
+
+    def start_upload(self, request):
+        upload_id = next(self.ids)
+        self.uploads[upload_id] = {'size': None, 'received': 0, 'final': False}
+        return 200, {'uploadUrl': '{}/upload/{}'.format(request.base_url, upload_id)}, {}
+
+    def upload(self, request, upload_id):
+        upload = self.uploads.get(int(upload_id))
+        if not upload:
+            return 404, {'error': 'Unknown upload'}, {}
+
+        command = request.headers.get('X-Goog-Upload-Command', '')
+        headers = {}
+        if command == 'start':
+            upload['size'] = int(request.headers.get('X-Goog-Upload-Header-Content-Length', 0))
+            headers['X-Goog-Upload-URL'] = '{}/upload/{}'.format(request.base_url, upload_id)
+        elif command == 'query':
+            headers['X-Goog-Upload-Size-Received'] = str(upload['received'])
+        elif 'upload' in command:
+            if upload['final']:
+                return 400, {'error': 'Upload already finalized'}, {}
+            offset = int(request.headers.get('X-Goog-Upload-Offset', -1))
+            # A chunk may be sent again, but never past the bytes received so far
+            if offset < 0 or offset > upload['received']:
+                return 400, {'error': 'Invalid offset {}, {} bytes received'.format(offset, upload['received'])}, {}
+            upload['received'] = offset + len(request.body)
+            if 'finalize' in command:
+                if upload['size'] is not None and upload['received'] != upload['size']:
+                    return 400, {'error': 'Received {} of {} bytes'.format(upload['received'], upload['size'])}, {}
+                upload['final'] = True
+        else:
+            return 400, {'error': 'Unknown upload command'}, {}
+
+        headers['X-Goog-Upload-Status'] = 'final' if upload['final'] else 'active'
+        return 200, None, headers
+
+    def create_photo(self, request):
+        photo = request.json()
+        upload_url = photo.get('uploadReference', {}).get('uploadUrl', '')
+        upload = self.uploads.get(int(upload_url.rsplit('/', 1)[-1] or 0))
+        if not upload or not upload['final']:
+            return 400, {'error': {'code': 400, 'message': 'Upload not finalized'}}, {}
+
+        photo_id = 'FAKE{:012d}'.format(next(self.ids))
+        photo.update({
+            'photoId': {'id': photo_id},
+            'shareLink': '{}/share/{}'.format(request.base_url, photo_id),
+            'downloadUrl': '{}/download/{}'.format(request.base_url, photo_id),
+            'thumbnailUrl': '{}/thumbnail/{}'.format(request.base_url, photo_id),
+            'mapsPublishStatus': 'PUBLISHED',
+            'viewCount': '0'
+        })
+        self.photos[photo_id] = photo
+        return 200, photo, {}
+
+    def delete_photo(self, request, photo_id):
+        if not self.photos.pop(photo_id, None):
+            return 404, {'error': {'code': 404, 'message': 'Photo not found'}}, {}
+        return 200, {}, {}
+
+    def batch_get(self, request):
+        results = []
+        for photo_id in request.query.get('photoIds', []):
+            if photo_id in self.photos:
+                results.append({'status': {'code': OK}, 'photo': self.photos[photo_id]})
+            else:
+                results.append({'status': {'code': NOT_FOUND, 'message': 'Photo not found'}})
+        return 200, {'results': results}, {}
+
+    def batch_update(self, request):
+        results = []
+        for update in request.json().get('updatePhotoRequests', []):
+            photo_id = update['photo']['photoId']['id']
+            if photo_id not in self.photos:
+                results.append({'status': {'code': NOT_FOUND, 'message': 'Photo not found'}})
+                continue
+            for field in set(path.split('.')[0] for path in update.get('updateMask', '').split(',') if path):
+                self.photos[photo_id][field] = update['photo'].get(field)
+            results.append({'status': {'code': OK}, 'photo': self.photos[photo_id]})
+        return 200, {'results': results}, {}
+
+    def batch_delete(self, request):
+        statuses = []
+        for photo_id in request.json().get('photoIds', []):
+            if self.photos.pop(photo_id, None):
+                statuses.append({'code': OK})
+            else:
+                statuses.append({'code': NOT_FOUND, 'message': 'Photo not found'})
+        return 200, {'status': statuses}, {}
+
+
+class OpenTrailViewApi(Api):
+    name = 'otv'
+    routes = [
+        ('POST', r'/oauth/auth/access_token', 'access_token'),
+        ('POST', r'/oauth/api/panorama/upload', 'upload'),
+        ('POST', r'/oauth/api/panorama/(\d+)/move', 'move'),
+        ('DELETE', r'/oauth/api/panorama/(\d+)', 'delete')
+    ]
+
+    def __init__(self):
+        super().__init__()
+        self.panoramas = {}
+
+    def handle(self, request):
+        if '/api/' in request.path and not request.headers.get('Authorization', '').startswith('Bearer '):
+            return 401, {'error': 'Missing access token'}, {}
+
+        return super().handle(request)
+
+    def access_token(self, request):
+        return 200, {'access_token': 'fake-otv-token', 'token_type': 'Bearer'}, {}
+
+    def upload(self, request):
+        _, files = request.form()
+        if 'file' not in files:
+            return 400, {'error': 'No file'}, {}
+
+        pano_id = next(self.ids)
+        self.panoramas[pano_id] = {'bytes': files['file'], 'lat': None, 'lon': None}
+        return 200, {'id': pano_id}, {}
+
+    def move(self, request, pano_id):
+        panorama = self.panoramas.get(int(pano_id))
+        if not panorama:
+            return 404, {'error': 'Panorama not found'}, {}
+
+        fields, _ = request.form()
+        panorama.update(lat=fields.get('lat'), lon=fields.get('lon'))
+        return 200, {}, {}
+
+    def delete(self, request, pano_id):
+        if not self.panoramas.pop(int(pano_id), None):
+            return 404, {'error': 'Panorama not found'}, {}
+        return 200, {}, {}
+
+
+def nest(fields):
+    '''
+    Nested dicts and lists from form keys such as tourer[connections][0][photo_id]
+    '''
+    nested = {}
+    for name, value in fields.items():
+        keys = re.findall(r'[^\[\]]+', name)
+        item = nested
+        for k in keys[:-1]:
+            item = item.setdefault(k, {})
+        item[keys[-1]] = value
+
+    def listify(item):
+        if not isinstance(item, dict):
+            return item
+        if item and all(k.isdigit() for k in item):
+            return [listify(item[k]) for k in sorted(item, key=int)]
+        return {k: listify(v) for k, v in item.items()}
+
+    return listify(nested)
+
+
+class ExplorerApi(Api):
+    name = 'explorer'
+    routes = [
+        ('GET', r'/api/v1/users', 'user'),
+        ('GET', r'/api/v1/tours', 'list_tours'),
+        ('POST', r'/api/v1/tours', 'create_tour'),
+        ('PUT', r'/api/v1/tours/(\d+)', 'update_tour'),
+        ('DELETE', r'/api/v1/tours/(\d+)', 'delete_tour'),
+        ('GET', r'/api/v1/tours/(\d+)/photos', 'list_photos'),
+        ('POST', r'/api/v1/tours/(\d+)/photos', 'add_photo'),
+        ('PUT', r'/api/v1/tours/(\d+)/photos/(\d+)', 'update_photo'),
+        ('DELETE', r'/api/v1/tours/(\d+)/photos/(\d+)', 'delete_photo')
+    ]
+    user_id = 1
+
+    def __init__(self):
+        super().__init__()
+        self.tours = {}
+
+    def handle(self, request):
+        if not request.headers.get('api-key'):
+            return 401, {'error': 'Missing API key'}, {}
+
+        return super().handle(request)
+
+    def now(self):
+        return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    def page(self, request, items):
+        '''
+        One page of a listing, answering 304 when the client has its ETag
+        '''
+        updated_since = request.query.get('updated_since', [None])[0]
+        if updated_since:
+            items = [item for item in items if item['updated_at'][:19] >= updated_since[:19]]
+
+        page = int(request.query.get('page', [1])[0])
+        per_page = int(request.query.get('per_page', [20])[0])
+        items = items[(page - 1) * per_page:page * per_page]
+
+        body = json.dumps(items, sort_keys=True).encode()
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if request.headers.get('If-None-Match') == etag:
+            return 304, None, {'ETag': etag}
+        return 200, items, {'ETag': etag}
+
+    def tour(self, tour_id):
+        return self.tours.get(int(tour_id))
+
+    def user(self, request):
+        return 200, {'user': {'id': self.user_id}}, {}
+
+    def list_tours(self, request):
+        tours = [{k: v for k, v in t.items() if k != 'photos'} for t in self.tours.values()]
+        status, items, headers = self.page(request, tours)
+        return status, None if items is None else {'tours': items}, headers
+
+    def create_tour(self, request):
+        tour = request.json()
+        tour.update(id=next(self.ids), user_id=self.user_id, created_at=self.now(), updated_at=self.now(), photos={})
+        self.tours[tour['id']] = tour
+        return 201, {'tour': {k: v for k, v in tour.items() if k != 'photos'}}, {}
+
+    def update_tour(self, request, tour_id):
+        tour = self.tour(tour_id)
+        if not tour:
+            return 404, {'error': 'Tour not found'}, {}
+
+        tour.update({k: v for k, v in request.json().items() if v is not None}, updated_at=self.now())
+        return 200, {'tour': {k: v for k, v in tour.items() if k != 'photos'}}, {}
+
+    def delete_tour(self, request, tour_id):
+        if not self.tours.pop(int(tour_id), None):
+            return 404, {'error': 'Tour not found'}, {}
+        return 200, {}, {}
+
+    def list_photos(self, request, tour_id):
+        tour = self.tour(tour_id)
+        if not tour:
+            return 404, {'error': 'Tour not found'}, {}
+
+        status, items, headers = self.page(request, list(tour['photos'].values()))
+        return status, None if items is None else {'photos': items}, headers
+
+    def add_photo(self, request, tour_id):
+        tour = self.tour(tour_id)
+        if not tour:
+            return 404, {'error': 'Tour not found'}, {}
+
+        fields, files = request.form()
+        if 'image' not in files:
+            return 400, {'error': 'No image'}, {}
+
+        photo = nest(fields)
+        photo.update(id=next(self.ids), tour_id=tour['id'], bytes=files['image'], updated_at=self.now())
+        tour['photos'][photo['id']] = photo
+        return 201, {'photo': photo}, {}
+
+    def update_photo(self, request, tour_id, photo_id):
+        tour = self.tour(tour_id)
+        photo = tour and tour['photos'].get(int(photo_id))
+        if not photo:
+            return 404, {'error': 'Photo not found'}, {}
+
+        fields, _ = request.form()
+        photo.update(nest(fields), updated_at=self.now())
+        return 200, {'photo': photo}, {}
+
+    def delete_photo(self, request, tour_id, photo_id):
+        tour = self.tour(tour_id)
+        if not tour or not tour['photos'].pop(int(photo_id), None):
+            return 404, {'error': 'Photo not found'}, {}
+        return 200, {}, {}
+
+
+APIS = {api.name: api for api in (StreetViewApi, OpenTrailViewApi, ExplorerApi)}
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Keep-alive, as requests sessions reuse connections
+    protocol_version = 'HTTP/1.1'
+
+    def dispatch(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        failure = self.server.faults.inject()
+        if failure == 429:
+            self.respond(429, {'error': 'Rate limit exceeded'}, {'Retry-After': str(self.server.faults.retry_after)})
+        elif failure:
+            self.respond(failure, {'error': 'Service unavailable'})
+        else:
+            self.respond(*self.server.api.handle(Request(self.command, self.path, self.headers, body)))
+
+    do_GET = do_POST = do_PUT = do_DELETE = dispatch
+
+    def respond(self, status, payload, headers=None):
+        body = b'' if payload is None else json.dumps(payload).encode()
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        if payload is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(name, port, faults, host='127.0.0.1', verbose=False):
+    '''
+    Start the fake API <name> in a background thread, returns the server
+    '''
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.api = APIS[name]()
+    server.faults = faults
+    server.verbose = verbose
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def endpoints(servers):
+    '''
+    The [endpoints] and [explorer] sections that point tourer at <servers>,
+    to use in place of those in config.ini
+    '''
+    urls = {name: 'http://{}:{}/'.format(*server.server_address[:2]) for name, server in servers.items()}
+    lines = ['[endpoints]']
+    if 'gsv' in urls:
+        lines += ['gsv_api_url = {}v1/'.format(urls['gsv']), 'gsv_access_token = fake-gsv-token']
+    if 'otv' in urls:
+        lines.append('otv_url = {}'.format(urls['otv']))
+    if 'explorer' in urls:
+        lines += ['explorer_url = {}api/v1/'.format(urls['explorer']), '', '[explorer]', 'explorer_key = fake-explorer-key']
+
+    return '\n'.join(lines) + '\n'
+
+
+@click.command()
+@click.argument('apis', nargs=-1, type=click.Choice(sorted(APIS)))
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=8001, help='Port of the first API, the others follow')
+@click.option('--latency', default=0.0, help='Seconds each request takes')
+@click.option('--jitter', default=0.0, help='Random seconds added to or taken from the latency')
+@click.option('--error-rate', default=0.0, help='Share of requests answered with 503')
+@click.option('--throttle-rate', default=0.0, help='Share of requests answered with 429')
+@click.option('--retry-after', default=1, help='Retry-After seconds of 429 responses')
+@click.option('--seed', type=int, default=None, help='Seed for reproducible faults')
+@click.option('--verbose', '-v', is_flag=True, help='Log every request')
+def main(apis, host, port, latency, jitter, error_rate, throttle_rate, retry_after, seed, verbose):
+    '''
+    Serve fake Street View Publish, Open Trail View and Trek View Explorer APIs, all of them by default
+    '''
+    servers = {}
+    for i, name in enumerate(apis or list(APIS)):
+        faults = Faults(latency, jitter, error_rate, throttle_rate, retry_after, seed)
+        servers[name] = serve(name, port + i, faults, host, verbose)
+
+    print('Replace these sections of config.ini with:\n')
+    print(endpoints(servers))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for name, server in servers.items():
+            print('{}: {} requests'.format(name, server.api.requests))
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import os
+import io
+import math
+import random
+import datetime
+
+import click
+import piexif
+
+from PIL import Image
+
+
+TRANSPORT_SPEEDS = {
+    'walk': 1.4,
+    'bike': 5.0,
+    'car': 13.0
+}
+EARTH_RADIUS = 6371000
+
+
+
+def track(frames, start, transport='walk', interval=1.0, stop_chance=0.002, seed=None):
+    '''
+    Yield (time, lat, lon, altitude) of a capture along a wandering route,
+    with occasional stops where the rig keeps shooting in place
+    '''
+    rnd = random.Random(seed)
+    lat, lon = start
+    altitude = rnd.uniform(10, 500)
+    heading = rnd.uniform(0, 360)
+    speed = TRANSPORT_SPEEDS[transport]
+    taken = datetime.datetime(2020, 6, 1, 9, 0, 0)
+    stopped = 0
+
+    for _ in range(frames):
+        yield taken, lat, lon, altitude
+
+        taken += datetime.timedelta(seconds=interval)
+        if stopped:
+            stopped -= 1
+            continue
+        if rnd.random() < stop_chance:
+            stopped = rnd.randint(10, 120)
+
+        heading = (heading + rnd.gauss(0, 8)) % 360
+        distance = max(rnd.gauss(speed, speed * 0.2), 0) * interval
+        lat += math.degrees(distance * math.cos(math.radians(heading)) / EARTH_RADIUS)
+        lon += math.degrees(distance * math.sin(math.radians(heading)) / (EARTH_RADIUS * math.cos(math.radians(lat))))
+        altitude = max(altitude + rnd.gauss(0, 0.3), 0)
+
+
+def rational(value, precision=10000):
+    return int(round(value * precision)), precision
+
+
+def dms(value):
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = (value - degrees - minutes / 60) * 3600
+    return (degrees, 1), (minutes, 1), rational(seconds)
+
+
+def exif_bytes(taken, lat, lon, altitude, width, height):
+    zeroth = {
+        piexif.ImageIFD.Make: b'Tourer',
+        piexif.ImageIFD.Model: b'Synthetic 360',
+        piexif.ImageIFD.ImageWidth: width,
+        piexif.ImageIFD.ImageLength: height
+    }
+    exif = {
+        piexif.ExifIFD.DateTimeOriginal: taken.strftime('%Y:%m:%d %H:%M:%S').encode()
+    }
+    gps = {
+        piexif.GPSIFD.GPSLatitudeRef: b'N' if lat >= 0 else b'S',
+        piexif.GPSIFD.GPSLatitude: dms(lat),
+        piexif.GPSIFD.GPSLongitudeRef: b'E' if lon >= 0 else b'W',
+        piexif.GPSIFD.GPSLongitude: dms(lon),
+        piexif.GPSIFD.GPSAltitudeRef: 0,
+        piexif.GPSIFD.GPSAltitude: rational(altitude, 100),
+        piexif.GPSIFD.GPSDateStamp: taken.strftime('%Y:%m:%d').encode(),
+        piexif.GPSIFD.GPSTimeStamp: ((taken.hour, 1), (taken.minute, 1), (taken.second, 1))
+    }
+
+    return piexif.dump({'0th': zeroth, 'Exif': exif, 'GPS': gps})
+
+
+def template(width, height, fmt):
+    '''
+    Encode one equirectangular frame, a sky to ground gradient, that every photo reuses
+    '''
+    sky = Image.linear_gradient('L').resize((width, height))
+    img = Image.merge('RGB', (sky, sky, Image.new('L', (width, height), 200)))
+    if fmt != 'jpeg':
+        return img, None
+
+    data = io.BytesIO()
+    img.save(data, 'JPEG', quality=70)
+    return img, data.getvalue()
+
+
+def generate(path, frames, fmt='jpeg', width=4000, height=2000, start=(51.5007, -0.1246), transport='walk', seed=None):
+    '''
+    Write a tour of <frames> geotagged 2:1 photos to <path>, returns their file names
+    '''
+    os.makedirs(path, exist_ok=True)
+    img, encoded = template(width, height, fmt)
+    extension = '.jpg' if fmt == 'jpeg' else '.tiff'
+    fnames = []
+
+    for i, (taken, lat, lon, altitude) in enumerate(track(frames, start, transport, seed=seed)):
+        fname = os.path.join(path, 'frame_{:06d}{}'.format(i, extension))
+        exif = exif_bytes(taken, lat, lon, altitude, width, height)
+        if fmt == 'jpeg':
+            piexif.insert(exif, encoded, fname)
+        else:
+            img.save(fname, 'TIFF', exif=exif)
+        fnames.append(fname)
+
+    return fnames
+
+
+@click.command()
+@click.argument('path')
+@click.option('--frames', '-n', default=100, help='Number of photos in the tour')
+@click.option('--format', 'fmt', type=click.Choice(['jpeg', 'tiff']), default='jpeg')
+@click.option('--width', default=4000, help='Width in pixels, the height is half of it')
+@click.option('--transport', type=click.Choice(sorted(TRANSPORT_SPEEDS)), default='walk')
+@click.option('--seed', type=int, default=None, help='Seed for a reproducible track')
+def main(path, frames, fmt, width, transport, seed):
+    '''
+    Generate a synthetic tour of geotagged equirectangular photos at <path>
+    '''
+    fnames = generate(path, frames, fmt, width, width // 2, transport=transport, seed=seed)
+    print('{} photos written to {}'.format(len(fnames), path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import itertools
+import platform
+import tempfile
+import contextlib
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import click
+
+from generate import generate
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = '''[other]
+database_file = bench.sqlite
+
+[autotune]
+enabled = no
+'''
+
+STAGES = ['validate', 'geocode', 'insert', 'connections', 'list', 'sync']
+
+
+
+class FakeClient(object):
+    '''
+    Stands in for an integration client, answering every request after <latency> seconds
+    '''
+    def __init__(self, name, short_name, latency):
+        self.name = name
+        self.short_name = short_name
+        self.latency = latency
+        self.ids = itertools.count(1)
+
+    def respond(self, item):
+        time.sleep(self.latency)
+        return next(self.ids)
+
+    def map(self, items, workers):
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            return list(executor.map(self.respond, items))
+
+    # Google Street View
+    def upload_photos(self, fls, *args):
+        if self.short_name == 'otv':
+            return [str(i) for i in self.map(fls, args[1])], set()
+
+        return [SimpleNamespace(photo_id=SimpleNamespace(id='gsv{}'.format(i)), download_url='', share_link='',
+                                thumbnail_url='') for i in self.map(fls, args[0])]
+
+    def update_poses(self, poses, workers=1):
+        self.map(poses, workers)
+        return [pose['photo_id'] for pose in poses]
+
+    # Trek View Explorer
+    def sync_photos(self, explorer_tour_id, photos, workers=1):
+        ids = self.map(photos, workers)
+        return {photo['tourer[photo_id]']: i for photo, i in zip(photos, ids)}, {}
+
+    def update_tour(self, *args, **kwargs):
+        return self.respond(None)
+
+
+@contextlib.contextmanager
+def workdir(path):
+    '''
+    Run tourer against a fresh database and config in <path>
+    '''
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'config.ini'), 'w') as f:
+        f.write(CONFIG)
+    if os.path.exists(os.path.join(path, 'bench.sqlite')):
+        os.remove(os.path.join(path, 'bench.sqlite'))
+
+    cwd = os.getcwd()
+    os.chdir(path)
+    sys.path.insert(0, ROOT)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def timed(results, stage, func, *args):
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func(*args)
+    results[stage] = round(time.perf_counter() - started, 4)
+    return result
+
+
+def run_benchmark(photos_path, frames, stages, latency, workers):
+    import progress
+    progress.mode = 'off'
+
+    import utils
+    from constants import session, sync_config
+    from models import Tour, Photo, TourTransport, TourType, TransportType, SyncStatus
+
+    utils.initdb()
+    sync_config['workers'] = workers
+    results = {}
+
+    validated = timed(results, 'validate', utils.validate_files, photos_path)
+    if 'geocode' in stages:
+        fields = timed(results, 'geocode', lambda: [utils.photo_fields(fl) for fl in validated])
+    else:
+        fields = [utils.photo_fields(fl, False) for fl in validated]
+
+    transport = session.query(TourTransport).filter(TourTransport.tour_type == TourType.Land,
+                                                    TourTransport.tour_transport == TransportType.Hike).first()
+    tour = Tour(name='Benchmark', description='Synthetic tour', tags='benchmark', tour_id='bench001',
+                transport=transport, explorer_tour_id=1)
+
+    def insert():
+        session.add(tour)
+        session.add_all([Photo(tour=tour, **f) for f in fields])
+        session.commit()
+    timed(results, 'insert', insert)
+
+    if 'connections' in stages:
+        timed(results, 'connections', utils.set_tour_connections, tour)
+
+    if 'list' in stages:
+        timed(results, 'listtours', utils.list_tours, session.query(Tour).all())
+        timed(results, 'listphotos', utils.list_photos, tour.tour_id)
+
+    if 'sync' in stages:
+        integrations = [('Google Street View', 'gsv'), ('Open Trail View', 'otv'), ('Trek View Explorer', 'explorer')]
+        for name, short_name in integrations:
+            utils.clients[short_name] = FakeClient(name, short_name, latency)
+            utils.set_sync_state([p.photo_id for p in tour.photos], short_name, SyncStatus.Pending)
+
+        def sync():
+            utils.sync_push(integrations)
+            utils.sync_gsv_pose()
+        timed(results, 'sync', sync)
+
+    return len(validated), results
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option('--frames', '-n', default=100, help='Number of synthetic photos')
+@click.option('--format', 'fmt', type=click.Choice(['jpeg', 'tiff']), default='jpeg')
+@click.option('--stage', 'stages', multiple=True, type=click.Choice(STAGES), help='Stages to time, all by default')
+@click.option('--latency', default=0.05, help='Seconds each fake integration request takes')
+@click.option('--workers', default=4, help='Concurrent requests per integration')
+@click.option('--photos', type=click.Path(file_okay=False), help='Reuse photos generated at this path')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='Append the JSON result to this file')
+@click.option('--seed', default=1, help='Seed of the synthetic GPS track')
+def main(frames, fmt, stages, latency, workers, photos, output, seed):
+    '''
+    Time validation, geocoding, DB insertion, connections, listings and a sync
+    against fake integrations on a synthetic tour
+    '''
+    stages = stages or STAGES
+    tmp = tempfile.mkdtemp(prefix='tourer-bench-')
+    try:
+        photos_path = os.path.abspath(photos or os.path.join(tmp, 'photos'))
+        if not os.path.isdir(photos_path) or not os.listdir(photos_path):
+            started = time.perf_counter()
+            generate(photos_path, frames, fmt, seed=seed)
+            print('Generated {} photos in {:.1f}s'.format(frames, time.perf_counter() - started), file=sys.stderr)
+
+        with workdir(os.path.join(tmp, 'work')):
+            validated, results = run_benchmark(photos_path, frames, stages, latency, workers)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    result = {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'frames': frames,
+        'validated': validated,
+        'format': fmt,
+        'latency': latency,
+        'workers': workers,
+        'seconds': results,
+        'frames_per_sec': {stage: round(validated / seconds, 1) for stage, seconds in results.items() if seconds}
+    }
+    line = json.dumps(result)
+    print(line)
+    if output:
+        with open(output, 'a') as f:
+            f.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -79,12 +79,147 @@ except:
     sys.exit()
     
 
-engine = create_engine('sqlite:///{}'.format(db_file))
+# Worker threads each use their own session, give them time to wait for the write lock
+engine = create_engine('sqlite:///{}'.format(db_file), connect_args={'timeout': 30, 'check_same_thread': False})
 Session = sessionmaker(bind=engine)
 session = Session()
 
 SUPPORTED_FORMATS = ['.jpg', '.jpeg', '.tiff']
 
+# Street View publish states that no longer change on their own
+GSV_FINAL_STATUSES = ['PUBLISHED', 'REJECTED_UNKNOWN']
+
+# Photo columns filled from each integration, cleared when the integration is removed from a tour
+REMOTE_FIELDS = {
+    'gsv': ['street_view_photoid', 'street_view_sharelink', 'street_view_download_url', 'street_view_thumbnail_url',
+            'street_view_publish_status', 'street_view_view_count', 'street_view_connections',
+            'street_view_fetched', 'street_view_fingerprint'],
+    'otv': ['otv_pano_id'],
+    'explorer': ['explorer_photo_id', 'explorer_fingerprint']
+}
+
+# Decimal places of the coordinates that share a cached geocoding result, about 100 m
+GEOCODE_PRECISION = 3
+
+# Photos an upload job uploads and commits at a time, so that a job run again skips those done
+UPLOAD_BATCH = 20
+
 known_modules = [('Google Street View', 'gsv'),
                     ('Open Trail View', 'otv'),
                     ('Trek View Explorer', 'explorer')]
+
+try:
+    rc = config['retry']
+    retry_config = {
+        'max_attempts': int(rc.get('max_attempts', 6)),
+        'deadline': float(rc.get('deadline', 300)),
+        'base_delay': float(rc.get('base_delay', 1)),
+        'max_delay': float(rc.get('max_delay', 60))
+    }
+except:
+    retry_config = {
+        'max_attempts': 6,
+        'deadline': 300,
+        'base_delay': 1,
+        'max_delay': 60
+    }
+
+ratelimit_config = {}
+
+for service in ['gsv', 'otv', 'explorer', 'geocode']:
+    limits = {}
+    for limit in ['requests_per_sec', 'bytes_per_sec', 'daily_quota']:
+        try:
+            value = config['ratelimit'][service + '_' + limit]
+            limits[limit] = float(value) if value else None
+        except:
+            limits[limit] = None
+    ratelimit_config[service] = limits
+
+try:
+    bc = config['bandwidth']
+    bandwidth_config = {
+        'bytes_per_sec': float(bc['bytes_per_sec']) if bc.get('bytes_per_sec') else None,
+        'policy': bc.get('policy') or 'fair',
+        'metadata_bytes': int(bc.get('metadata_bytes') or 65536),
+        'weights': {service: float(bc.get(service + '_weight') or 1) for service in ['gsv', 'otv', 'explorer']}
+    }
+except:
+    bandwidth_config = {
+        'bytes_per_sec': None,
+        'policy': 'fair',
+        'metadata_bytes': 65536,
+        'weights': {}
+    }
+
+try:
+    mc = config['metrics']
+    metrics_config = {
+        'textfile': mc.get('textfile') or None,
+        'json': mc.get('json') or None
+    }
+except:
+    metrics_config = {
+        'textfile': None,
+        'json': None
+    }
+
+try:
+    ac = config['autotune']
+    autotune_config = {
+        'enabled': ac.getboolean('enabled', True),
+        'min_workers': int(ac.get('min_workers', 1)),
+        'max_workers': int(ac.get('max_workers', 16))
+    }
+except:
+    autotune_config = {
+        'enabled': True,
+        'min_workers': 1,
+        'max_workers': 16
+    }
+
+try:
+    epc = config['endpoints']
+    endpoints_config = {
+        'gsv_api_url': epc.get('gsv_api_url') or None,
+        'gsv_access_token': epc.get('gsv_access_token') or None,
+        'otv_url': epc.get('otv_url') or 'https://opentrailview.org/',
+        'explorer_url': epc.get('explorer_url') or 'https://explorer.trekview.org/api/v1/',
+        'geocode_url': epc.get('geocode_url') or 'https://maps.googleapis.com/maps/api/geocode/json'
+    }
+except:
+    endpoints_config = {
+        'gsv_api_url': None,
+        'gsv_access_token': None,
+        'otv_url': 'https://opentrailview.org/',
+        'explorer_url': 'https://explorer.trekview.org/api/v1/',
+        'geocode_url': 'https://maps.googleapis.com/maps/api/geocode/json'
+    }
+
+try:
+    tc = config['tracks']
+    tracks_config = {
+        'max_gap': float(tc.get('max_gap') or 0),
+        'max_jump': float(tc.get('max_jump') or 0),
+        'spacing': float(tc.get('spacing') or 0)
+    }
+except:
+    tracks_config = {
+        'max_gap': 300,
+        'max_jump': 500,
+        'spacing': 0
+    }
+
+try:
+    sc = config['sync']
+    sync_config = {
+        'workers': int(sc.get('workers', 4)),
+        'gsv_fetch_max_age': float(sc.get('gsv_fetch_max_age', 24)),
+        'max_attempts': int(sc.get('max_attempts', 5))
+    }
+except:
+    sync_config = {
+        'workers': 4,
+        'gsv_fetch_max_age': 24,
+        'max_attempts': 5
+    }
@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import random
+import socket
+import threading
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, and_
+
+from constants import Session, session, retry_config
+from models import Job, JobState
+from ratelimit import QuotaExceeded
+
+
+# Higher priorities are claimed first
+PRIORITIES = {
+    'move': 10,
+    'geocode': 5,
+    'delete': 3,
+    'fetch': 1,
+    'upload': 0
+}
+
+handlers = {}
+
+
+
+class JobError(Exception):
+    pass
+
+
+def handler(kind):
+    '''
+    Register the function running jobs of <kind>, called with a database session and the job payload
+    '''
+    def register(func):
+        handlers[kind] = func
+        return func
+
+    return register
+
+
+def enqueue(kind, payload, key=None, priority=None, db=None):
+    '''
+    Add a job to the queue, unless a queued or running job with the same <key> exists
+    '''
+    db = db or session
+    if key:
+        existing = db.query(Job.id).filter(Job.key == key, Job.state.in_([JobState.Queued, JobState.Running])).first()
+        if existing:
+            return None
+
+    now = datetime.now()
+    job = Job(
+        kind=kind,
+        key=key,
+        payload=json.dumps(payload, default=str),
+        priority=PRIORITIES.get(kind, 0) if priority is None else priority,
+        state=JobState.Queued,
+        attempts=0,
+        max_attempts=retry_config['max_attempts'],
+        run_after=now,
+        created=now,
+        updated=now
+    )
+    db.add(job)
+    db.commit()
+
+    return job
+
+
+def claim(db, worker, lease):
+    '''
+    Lease the next runnable job to <worker> for <lease> seconds.
+    Running jobs whose lease ran out, e.g. after a crash, are claimed again
+    '''
+    while True:
+        now = datetime.now()
+        runnable = or_(
+            and_(Job.state == JobState.Queued, Job.run_after <= now),
+            and_(Job.state == JobState.Running, Job.lease_until < now)
+        )
+        job = db.query(Job).filter(runnable).order_by(Job.priority.desc(), Job.id).first()
+        if not job:
+            return None
+
+        claimed = db.query(Job).filter(Job.id == job.id, runnable).update({
+            'state': JobState.Running,
+            'worker': worker,
+            'lease_until': now + timedelta(seconds=lease),
+            'attempts': Job.attempts + 1,
+            'updated': now
+        }, synchronize_session=False)
+        db.commit()
+
+        if claimed:
+            db.refresh(job)
+            return job
+
+
+def release(db, job, worker, values):
+    '''
+    Write the outcome of a job, unless its lease ran out and another worker claimed it since
+    '''
+    released = db.query(Job).filter(Job.id == job.id, Job.worker == worker, Job.state == JobState.Running).update(
+        values, synchronize_session=False)
+    db.commit()
+    db.expire(job)
+
+    if not released:
+        print('Job {} was taken over by another worker'.format(job.id))
+    return bool(released)
+
+
+def complete(db, job, worker):
+    return release(db, job, worker, {
+        'state': JobState.Done,
+        'lease_until': None,
+        'last_error': None,
+        'updated': datetime.now()
+    })
+
+
+def fail(db, job, worker, error, run_after=None, count=True):
+    '''
+    Put a failed job back in the queue with backoff, or give up after max_attempts
+    '''
+    now = datetime.now()
+    attempts = job.attempts if count else job.attempts - 1
+    values = {
+        'attempts': attempts,
+        'last_error': error,
+        'lease_until': None,
+        'updated': now
+    }
+
+    if attempts >= job.max_attempts:
+        values['state'] = JobState.Failed
+    else:
+        values['state'] = JobState.Queued
+        if not run_after:
+            backoff = min(retry_config['max_delay'], retry_config['base_delay'] * 2 ** attempts)
+            run_after = now + timedelta(seconds=random.uniform(0, backoff))
+        values['run_after'] = run_after
+
+    return release(db, job, worker, values)
+
+
+def heartbeat(job_id, worker, lease, stop):
+    '''
+    Extend the lease of a running job every third of <lease> seconds until <stop> is set,
+    so that long jobs are not claimed again by other workers
+    '''
+    db = Session()
+    try:
+        while not stop.wait(lease / 3):
+            try:
+                db.query(Job).filter(Job.id == job_id, Job.worker == worker, Job.state == JobState.Running).update(
+                    {'lease_until': datetime.now() + timedelta(seconds=lease)}, synchronize_session=False)
+                db.commit()
+            except Exception:
+                db.rollback()
+    finally:
+        db.close()
+
+
+def run(db, job, worker, lease):
+    func = handlers.get(job.kind)
+    stop = threading.Event()
+    beat = threading.Thread(target=heartbeat, args=(job.id, worker, lease, stop), daemon=True)
+    beat.start()
+    try:
+        if not func:
+            raise JobError('Unknown job kind {}'.format(job.kind))
+        func(db, json.loads(job.payload))
+    except QuotaExceeded as e:
+        db.rollback()
+        tomorrow = datetime.combine(datetime.now().date() + timedelta(days=1), datetime.min.time())
+        fail(db, job, worker, str(e), run_after=tomorrow, count=False)
+        return False
+    except Exception as e:
+        db.rollback()
+        fail(db, job, worker, str(e))
+        return False
+    else:
+        return complete(db, job, worker)
+    finally:
+        stop.set()
+        beat.join()
+
+
+def queue_status(db=None):
+    db = db or session
+    return {state.name: db.query(Job).filter(Job.state == state).count() for state in JobState}
+
+
+def run_worker(workers=1, lease=1800, follow=False, poll=5):
+    '''
+    Drain the queue with <workers> threads, each with its own database session.
+    With <follow> the workers keep polling for new jobs instead of exiting
+    '''
+    name = '{}-{}'.format(socket.gethostname(), os.getpid())
+    results = {'done': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    def work(n):
+        db = Session()
+        try:
+            while True:
+                worker = '{}/{}'.format(name, n)
+                job = claim(db, worker, lease)
+                if not job:
+                    if follow:
+                        time.sleep(poll)
+                        continue
+                    return None
+
+                print('Worker {}: Running {} job {}'.format(n, job.kind, job.id))
+                done = run(db, job, worker, lease)
+                with lock:
+                    results['done' if done else 'failed'] += 1
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target=work, args=(n,), daemon=True) for n in range(max(workers, 1))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results
@@ -0,0 +1,175 @@
+import os
+import re
+import json
+import time
+import threading
+
+from sqlalchemy import event
+
+import progress
+
+from constants import engine, metrics_config
+
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+HELP = {
+    'tourer_http_requests_total': ('counter', 'HTTP and API requests sent, by outcome'),
+    'tourer_http_request_seconds': ('histogram', 'Latency of HTTP and API requests'),
+    'tourer_http_retries_total': ('counter', 'Requests repeated after a transient error'),
+    'tourer_uploaded_bytes_total': ('counter', 'Payload bytes sent'),
+    'tourer_stage_items_total': ('counter', 'Photos processed per stage or integration'),
+    'tourer_stage_failures_total': ('counter', 'Photos that failed per stage or integration'),
+    'tourer_stage_bytes_total': ('counter', 'Bytes uploaded per integration'),
+    'tourer_validation_rejects_total': ('counter', 'Photos rejected by validation, by reason'),
+    'tourer_decimated_total': ('counter', 'Photos dropped as too close to the previous photo kept'),
+    'tourer_db_transaction_seconds': ('histogram', 'Time from the start to the commit or rollback of DB transactions'),
+    'tourer_run_seconds': ('gauge', 'Duration of the run'),
+    'tourer_run_timestamp_seconds': ('gauge', 'Time the run finished')
+}
+
+counters = {}
+histograms = {}
+metrics_lock = threading.Lock()
+started = time.time()
+command = None
+
+
+
+def key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with metrics_lock:
+        k = key(name, labels)
+        counters[k] = counters.get(k, 0) + value
+
+
+def observe(name, seconds, **labels):
+    with metrics_lock:
+        k = key(name, labels)
+        histogram = histograms.get(k)
+        if not histogram:
+            histogram = histograms[k] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+
+def endpoint(url):
+    '''
+    URL path with IDs replaced, so each API endpoint is one series
+    '''
+    path = re.sub(r'^[a-z]+://[^/]+', '', url.split('?')[0])
+    return re.sub(r'/(?!v\d+(?:/|$))[^/]*\d[^/]*(?=/|$)', '/:id', path) or '/'
+
+
+def begin_transaction(conn):
+    conn.info['transaction_started'] = time.monotonic()
+
+
+def end_transaction(conn):
+    transaction_started = conn.info.pop('transaction_started', None)
+    if transaction_started is not None:
+        observe('tourer_db_transaction_seconds', time.monotonic() - transaction_started)
+
+
+event.listen(engine, 'begin', begin_transaction)
+event.listen(engine, 'commit', end_transaction)
+event.listen(engine, 'rollback', end_transaction)
+
+
+def collect():
+    '''
+    Counters and histograms of this run, including the progress counters
+    '''
+    with metrics_lock:
+        run_counters = dict(counters)
+        run_histograms = {k: dict(v, buckets=list(v['buckets'])) for k, v in histograms.items()}
+
+    for counter in progress.counters.values():
+        run_counters[key('tourer_stage_items_total', {'stage': counter.name})] = counter.done
+        run_counters[key('tourer_stage_failures_total', {'stage': counter.name})] = counter.failed
+        if counter.bytes:
+            run_counters[key('tourer_stage_bytes_total', {'stage': counter.name})] = counter.bytes
+
+    now = time.time()
+    run_counters[key('tourer_run_seconds', {})] = round(now - started, 3)
+    run_counters[key('tourer_run_timestamp_seconds', {})] = round(now, 3)
+
+    return run_counters, run_histograms
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if command:
+        labels.insert(0, ('command', command))
+    if not labels:
+        return ''
+
+    escaped = ['{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+    return '{' + ','.join(escaped) + '}'
+
+
+def textfile(run_counters, run_histograms):
+    lines = []
+    names = sorted(set(k[0] for k in run_counters) | set(k[0] for k in run_histograms))
+    for name in names:
+        kind, description = HELP.get(name, ('untyped', name))
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (metric, labels), value in sorted(run_counters.items()):
+            if metric == name:
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))
+
+        for (metric, labels), histogram in sorted(run_histograms.items()):
+            if metric != name:
+                continue
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', str(bound))]), count))
+            lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', '+Inf')]), histogram['count']))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), round(histogram['sum'], 6)))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def summary(run_counters, run_histograms):
+    def series(items):
+        return [dict(labels, name=name, value=value) for (name, labels), value in sorted(items)]
+
+    return {
+        'command': command,
+        'counters': series((k, v) for k, v in run_counters.items()),
+        'histograms': series((k, dict(v, buckets=dict(zip([str(b) for b in BUCKETS], v['buckets']))))
+                             for k, v in run_histograms.items())
+    }
+
+
+def write_atomic(path, content):
+    # The textfile collector may read at any time, never let it see a partial file
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def export(textfile_path=None, json_path=None):
+    '''
+    Write the metrics of this run as a Prometheus textfile and/or a JSON summary
+    '''
+    textfile_path = textfile_path or metrics_config['textfile']
+    json_path = json_path or metrics_config['json']
+    if not textfile_path and not json_path:
+        return None
+
+    run_counters, run_histograms = collect()
+    if textfile_path:
+        write_atomic(textfile_path, textfile(run_counters, run_histograms))
+    if json_path:
+        write_atomic(json_path, json.dumps(summary(run_counters, run_histograms), indent=2) + '\n')
@@ -1,4 +1,4 @@
-from sqlalchemy import ForeignKey, Column, Integer, Text, DateTime, Enum, Boolean, Float, String
+from sqlalchemy import ForeignKey, Column, Integer, Text, DateTime, Date, Enum, Boolean, Float, String, Index, UniqueConstraint
 from sqlalchemy.orm import backref, validates, relationship
 from sqlalchemy.ext.declarative import declarative_base
 import enum
@@ -36,6 +36,21 @@ class TransportType(enum.Enum):
     OtherAir = 20
 
 
+class SyncStatus(enum.Enum):
+    Pending = 1
+    Uploading = 2
+    Uploaded = 3
+    Failed = 4
+    Deleted = 5
+
+
+class JobState(enum.Enum):
+    Queued = 1
+    Running = 2
+    Done = 3
+    Failed = 4
+
+
 class TourTransport(Base):
     __tablename__ = 'tour_description'
     transp_id = Column(Integer, primary_key=True)
@@ -68,6 +83,9 @@ class Tour(Base):
     transp_id = Column(Integer, ForeignKey('tour_description.transp_id'))
     tourbook_tour_id = Column(Integer, ForeignKey('tourbook.tourbook_id'))
     integrations = Column(String(100), nullable=True)
+    explorer_fingerprint = Column(String(40))
+    explorer_pulled = Column(DateTime)
+    source_path = Column(String(300))
     
 class Photo(Base):
     __tablename__ = 'photo'
@@ -116,5 +134,74 @@ class Photo(Base):
     street_view_roll = Column(Text())
     street_view_level = Column(Text())
     street_view_connections = Column(Text())
+    street_view_fetched = Column(DateTime)
+    street_view_fingerprint = Column(String(40))
     otv_pano_id = Column(String(20))
+    explorer_fingerprint = Column(String(40))
     photo_heading = Column(Text())
+
+class QuotaUsage(Base):
+    __tablename__ = 'quota_usage'
+    id = Column(Integer, primary_key=True)
+    service = Column(String(20), nullable=False)
+    day = Column(Date, nullable=False)
+    requests = Column(Integer, default=0)
+    bytes = Column(Integer, default=0)
+
+class UploadTuning(Base):
+    __tablename__ = 'upload_tuning'
+    id = Column(Integer, primary_key=True)
+    service = Column(String(20), nullable=False, unique=True)
+    workers = Column(Integer)
+    bytes_per_sec = Column(Float)
+    latency = Column(Float)
+    updated = Column(DateTime)
+
+class PhotoSync(Base):
+    __tablename__ = 'photo_sync'
+    __table_args__ = (
+        UniqueConstraint('photo_id', 'integration'),
+        Index('ix_photo_sync_integration_state', 'integration', 'state'),
+    )
+    id = Column(Integer, primary_key=True)
+    photo_id = Column(String(10), ForeignKey('photo.photo_id'), nullable=False)
+    integration = Column(String(20), nullable=False)
+    state = Column(Enum(SyncStatus), default=SyncStatus.Pending)
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text())
+    created = Column(DateTime, default=datetime.datetime.now)
+    updated = Column(DateTime, default=datetime.datetime.now)
+
+class ListingCache(Base):
+    __tablename__ = 'listing_cache'
+    id = Column(Integer, primary_key=True)
+    url = Column(Text(), nullable=False, unique=True)
+    etag = Column(Text())
+    last_page = Column(Boolean, default=False)
+
+class SkippedFile(Base):
+    __tablename__ = 'skipped_file'
+    id = Column(Integer, primary_key=True)
+    source_path = Column(Text(), nullable=False, index=True)
+    fullpath = Column(Text(), nullable=False)
+
+class Job(Base):
+    __tablename__ = 'job'
+    __table_args__ = (
+        Index('ix_job_state_priority', 'state', 'priority', 'run_after'),
+        Index('ix_job_key', 'key'),
+    )
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(20), nullable=False)
+    key = Column(String(100))
+    payload = Column(Text())
+    priority = Column(Integer, default=0)
+    state = Column(Enum(JobState), default=JobState.Queued)
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=5)
+    worker = Column(String(100))
+    lease_until = Column(DateTime)
+    run_after = Column(DateTime)
+    last_error = Column(Text())
+    created = Column(DateTime, default=datetime.datetime.now)
+    updated = Column(DateTime, default=datetime.datetime.now)
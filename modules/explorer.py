@@ -1,21 +1,38 @@
 import os
 import sys
 import json
+import datetime
+import email.utils
+
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
-from constants import auth_config, session
-from models import Photo
+import retry
+import autotune
+import ratelimit
+
+from constants import auth_config, endpoints_config
 
 
+# Items requested per page of a listing
+PAGE_SIZE = 100
+
 
 class Explorer(object):
     def __init__(self, init=False):
         self.name = 'Trek View Explorer'
         self.short_name = 'explorer'
-        self.api_url = 'https://explorer.trekview.org/api/v1/'
+        self.api_url = endpoints_config['explorer_url'].rstrip('/') + '/'
         self.key_reason = None
         self.headers = None
+        self.user_id = None
+        self.http = requests.Session()
+        self.limiter = None
+        self.tuner = None
+        # Validators of listing pages seen before, by page URL, and the pages requested since
+        self.etags = {}
+        self.visited = set()
 
         version_file = 'VERSION.txt'
         if os.path.exists(version_file):
@@ -25,14 +42,16 @@ class Explorer(object):
             self.version = '0'
         
         if not init:
+            self.limiter = ratelimit.get_limiter('explorer')
+            self.tuner = autotune.get_tuner('explorer')
             ek = auth_config[2]['key']
             if ek:
                 self.headers = {
                     'Content-Type': 'application/json',
                     'api-key': ek
                 }
-                user_id = self.get_user_id()
-                if not user_id:
+                self.user_id = self.get_user_id()
+                if not self.user_id:
                     self.key_reason = 'with invalid'
                     print(self.name + ': Invalid API key')
             else:
@@ -44,9 +63,12 @@ class Explorer(object):
             print(self.name + ': You can not get user id {} API key'.format(self.key_reason))
             return None
 
+        if self.user_id:
+            return self.user_id
+
         user_info_url = self.api_url + 'users'
 
-        r = requests.get(user_info_url, headers=self.headers)
+        r = retry.send(self.http, 'GET', user_info_url, headers=self.headers, limiter=self.limiter)
 
         if r.status_code == 200 or r.status_code == 201:
             user_id = r.json()['user']['id']
@@ -61,11 +83,12 @@ class Explorer(object):
         
         photo['tourer[version]'] = self.version
         add_photo_url = self.api_url + 'tours/{}/photos'.format(explorer_tour_id)
-        files = {'image': open(photo['fullpath'], 'rb')}
         headers = {
             'api-key': auth_config[2]['key']
         }
-        r = requests.post(add_photo_url, data=photo, files=files, headers=headers)
+        with open(photo['fullpath'], 'rb') as f:
+            files = {'image': f}
+            r = retry.send(self.http, 'POST', add_photo_url, data=photo, files=files, headers=headers, limiter=self.limiter)
         if r.status_code == 200 or r.status_code == 201:
             photo_id = r.json()['photo']['id']
             print(self.name + ': Photo uploaded, explorer photo ID ' + str(photo_id))
@@ -84,26 +107,112 @@ class Explorer(object):
         headers = {
             'api-key': auth_config[2]['key']
         }
-        r = requests.put(update_photo_url, data=photo, headers=headers)
+        r = retry.send(self.http, 'PUT', update_photo_url, data=photo, headers=headers, limiter=self.limiter)
         if r.status_code == 200 or r.status_code == 201:
             print(self.name + ': Photo updated')
+            return True
         else:
             print(self.name + ': Failed to update photo')
+            return False
+
+    def sync_photos(self, explorer_tour_id, photos, workers=1):
+        '''
+        Create or update photos through a pool of at most <workers> requests in flight,
+        as many as the tuner allows. Returns explorer photo IDs by tourer photo ID for the photos that were synced,
+        and the errors by tourer photo ID of those that raised, QuotaExceeded included
+        '''
+        def sync(photo):
+            explorer_photo_id = photo.get('explorer_photo_id')
+            try:
+                if explorer_photo_id:
+                    if not self.tuner.run(0, self.update_photo, photo, explorer_tour_id, explorer_photo_id):
+                        explorer_photo_id = None
+                else:
+                    size = os.stat(photo['fullpath']).st_size
+                    explorer_photo_id = self.tuner.run(size, self.add_photo, explorer_tour_id, photo)
+            except Exception as e:
+                return photo['tourer[photo_id]'], e
+
+            return photo['tourer[photo_id]'], explorer_photo_id
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            results = list(executor.map(sync, photos))
+
+        synced = {photo_id: result for photo_id, result in results if result and not isinstance(result, Exception)}
+        errors = {photo_id: result for photo_id, result in results if isinstance(result, Exception)}
+        return synced, errors
 
     def list_photos(self, explorer_tour_id):
         if self.key_reason:
             print(self.name + ': You can not list photos {} API key'.format(self.key_reason))
             return None
 
-        list_url = self.api_url + 'tours/{}/photos'.format(explorer_tour_id)
-        r = requests.get(list_url, headers=self.headers)
-        if r.status_code == 200 or r.status_code == 201:
-            photos = r.json()['photos']
-            print(self.name + ': Photo list fetched')
-            return photos
-        else:
+        try:
+            photos = list(self.iter_photos(explorer_tour_id))
+        except requests.exceptions.RequestException:
             return None
 
+        print(self.name + ': Photo list fetched')
+        return photos
+
+    def iter_photos(self, explorer_tour_id, updated_since=None):
+        list_url = self.api_url + 'tours/{}/photos'.format(explorer_tour_id)
+        return self.iter_pages(list_url, 'photos', updated_since=updated_since)
+
+    def iter_pages(self, list_url, key, params=None, updated_since=None):
+        '''
+        Yield the items of a paginated listing page by page.
+        Pages whose ETag is unchanged are skipped, and nothing is yielded when the
+        server reports no change since <updated_since>. Raises HTTPError on failure
+        '''
+        params = dict(params or {})
+        params['per_page'] = PAGE_SIZE
+        if updated_since:
+            since = updated_since.astimezone(datetime.timezone.utc)
+            params['updated_since'] = since.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        seen = set()
+        page = 1
+
+        while True:
+            params['page'] = page
+            # Leave the moving updated_since out so validators carry over between pulls
+            page_key = '{}?{}'.format(list_url, '&'.join('{}={}'.format(k, params[k]) for k in sorted(params) if k != 'updated_since'))
+            self.visited.add(page_key)
+            headers = dict(self.headers)
+            cached = self.etags.get(page_key)
+            if cached:
+                headers['If-None-Match'] = cached['etag']
+            if updated_since:
+                headers['If-Modified-Since'] = email.utils.format_datetime(since, usegmt=True)
+
+            r = retry.send(self.http, 'GET', list_url, params=params, headers=headers, limiter=self.limiter)
+
+            if r.status_code == 304:
+                if not cached or cached['last_page']:
+                    return None
+                page += 1
+                continue
+
+            r.raise_for_status()
+            items = r.json()[key]
+            ids = [item['id'] for item in items]
+            # Servers that ignore pagination return the same items again
+            if seen.intersection(ids):
+                return None
+            seen.update(ids)
+
+            last_page = len(items) != PAGE_SIZE
+            if r.headers.get('ETag'):
+                self.etags[page_key] = {'etag': r.headers['ETag'], 'last_page': last_page}
+
+            for item in items:
+                yield item
+
+            if last_page:
+                return None
+            page += 1
+
     def delete_photo(self, explorer_tour_id, explorer_photo_id):
         if self.key_reason:
             print(self.name + ': You can not delete photo {} API key'.format(self.key_reason))
@@ -112,7 +221,7 @@ class Explorer(object):
         delete_photo_url = self.api_url + 'tours/{}/photos/{}'.format(
                                 explorer_tour_id, explorer_photo_id)
 
-        r = requests.delete(delete_photo_url, headers=self.headers)
+        r = retry.send(self.http, 'DELETE', delete_photo_url, headers=self.headers, limiter=self.limiter)
         if r.status_code == 200 or r.status_code == 201:
             print(self.name + ': Photo deleted, explorer photo ID ' + str(explorer_photo_id))
             return True
@@ -139,7 +248,7 @@ class Explorer(object):
             }
 
         data = json.dumps(tour)
-        r = requests.post(create_url, data=data, headers=self.headers)
+        r = retry.send(self.http, 'POST', create_url, data=data, headers=self.headers, limiter=self.limiter)
         if r.status_code == 200 or r.status_code == 201:
             explorer_tour_id = r.json()['tour']['id']
             print(self.name + ': Tour created, explorer tour ID ' + str(explorer_tour_id))
@@ -154,7 +263,7 @@ class Explorer(object):
             return None
 
         delete_url = '{}tours/{}'.format(self.api_url, explorer_tour_id)
-        r = requests.delete(delete_url, headers=self.headers)
+        r = retry.send(self.http, 'DELETE', delete_url, headers=self.headers, limiter=self.limiter)
 
         if r.status_code == 200 or r.status_code == 201:
             print(self.name + ': Tour deleted, explorer tour ID ' + str(explorer_tour_id))
@@ -163,19 +272,16 @@ class Explorer(object):
             print(self.name + ': Falied to delete tour')
             return False
     
-    def update_tour(self, explorer_tour_id, tour_id=None, description=None, tags=None, tour_type=None, transport_type=None, photos=None):
+    def update_tour(self, explorer_tour_id, tour_id=None, description=None, tags=None, tour_type=None, transport_type=None, photos=None, workers=1):
+        '''
+        Update tour fields, or add <photos> to the tour and return their explorer photo IDs
+        '''
         if self.key_reason:
             print('{}: You can not update tour {} API key'.format(self.name, self.key_reason))
             return None
 
         if photos:
-            for photo in photos:
-                explorer_photo_id = self.add_photo(explorer_tour_id, photo)
-                photo_id = photo['tourer[photo_id]']
-                photo = session.query(Photo).filter(Photo.photo_id == photo_id).first()
-                photo.explorer_photo_id = explorer_photo_id
-                session.add(photo)
-                session.commit()
+            updated, errors = self.sync_photos(explorer_tour_id, photos, workers)
         else:
             update_url = '{}tours/{}'.format(self.api_url, explorer_tour_id)
             tour_fields = {
@@ -190,22 +296,25 @@ class Explorer(object):
             }
                 
             data = json.dumps(tour_fields)
-            r = requests.put(update_url, data=data, headers=self.headers)
+            r = retry.send(self.http, 'PUT', update_url, data=data, headers=self.headers, limiter=self.limiter)
+            updated = r.status_code == 200 or r.status_code == 201
 
         print(self.name + ': Tour updated')
+        return updated
 
     def list_tours(self, user_id):
         if self.key_reason:
             print(self.name + ': You can not list tours {} API key'.format(self.key_reason))
             return None
 
-        list_url = self.api_url + 'tours?user_ids[]=' + str(user_id)
+        try:
+            tours = list(self.iter_tours(user_id))
+        except requests.exceptions.RequestException:
+            return None
 
-        r = requests.get(list_url, headers=self.headers)
+        print(self.name + ': Tour list fetched')
+        return tours
 
-        if r.status_code == 200 or r.status_code == 201:
-            tours = r.json()['tours']
-            print(self.name + ': Tour list fetched')
-            return tours
-        else:
-            return None
+    def iter_tours(self, user_id, updated_since=None):
+        list_url = self.api_url + 'tours'
+        return self.iter_pages(list_url, 'tours', {'user_ids[]': user_id}, updated_since)
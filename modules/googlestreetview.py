@@ -4,6 +4,9 @@ import json
 import time
 import click
 import datetime
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import google.oauth2.credentials
@@ -11,14 +14,82 @@ import googleapiclient.discovery
 
 from google.protobuf.timestamp_pb2 import Timestamp
 from google.protobuf.field_mask_pb2 import FieldMask
-from google.streetview.publish_v1.proto import resources_pb2
+from google.protobuf import json_format
+from google.type import latlng_pb2
+from google.streetview.publish_v1.proto import resources_pb2, rpcmessages_pb2
 from google.streetview.publish_v1 import street_view_publish_service_client as client, enums
 
 from oauth2client.client import OAuth2WebServerFlow
 from oauth2client.file import Storage
 from oauth2client import tools
 
-from constants import auth_config
+import retry
+import autotune
+import progress
+import ratelimit
+
+from constants import auth_config, endpoints_config
+
+
+# Seconds before token_expiry at which the access token is refreshed
+REFRESH_MARGIN = 300
+REFRESH_RETRY = 30
+# Maximum number of photos per batch request of the Street View Publish API
+BATCH_SIZE = 20
+
+
+class ApiError(Exception):
+    '''
+    Error response of the REST API, with the HTTP status as code like google.api_core errors
+    '''
+    def __init__(self, code, message):
+        super().__init__('{} {}'.format(code, message))
+        self.code = code
+
+
+class RestClient(object):
+    '''
+    The methods of StreetViewPublishServiceClient used here, over the REST API at <api_url>,
+    so that another endpoint such as a local fake server can stand in for Google
+    '''
+    def __init__(self, api_url, token, http):
+        self.api_url = api_url.rstrip('/') + '/'
+        self.token = token
+        self.http = http
+
+    def request(self, method, path, body=None, params=None):
+        headers = {'Authorization': 'Bearer ' + self.token}
+        r = self.http.request(method, self.api_url + path, json=body, params=params, headers=headers)
+        if r.status_code >= 400:
+            raise ApiError(r.status_code, r.text)
+
+        return r.json() if r.content else {}
+
+    def parse(self, data, message):
+        return json_format.ParseDict(data, message, ignore_unknown_fields=True)
+
+    def start_upload(self):
+        return self.parse(self.request('POST', 'photo:startUpload', {}), resources_pb2.UploadRef())
+
+    def create_photo(self, photo):
+        return self.parse(self.request('POST', 'photo', json_format.MessageToDict(photo)), resources_pb2.Photo())
+
+    def delete_photo(self, photo_id):
+        # The empty body is falsy, and callers read a falsy result as a failed delete
+        self.request('DELETE', 'photo/' + photo_id)
+        return True
+
+    def batch_delete_photos(self, photo_ids):
+        response = self.request('POST', 'photos:batchDelete', {'photoIds': list(photo_ids)})
+        return self.parse(response, rpcmessages_pb2.BatchDeletePhotosResponse())
+
+    def batch_get_photos(self, photo_ids, view):
+        params = {'photoIds': list(photo_ids), 'view': rpcmessages_pb2.PhotoView.Name(int(view))}
+        return self.parse(self.request('GET', 'photos:batchGet', params=params), rpcmessages_pb2.BatchGetPhotosResponse())
+
+    def batch_update_photos(self, update_requests):
+        body = {'updatePhotoRequests': [json_format.MessageToDict(r) for r in update_requests]}
+        return self.parse(self.request('POST', 'photos:batchUpdate', body), rpcmessages_pb2.BatchUpdatePhotosResponse())
 
 
 
@@ -26,18 +97,61 @@ class GoogleStreetView(object):
     def __init__(self, init=False):
         self.name = 'Google Street View'
         self.short_name = 'gsv'
+        self.credentials = None
+        self.storage = None
+        self.token_expiry = None
+        self.token_lock = threading.Lock()
+        self.refresh_timer = None
+        self.http = requests.Session()
+        self.limiter = None
+        self.tuner = None
         
         if not init:
+            self.limiter = ratelimit.get_limiter('gsv')
+            self.tuner = autotune.get_tuner('gsv')
             self.token = self.get_access_token()
-            credentials = google.oauth2.credentials.Credentials(self.token) 
-            self.stclient = client.StreetViewPublishServiceClient(credentials=credentials)
+            self.set_client()
+            self.schedule_refresh()
+
+    def set_client(self):
+        if endpoints_config['gsv_api_url']:
+            self.stclient = RestClient(endpoints_config['gsv_api_url'], self.token, self.http)
+            return None
+
+        credentials = google.oauth2.credentials.Credentials(self.token) 
+        self.stclient = client.StreetViewPublishServiceClient(credentials=credentials)
+
+    def schedule_refresh(self, delay=None):
+        '''
+        Refresh the cached access token in the background before it expires
+        '''
+        if delay is None:
+            if not self.token_expiry:
+                return None
+            delay = (self.token_expiry - datetime.datetime.utcnow()).total_seconds() - REFRESH_MARGIN
+
+        self.refresh_timer = threading.Timer(max(delay, 0), self.background_refresh)
+        self.refresh_timer.daemon = True
+        self.refresh_timer.start()
+
+    def background_refresh(self):
+        try:
+            with self.token_lock:
+                self.credentials = self.refresh_token(self.credentials, self.storage)
+                self.token = self.credentials.access_token
+                self.token_expiry = self.credentials.token_expiry
+                self.set_client()
+        except Exception:
+            self.schedule_refresh(REFRESH_RETRY)
+        else:
+            self.schedule_refresh()
 
     def upload_photo(self, fl):
         distance = None
         heading = None
         countries = []
 
-        upload_ref = self.stclient.start_upload()
+        upload_ref = retry.call(self.stclient.start_upload, limiter=self.limiter)
 
         filesize = os.stat(fl['fname']).st_size
         _, ftype = os.path.splitext(fl['fname'])
@@ -55,58 +169,39 @@ class GoogleStreetView(object):
             'X-Goog-Upload-Command': 'start'
         }
 
-        resumableUrl = requests.post(upload_ref.upload_url, headers=headers).headers['X-Goog-Upload-URL']
+        response = retry.send(self.http, 'POST', upload_ref.upload_url, idempotent=True, headers=headers, limiter=self.limiter)
+        resumableUrl = response.headers['X-Goog-Upload-URL']
 
         chunk_size = 3 * 1024 * 1024
-        f = open(fl['fname'], 'rb')
         num_of_chunks = int(filesize / chunk_size)
+        last_chunk = filesize % chunk_size
+
+        with open(fl['fname'], 'rb') as f:
+            for i in range(num_of_chunks + 1):
+                offset = chunk_size * i
+                if i < num_of_chunks:
+                    length = chunk_size
+                    command = 'upload'
+                else:
+                    length = last_chunk
+                    command = 'upload, finalize'
 
-        for i in range(num_of_chunks):
-            cnt = 0
-            offset = chunk_size * i
-            headers = {
-                'Authorization': 'Bearer ' + self.token,
-                'Content-Length': str(chunk_size),
-                'X-Goog-Upload-Command': 'upload',
-                'X-Goog-Upload-Offset': str(offset)
-            }
-
-            f.seek(offset)
-            data = f.read(chunk_size)
-            part_uploaded = False
-
-            while not part_uploaded:
-                try:
-                    response = requests.post(resumableUrl, data=data, headers=headers)
-                    part_uploaded = True
-                except requests.exceptions.ConnectionError as e:
-                    print('Network error, waiting for {} seconds before next attempt'.format(2 ** cnt))
-                    time.sleep(2 ** cnt)
-                    cnt += 1
+                headers = {
+                    'Authorization': 'Bearer ' + self.token,
+                    'Content-Length': str(length),
+                    'X-Goog-Upload-Command': command,
+                    'X-Goog-Upload-Offset': str(offset)
+                }
 
-        last_chunk = filesize % chunk_size
-        offset = chunk_size * num_of_chunks
-        headers = {
-            'Authorization': 'Bearer ' + self.token,
-            'Content-Length': str(last_chunk),
-            'X-Goog-Upload-Command': 'upload, finalize',
-            'X-Goog-Upload-Offset': str(offset)
-        }
+                f.seek(offset)
+                data = f.read(length)
+                # Re-sending a chunk at the same offset is safe
+                response = retry.send(self.http, 'POST', resumableUrl, idempotent=True, data=data, headers=headers, limiter=self.limiter)
 
-        f.seek(offset)
-        data = f.read(last_chunk)
-        last_part_uploaded = False
-        last_cnt = 0
+        last_part_uploaded = response.status_code == 200
+        if not last_part_uploaded:
+            print('Google Street View: Failed to upload photo ' + fl['fname'])
 
-        while not last_part_uploaded:
-            try:
-                response = requests.post(resumableUrl, data=data, headers=headers)
-                last_part_uploaded = True
-            except requests.exceptions.ConnectionError as e:
-                print('Network error, waiting for {} seconds before next attempt'.format(2 ** cnt))
-                time.sleep(2 ** last_cnt)
-                last_cnt += 1
-            
         if last_part_uploaded:
             seconds = int((fl['timestamp'] - datetime.datetime.utcfromtimestamp(0)).total_seconds())
             timestamp = Timestamp(seconds=seconds)
@@ -117,32 +212,142 @@ class GoogleStreetView(object):
                 photo = resources_pb2.Photo(capture_time=timestamp)
             
             photo.upload_reference.upload_url = upload_ref.upload_url
-            uploaded_photo = self.stclient.create_photo(photo)
+            uploaded_photo = retry.call(self.stclient.create_photo, photo, idempotent=False, limiter=self.limiter)
 
             print('Google Street View: Photo uploaded, ID ' + uploaded_photo.photo_id.id)
 
             return uploaded_photo
             
+    def upload_photos(self, fls, workers=1):
+        '''
+        Upload photos with at most <workers> in flight, as many as the tuner allows.
+        Returns the uploaded photos in order of <fls>, or the error of a failed upload.
+        QuotaExceeded is returned too, so uploads that finished before it are never lost
+        '''
+        def upload(fl):
+            try:
+                return self.tuner.run(os.stat(fl['fname']).st_size, self.upload_photo, fl)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            return list(executor.map(upload, fls))
+
     def delete_photo(self, gsv_photo_id):
         delete_response = None
         try:
-            delete_response = self.stclient.delete_photo(gsv_photo_id)
+            delete_response = retry.call(self.stclient.delete_photo, gsv_photo_id, limiter=self.limiter)
         except:
             print('Google Street View: Photo not found')
             
         return delete_response
 
+    def delete_photos(self, gsv_photo_ids, workers=1):
+        '''
+        Delete photos in API-sized batches, returns errors by Street View photo ID
+        '''
+        def delete(batch):
+            try:
+                statuses = retry.call(self.stclient.batch_delete_photos, batch, limiter=self.limiter).status
+            except Exception as e:
+                return {gsv_photo_id: str(e) for gsv_photo_id in batch}
+
+            # NOT_FOUND means the photo is already gone
+            return {gsv_photo_id: status.message or 'Error code {}'.format(status.code)
+                        for gsv_photo_id, status in zip(batch, statuses) if status.code not in (0, 5)}
+
+        batches = [gsv_photo_ids[i:i + BATCH_SIZE] for i in range(0, len(gsv_photo_ids), BATCH_SIZE)]
+        failed = {}
+        counter = progress.counter(self.name + ' delete', len(gsv_photo_ids))
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            for batch, errors in zip(batches, executor.map(delete, batches)):
+                failed.update(errors)
+                counter.update(len(batch), failed=len(errors))
+
+        return failed
+
     def get_photo_info(self, gsv_photo_ids):
         view = enums.PhotoView.BASIC
         info = None
         try:
-            info = self.stclient.batch_get_photos(gsv_photo_ids, view).results
+            info = retry.call(self.stclient.batch_get_photos, gsv_photo_ids, view, limiter=self.limiter).results
         except:
             print('Google Street View: Photo not found')
 
         return info
 
+    def get_photos_info(self, gsv_photo_ids, workers=1):
+        '''
+        Fetch photo info in API-sized batches, returns photos by Street View photo ID
+        '''
+        batches = [gsv_photo_ids[i:i + BATCH_SIZE] for i in range(0, len(gsv_photo_ids), BATCH_SIZE)]
+        photos = {}
+        counter = progress.counter(self.name + ' fetch', len(gsv_photo_ids))
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            for batch, results in zip(batches, executor.map(self.get_photo_info, batches)):
+                fetched = [r.photo for r in results or [] if not r.status.code]
+                for photo in fetched:
+                    photos[photo.photo_id.id] = photo
+                counter.update(len(batch), failed=len(batch) - len(fetched))
+
+        return photos
+
+    def update_poses(self, poses, workers=1):
+        '''
+        Update pose and connections of photos in API-sized batches,
+        returns the Street View photo IDs that were updated
+        '''
+        update_requests = []
+        for pose in poses:
+            photo = resources_pb2.Photo(
+                photo_id=resources_pb2.PhotoId(id=pose['photo_id']),
+                pose=resources_pb2.Pose(
+                    lat_lng_pair=latlng_pb2.LatLng(latitude=pose['lat'], longitude=pose['lon']),
+                    altitude=pose['altitude']
+                ),
+                connections=[resources_pb2.Connection(target=resources_pb2.PhotoId(id=c)) for c in pose['connections']]
+            )
+            paths = ['pose.lat_lng_pair', 'pose.altitude', 'connections']
+            if pose['heading'] is not None:
+                photo.pose.heading = pose['heading']
+                paths.append('pose.heading')
+
+            update_requests.append(rpcmessages_pb2.UpdatePhotoRequest(photo=photo, update_mask=FieldMask(paths=paths)))
+
+        batches = [update_requests[i:i + BATCH_SIZE] for i in range(0, len(update_requests), BATCH_SIZE)]
+        updated = []
+        counter = progress.counter(self.name + ' pose', len(update_requests))
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            for batch, results in zip(batches, executor.map(self.update_photos, batches)):
+                batch_updated = [r.photo.photo_id.id for r in results or [] if not r.status.code]
+                updated += batch_updated
+                counter.update(len(batch), failed=len(batch) - len(batch_updated))
+
+        return updated
+
+    def update_photos(self, update_requests):
+        results = None
+        try:
+            results = retry.call(self.stclient.batch_update_photos, update_requests, limiter=self.limiter).results
+        except:
+            print('Google Street View: Failed to update photos')
+
+        return results
+
+    def publish_status(self, photo):
+        try:
+            return resources_pb2.Photo.MapsPublishStatus.Name(photo.maps_publish_status)
+        except (AttributeError, ValueError):
+            return None
+
     def get_access_token(self):
+        # A fixed token, for endpoints that do not check it
+        if endpoints_config['gsv_access_token']:
+            return endpoints_config['gsv_access_token']
+
         client_id = auth_config[0]['client_id']
         client_secret = auth_config[0]['client_secret']
         if client_id != '' and client_secret != '':
@@ -175,7 +380,9 @@ class GoogleStreetView(object):
             if tokeninfo == -1:
                 credentials = self.refresh_token(credentials, storage)
 
-            exp = credentials.token_expiry
+            self.credentials = credentials
+            self.storage = storage
+            self.token_expiry = credentials.token_expiry
             assert credentials.access_token is not None
 
             return credentials.access_token
@@ -185,24 +392,19 @@ class GoogleStreetView(object):
 
     def get_token_info(self, token):
         url = 'https://www.googleapis.com/oauth2/v1/tokeninfo?alt=json&access_token={}'.format(token)
-        cnt = 0
+        try:
+            res = retry.send(requests, 'GET', url)
+        except requests.exceptions.ConnectionError:
+            return -2
 
-        while True:
-            try:
-                res = requests.get(url)
-                tokeninfo = json.loads(res.text)
-                seconds_to_expire = int(tokeninfo.get('expires_in', 0))
-        
-                if seconds_to_expire <= 0:
-                    return -1
-                else:
-                    expires = datetime.datetime.now() + datetime.timedelta(seconds=seconds_to_expire)
-                    return expires.strftime('%H:%M:%S %d/%m/%Y')
+        tokeninfo = json.loads(res.text)
+        seconds_to_expire = int(tokeninfo.get('expires_in', 0))
 
-            except requests.exceptions.ConnectionError as e:
-                print('Network error, waiting for {} seconds before next attempt'.format(2 ** cnt))
-                time.sleep(2 ** cnt)
-                cnt += 1
+        if seconds_to_expire <= 0:
+            return -1
+        else:
+            expires = datetime.datetime.now() + datetime.timedelta(seconds=seconds_to_expire)
+            return expires.strftime('%H:%M:%S %d/%m/%Y')
 
     def refresh_token(self, credentials, storage):
         token = credentials.access_token
@@ -218,6 +420,7 @@ class GoogleStreetView(object):
         refresh_credentials.refresh(google.auth.transport.requests.Request())
         token = refresh_credentials.token
         credentials.access_token = token
+        credentials.token_expiry = refresh_credentials.expiry
         storage.put(credentials)
         
         return credentials
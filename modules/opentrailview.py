@@ -2,9 +2,16 @@ import os
 import json
 import click
 
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
-from constants import auth_config
+import retry
+import autotune
+import progress
+import ratelimit
+
+from constants import auth_config, endpoints_config
 
 
 
@@ -12,8 +19,14 @@ class OpenTrailView(object):
     def __init__(self, init=False):
         self.name = 'Open Trail View'
         self.short_name = 'otv'
+        self.base_url = endpoints_config['otv_url'].rstrip('/') + '/'
         self.headers = None
+        self.http = requests.Session()
+        self.limiter = None
+        self.tuner = None
         if not init:
+            self.limiter = ratelimit.get_limiter('otv')
+            self.tuner = autotune.get_tuner('otv')
             self.token = self.get_access_token()
             self.headers = {
                 'Authorization': 'Bearer ' + self.token
@@ -35,8 +48,8 @@ class OpenTrailView(object):
             client_id = auth_config[1]['client_id']
             client_secret = auth_config[1]['client_secret']
             
-            url = 'https://opentrailview.org/oauth/auth/authorize?response_type=code&client_id={}&redirect_uri={}&directReturn=1'.format(
-                    client_id, 'https://opentrailview.org/')
+            url = self.base_url + 'oauth/auth/authorize?response_type=code&client_id={}&redirect_uri={}&directReturn=1'.format(
+                    client_id, self.base_url)
             print(self.name + ': ' + 'Use this link to get the code: ' + url)
             code = click.prompt('Enter URL code')
 
@@ -47,8 +60,8 @@ class OpenTrailView(object):
                 'code': code,
             }
 
-            at_url = 'https://opentrailview.org/oauth/auth/access_token?redirect_uri=https://opentrailview.org'
-            r = requests.post(at_url, data=data)
+            at_url = self.base_url + 'oauth/auth/access_token?redirect_uri=' + self.base_url.rstrip('/')
+            r = retry.send(requests, 'POST', at_url, data=data)
 
             if r.status_code == 200:
                 token_data = r.json()
@@ -64,26 +77,64 @@ class OpenTrailView(object):
         
         return token
     
-    def upload_photo(self, fl, tour_id):
+    def upload_photo(self, fl, tour_id, move=True):
         if not self.token:
             print(self.name + ': ' + 'Falied to upload photo, auth error')
             return None
 
-        upload_url = 'https://opentrailview.org/oauth/api/panorama/upload'
+        upload_url = self.base_url + 'oauth/api/panorama/upload'
+
+        with open(fl['fname'], 'rb') as f:
+            files = {
+                'file': f,
+            }
+            r = retry.send(self.http, 'POST', upload_url, headers=self.headers, files=files, limiter=self.limiter)
 
-        files = {
-            'file': open(fl['fname'], 'rb'),
-        }
-        r = requests.post(upload_url, headers=self.headers, files=files)
         if r.status_code == 200:
             pano_id = r.json().get('id')
             print(self.name + ': ' + 'Photo uploaded, pano ID ' + str(pano_id))
-            self.move_photo(pano_id, fl['gpsdata']['Latitude'], fl['gpsdata']['Longitude'])
+            if move:
+                self.move_photo(pano_id, fl['gpsdata']['Latitude'], fl['gpsdata']['Longitude'])
             return pano_id
         else:
             print(self.name + ': ' + 'Falied to upload photo')
             return None
 
+    def upload_photos(self, fls, tour_id, workers=1, move=True):
+        '''
+        Upload photos with at most <workers> in flight, as many as the tuner allows,
+        moving each panorama into position while the next uploads run.
+        Returns pano IDs in order of <fls>, or the error of a failed upload,
+        and the pano IDs of the panoramas that could not be moved
+        '''
+        workers = max(workers, 1)
+        moves = {}
+
+        with ThreadPoolExecutor(max_workers=workers) as movers:
+            def upload(fl):
+                try:
+                    pano_id = self.tuner.run(os.stat(fl['fname']).st_size, self.upload_photo, fl, tour_id, move=False)
+                except Exception as e:
+                    return e
+                if pano_id and move:
+                    moves[pano_id] = movers.submit(self.move_photo, pano_id, fl['gpsdata']['Latitude'], fl['gpsdata']['Longitude'])
+                return pano_id
+
+            with ThreadPoolExecutor(max_workers=workers) as uploaders:
+                pano_ids = list(uploaders.map(upload, fls))
+
+        unmoved = set()
+        for pano_id, future in moves.items():
+            try:
+                moved = future.result()
+            except Exception as e:
+                print(self.name + ': ' + 'Falied to move photo, ' + str(e))
+                moved = False
+            if not moved:
+                unmoved.add(pano_id)
+
+        return pano_ids, unmoved
+
     def move_photo(self, pano_id, lat, lon):
         if not self.token:
             print(self.name + ': ' + 'Falied to move photo, auth error')
@@ -93,8 +144,8 @@ class OpenTrailView(object):
                 'lat': lat,
                 'lon': lon
             }
-        move_url = 'https://opentrailview.org/oauth/api/panorama/' + str(pano_id) + '/move'
-        r = requests.post(move_url, data=data, headers=self.headers)
+        move_url = self.base_url + 'oauth/api/panorama/' + str(pano_id) + '/move'
+        r = retry.send(self.http, 'POST', move_url, idempotent=True, data=data, headers=self.headers, limiter=self.limiter)
         if r.status_code == 200:
             return True
         else:
@@ -106,12 +157,29 @@ class OpenTrailView(object):
             print(self.name + ': ' + 'Falied to delete photo, auth error')
             return None
         
-        delete_url = 'https://opentrailview.org/oauth/api/panorama/' + str(pano_id)
+        delete_url = self.base_url + 'oauth/api/panorama/' + str(pano_id)
 
-        r = requests.delete(delete_url, headers=self.headers)
+        r = retry.send(self.http, 'DELETE', delete_url, headers=self.headers, limiter=self.limiter)
         if r.status_code == 200:
             print(self.name + ': ' + 'Photo deleted, pano ID ' + str(pano_id))
             return True
         else:
             print(self.name + ': ' + 'Falied to delete photo')
             return False
+
+    def delete_photos(self, pano_ids, workers=1):
+        '''
+        Delete panoramas concurrently, returns errors by pano ID
+        '''
+        counter = progress.counter(self.name + ' delete', len(pano_ids))
+
+        def delete(pano_id):
+            success = self.delete_photo(pano_id)
+            counter.update(failed=0 if success else 1)
+            return success
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            results = executor.map(delete, pano_ids)
+            failed = {pano_id: 'Failed to delete photo' for pano_id, success in zip(pano_ids, results) if not success}
+
+        return failed
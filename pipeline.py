@@ -0,0 +1,127 @@
+import queue
+import threading
+
+import progress
+
+from constants import Session
+from ratelimit import QuotaExceeded
+
+
+DONE = object()
+
+
+
+class Stage(object):
+    '''
+    A group of <workers> threads calling <func> with their own database session
+    and each item of a bounded input queue. Results other than None are passed on
+    to the stages this one feeds, so a slow stage holds back the ones before it.
+    Without <counted> the stage leaves progress reporting to <func>.
+    Once a quota is exceeded, the stages of the run skip their remaining items
+    '''
+    def __init__(self, name, func, workers=1, maxsize=None, counted=True):
+        self.name = name
+        self.func = func
+        self.workers = max(workers, 1)
+        self.queue = queue.Queue(maxsize or self.workers * 2)
+        self.outputs = []
+        self.running = self.workers
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.counter = progress.counter(name) if counted else None
+        # Set by run, shared by all stages
+        self.stopped = threading.Event()
+        self.quota_error = None
+
+    def feeds(self, *stages):
+        self.outputs.extend(stages)
+        return self
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def close(self):
+        for _ in range(self.workers):
+            self.queue.put(DONE)
+
+    def work(self):
+        db = Session()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is DONE:
+                    return None
+                if self.stopped.is_set():
+                    continue
+
+                try:
+                    result = self.func(db, item)
+                except QuotaExceeded as e:
+                    db.rollback()
+                    self.quota_error = e
+                    self.stopped.set()
+                    continue
+                except Exception as e:
+                    db.rollback()
+                    print('{}: {}'.format(self.name, e))
+                    with self.lock:
+                        self.failed += 1
+                    if self.counter:
+                        self.counter.update(failed=1)
+                    continue
+
+                with self.lock:
+                    self.processed += 1
+                    if result is None and self.outputs:
+                        self.dropped += 1
+                if self.counter:
+                    self.counter.update(failed=1 if result is None and self.outputs else 0)
+
+                if result is not None:
+                    for stage in self.outputs:
+                        stage.put(result)
+        finally:
+            db.close()
+            with self.lock:
+                self.running -= 1
+                last = not self.running
+            if last:
+                for stage in self.outputs:
+                    stage.close()
+
+    def start(self):
+        threads = [threading.Thread(target=self.work, daemon=True) for _ in range(self.workers)]
+        for t in threads:
+            t.start()
+
+        return threads
+
+
+def run(items, stages):
+    '''
+    Start all <stages>, feed <items> to the first one and wait until every stage has drained.
+    Raises QuotaExceeded if a stage exceeded a quota
+    '''
+    stopped = threading.Event()
+    threads = []
+    for stage in stages:
+        stage.stopped = stopped
+        threads += stage.start()
+
+    for item in items:
+        if stopped.is_set():
+            break
+        stages[0].put(item)
+    stages[0].close()
+
+    for t in threads:
+        t.join()
+
+    for stage in stages:
+        if stage.quota_error:
+            raise stage.quota_error
+
+    return {stage.name: {'processed': stage.processed, 'failed': stage.failed, 'dropped': stage.dropped}
+            for stage in stages}
@@ -0,0 +1,105 @@
+import io
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import functools
+
+from sqlalchemy import event
+
+from constants import engine
+
+
+enabled = False
+profiler = None
+report_file = None
+
+# Calls and wall-clock seconds by stage, summed over all threads
+timers = {}
+timers_lock = threading.Lock()
+
+
+
+def start(path):
+    '''
+    Profile the main thread and time the stages of the run, reporting to <path> at exit
+    '''
+    global enabled, profiler, report_file
+    enabled = True
+    report_file = path
+    event.listen(engine, 'before_cursor_execute', before_execute)
+    event.listen(engine, 'after_cursor_execute', after_execute)
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+
+def record(stage, seconds):
+    with timers_lock:
+        calls, total = timers.get(stage, (0, 0.0))
+        timers[stage] = (calls + 1, total + seconds)
+
+
+@contextlib.contextmanager
+def timer(stage):
+    if not enabled:
+        yield
+        return
+
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        record(stage, time.monotonic() - started)
+
+
+def timed(stage):
+    '''
+    Time every call of the decorated function as <stage> while profiling
+    '''
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+
+def before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.monotonic())
+
+
+def after_execute(conn, cursor, statement, parameters, context, executemany):
+    record('Database', time.monotonic() - conn.info['query_started'].pop())
+
+
+def summary():
+    lines = ['{:<40} {:>8} {:>12} {:>12}'.format('Stage', 'Calls', 'Seconds', 'Per call')]
+    for stage, (calls, total) in sorted(timers.items(), key=lambda t: -t[1][1]):
+        lines.append('{:<40} {:>8} {:>12.3f} {:>12.4f}'.format(stage, calls, total, total / calls))
+
+    return '\n'.join(lines)
+
+
+def finish():
+    '''
+    Write the stage timers and the profile of the main thread, printing the timers
+    '''
+    if not enabled:
+        return None
+
+    profiler.disable()
+    stats = io.StringIO()
+    pstats.Stats(profiler, stream=stats).sort_stats('cumulative').print_stats(50)
+
+    table = summary()
+    with open(report_file, 'w') as f:
+        f.write('Stage timers (inclusive, summed over threads)\n\n')
+        f.write(table + '\n\n')
+        f.write(stats.getvalue())
+    profiler.dump_stats(report_file + '.pstats')
+
+    print(table)
+    print('Profile written to {}'.format(report_file))
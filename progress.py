@@ -0,0 +1,111 @@
+import sys
+import json
+import time
+import threading
+
+from tqdm import tqdm
+
+
+# 'bar' draws a progress bar per counter, 'quiet' prints a JSON summary per counter at exit
+mode = 'bar'
+output = sys.stdout
+
+counters = {}
+counters_lock = threading.Lock()
+
+
+
+class Counter(object):
+    '''
+    Files, bytes and failures of one stage or integration,
+    cheap enough to update from every upload and validation
+    '''
+    def __init__(self, name, total=0, unit='photo'):
+        self.name = name
+        self.total = total
+        self.unit = unit
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.bar = None
+        if mode == 'bar':
+            self.bar = tqdm(total=total or None, desc=name, unit=unit, dynamic_ncols=True)
+
+    def add_total(self, n):
+        with self.lock:
+            self.total += n
+            if self.bar:
+                self.bar.total = self.total
+                self.bar.refresh()
+
+    def update(self, n=1, nbytes=0, failed=0):
+        with self.lock:
+            self.done += n
+            self.bytes += nbytes
+            self.failed += failed
+            if self.bar:
+                postfix = {'failed': self.failed}
+                if self.bytes:
+                    postfix['MB/s'] = '{:.2f}'.format(self.bytes / 1000000 / self.elapsed())
+                self.bar.set_postfix(postfix, refresh=False)
+                self.bar.update(n)
+
+    def elapsed(self):
+        return max(time.monotonic() - self.started, 0.001)
+
+    def summary(self):
+        elapsed = self.elapsed()
+        rate = self.done / elapsed
+        remaining = max(self.total - self.done, 0)
+        return {
+            'name': self.name,
+            'unit': self.unit,
+            'total': self.total,
+            'done': self.done,
+            'failed': self.failed,
+            'bytes': self.bytes,
+            'seconds': round(elapsed, 3),
+            'per_sec': round(rate, 3),
+            'mb_per_sec': round(self.bytes / 1000000 / elapsed, 3),
+            'eta': round(remaining / rate, 1) if rate and remaining else 0
+        }
+
+    def close(self):
+        if self.bar:
+            self.bar.close()
+
+
+def counter(name, total=0, unit='photo'):
+    '''
+    Return the counter of <name>, adding <total> to the work it expects
+    '''
+    with counters_lock:
+        item = counters.get(name)
+        if not item:
+            counters[name] = Counter(name, total, unit)
+            return counters[name]
+
+    if total:
+        item.add_total(total)
+    return item
+
+
+def set_quiet():
+    '''
+    Report machine-readable summaries on stdout, moving other output to stderr
+    '''
+    global mode, output
+    mode = 'quiet'
+    output = sys.stdout
+    sys.stdout = sys.stderr
+
+
+def finish():
+    for item in counters.values():
+        item.close()
+        if mode == 'quiet':
+            output.write(json.dumps(item.summary()) + '\n')
+
+    output.flush()
@@ -0,0 +1,218 @@
+import time
+import heapq
+import datetime
+import itertools
+import threading
+
+from constants import ratelimit_config, bandwidth_config, session
+from models import QuotaUsage
+
+
+service_names = {
+    'gsv': 'Google Street View',
+    'otv': 'Open Trail View',
+    'explorer': 'Trek View Explorer',
+    'geocode': 'Google Geocoding'
+}
+
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        '''
+        Block until <amount> tokens are available and take them.
+        Amounts larger than the bucket go through once it is full and leave it in debt.
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                needed = min(amount, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return None
+                wait = (needed - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def take(self, amount):
+        '''
+        Take <amount> tokens right away, leaving the bucket in debt if needed
+        '''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate) - amount
+            self.updated = now
+
+
+class BandwidthScheduler(object):
+    '''
+    Share a global upload bandwidth cap between integrations.
+    Requests up to <metadata_bytes> never wait, their bytes are only accounted.
+    Larger ones wait their turn per <policy>: 'fair' shares the link by integration
+    weight, 'smallest' sends the smallest weighted payload first and 'tour' keeps
+    the order requests were made in
+    '''
+    def __init__(self, bytes_per_sec=None, weights=None, policy='fair', metadata_bytes=65536):
+        self.bucket = TokenBucket(bytes_per_sec) if bytes_per_sec else None
+        self.weights = weights or {}
+        self.policy = policy
+        self.metadata_bytes = metadata_bytes
+        self.waiting = []
+        self.sending = False
+        self.finish = {}
+        self.virtual_time = 0.0
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    def order(self, service, nbytes, seq):
+        weighted = nbytes / (self.weights.get(service) or 1)
+        if self.policy == 'smallest':
+            return weighted
+        if self.policy == 'tour':
+            return seq
+
+        start = max(self.virtual_time, self.finish.get(service, 0))
+        self.finish[service] = start + weighted
+        return self.finish[service]
+
+    def acquire(self, service, nbytes):
+        if not self.bucket or not nbytes:
+            return None
+
+        if nbytes <= self.metadata_bytes:
+            self.bucket.take(nbytes)
+            return None
+
+        with self.condition:
+            seq = next(self.sequence)
+            key = self.order(service, nbytes, seq)
+            heapq.heappush(self.waiting, (key, seq))
+            while self.sending or self.waiting[0][1] != seq:
+                self.condition.wait()
+            heapq.heappop(self.waiting)
+            self.sending = True
+            if self.policy == 'fair':
+                self.virtual_time = key
+
+        try:
+            self.bucket.acquire(nbytes)
+        finally:
+            with self.condition:
+                self.sending = False
+                self.condition.notify_all()
+
+
+scheduler = BandwidthScheduler(
+    bandwidth_config['bytes_per_sec'],
+    bandwidth_config['weights'],
+    bandwidth_config['policy'],
+    bandwidth_config['metadata_bytes']
+)
+
+
+class RateLimiter(object):
+    def __init__(self, service, requests_per_sec=None, bytes_per_sec=None, daily_quota=None, used_today=0):
+        self.service = service
+        self.name = service_names.get(service, service)
+        self.requests = TokenBucket(requests_per_sec) if requests_per_sec else None
+        self.bytes = TokenBucket(bytes_per_sec) if bytes_per_sec else None
+        self.daily_quota = daily_quota
+        self.day = datetime.date.today()
+        self.used_today = used_today
+        self.run_requests = 0
+        self.run_bytes = 0
+        self.throttled = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, nbytes=0):
+        '''
+        Account for one request of <nbytes>, waiting until the limits allow it
+        '''
+        with self.lock:
+            today = datetime.date.today()
+            if today != self.day:
+                self.day = today
+                self.used_today = 0
+
+            if self.daily_quota and self.used_today >= self.daily_quota:
+                raise QuotaExceeded('{}: Daily quota of {} requests used up'.format(self.name, int(self.daily_quota)))
+
+            self.used_today += 1
+            self.run_requests += 1
+            self.run_bytes += nbytes
+
+        started = time.monotonic()
+        if self.requests:
+            self.requests.acquire()
+        if self.bytes and nbytes:
+            self.bytes.acquire(nbytes)
+        scheduler.acquire(self.service, nbytes)
+
+        with self.lock:
+            self.throttled += time.monotonic() - started
+
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def get_limiter(service):
+    '''
+    Return the process-wide rate limiter of a service
+    '''
+    with limiters_lock:
+        limiter = limiters.get(service)
+        if not limiter:
+            limits = ratelimit_config.get(service, {})
+            usage = session.query(QuotaUsage).filter(QuotaUsage.service == service,
+                                                     QuotaUsage.day == datetime.date.today()).first()
+            limiter = RateLimiter(
+                service,
+                limits.get('requests_per_sec'),
+                limits.get('bytes_per_sec'),
+                limits.get('daily_quota'),
+                usage.requests if usage else 0
+            )
+            limiters[service] = limiter
+
+    return limiter
+
+
+def report_usage():
+    '''
+    Print quota consumption of this run and save the daily totals
+    '''
+    for service, limiter in limiters.items():
+        if not limiter.run_requests:
+            continue
+
+        usage = session.query(QuotaUsage).filter(QuotaUsage.service == service,
+                                                 QuotaUsage.day == limiter.day).first()
+        if not usage:
+            usage = QuotaUsage(service=service, day=limiter.day, requests=0, bytes=0)
+        usage.requests = limiter.used_today
+        usage.bytes = (usage.bytes or 0) + limiter.run_bytes
+        session.add(usage)
+
+        if limiter.daily_quota:
+            quota = '{}/{}'.format(limiter.used_today, int(limiter.daily_quota))
+        else:
+            quota = str(limiter.used_today)
+
+        print('{}: {} requests, {:.1f} MB this run, {} requests today, {:.1f}s throttled'.format(
+                limiter.name, limiter.run_requests, limiter.run_bytes / 1000000, quota, limiter.throttled))
+
+    session.commit()
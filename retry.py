@@ -0,0 +1,200 @@
+import os
+import time
+import random
+import datetime
+import email.utils
+
+import requests
+
+import metrics
+
+from constants import retry_config
+
+
+# Responses worth retrying when repeating the request is safe
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+# Responses meaning the request was rejected unprocessed, safe to retry for any request
+REJECTED_STATUSES = (429,)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+
+class RetryPolicy(object):
+    def __init__(self, max_attempts=None, deadline=None, base_delay=None, max_delay=None):
+        self.max_attempts = max_attempts or retry_config['max_attempts']
+        self.deadline = deadline or retry_config['deadline']
+        self.base_delay = base_delay or retry_config['base_delay']
+        self.max_delay = max_delay or retry_config['max_delay']
+
+    def backoff(self, attempt):
+        '''
+        Capped exponential backoff with full jitter
+        '''
+        cap = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(0, cap)
+
+    def allows(self, attempt, started, delay):
+        if attempt >= self.max_attempts:
+            return False
+
+        return time.monotonic() - started + delay <= self.deadline
+
+
+default_policy = RetryPolicy()
+
+
+def retry_after(response):
+    '''
+    Seconds to wait as requested by the Retry-After header, if any
+    '''
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        until = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    now = datetime.datetime.now(until.tzinfo)
+    return max((until - now).total_seconds(), 0)
+
+
+def is_retryable(error, idempotent):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return idempotent
+
+    # google.api_core errors carry the HTTP status as code
+    code = getattr(error, 'code', None)
+    if code in REJECTED_STATUSES:
+        return True
+
+    return idempotent and code in RETRY_STATUSES
+
+
+def rewind(files):
+    if not files:
+        return None
+
+    for value in files.values():
+        if isinstance(value, tuple):
+            value = value[1]
+        if hasattr(value, 'seek'):
+            value.seek(0)
+
+
+def payload_size(kwargs):
+    size = 0
+    data = kwargs.get('data')
+    if isinstance(data, (bytes, str)):
+        size += len(data)
+
+    files = kwargs.get('files') or {}
+    for value in files.values():
+        if isinstance(value, tuple):
+            value = value[1]
+        if hasattr(value, 'fileno'):
+            size += os.fstat(value.fileno()).st_size
+
+    return size
+
+
+def send(http, method, url, idempotent=None, policy=None, limiter=None, **kwargs):
+    '''
+    Send an HTTP request through <http> (a requests session or the requests module),
+    retrying connection errors, 429 and 5xx responses per <policy>.
+    Non-idempotent requests are only retried when they cannot have been processed.
+    Every attempt is accounted to the service <limiter>.
+    '''
+    policy = policy or default_policy
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+
+    started = time.monotonic()
+    attempt = 0
+    service = limiter.service if limiter else 'none'
+    path = metrics.endpoint(url)
+
+    while True:
+        rewind(kwargs.get('files'))
+        response = None
+        error = None
+        size = payload_size(kwargs)
+        if limiter:
+            limiter.acquire(size)
+
+        sent = time.monotonic()
+        try:
+            response = http.request(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            metrics.inc('tourer_http_requests_total', service=service, method=method, endpoint=path, status=type(e).__name__)
+            if not is_retryable(e, idempotent):
+                raise
+            error = e
+            reason = type(e).__name__
+            delay = policy.backoff(attempt)
+        else:
+            metrics.observe('tourer_http_request_seconds', time.monotonic() - sent, service=service, endpoint=path)
+            metrics.inc('tourer_http_requests_total', service=service, method=method, endpoint=path, status=response.status_code)
+            metrics.inc('tourer_uploaded_bytes_total', size, service=service)
+            status = response.status_code
+            if status in REJECTED_STATUSES or (idempotent and status in RETRY_STATUSES):
+                reason = 'HTTP {}'.format(status)
+                delay = retry_after(response)
+                if delay is None:
+                    delay = policy.backoff(attempt)
+            else:
+                return response
+
+        attempt += 1
+        if not policy.allows(attempt, started, delay):
+            if error:
+                raise error
+            return response
+
+        metrics.inc('tourer_http_retries_total', service=service, reason=reason)
+        print('Network error ({}), waiting for {:.1f} seconds before next attempt'.format(reason, delay))
+        time.sleep(delay)
+
+
+def call(func, *args, idempotent=True, policy=None, limiter=None, **kwargs):
+    '''
+    Call an API client method, retrying transient errors per <policy>
+    '''
+    policy = policy or default_policy
+    started = time.monotonic()
+    attempt = 0
+    service = limiter.service if limiter else 'none'
+    path = getattr(func, '__name__', 'call')
+
+    while True:
+        if limiter:
+            limiter.acquire()
+        sent = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            metrics.inc('tourer_http_requests_total', service=service, method='RPC', endpoint=path, status=type(e).__name__)
+            if not is_retryable(e, idempotent):
+                raise
+
+            delay = policy.backoff(attempt)
+            attempt += 1
+            if not policy.allows(attempt, started, delay):
+                raise
+
+            metrics.inc('tourer_http_retries_total', service=service, reason=type(e).__name__)
+            print('Network error ({}), waiting for {:.1f} seconds before next attempt'.format(type(e).__name__, delay))
+            time.sleep(delay)
+        else:
+            metrics.observe('tourer_http_request_seconds', time.monotonic() - sent, service=service, endpoint=path)
+            metrics.inc('tourer_http_requests_total', service=service, method='RPC', endpoint=path, status='OK')
+            return result
@@ -3,11 +3,16 @@ import sys
 
 import click
 
+import metrics
+import progress
+import profiling
+
 from models import Tour, Photo
 from utils import (
                     sync_push,
                     sync_pull,
                     initdb,
+                    upgradedb,
                     integrations_status,
                     create_tour,
                     delete_tour,
@@ -16,29 +21,73 @@ from utils import (
                     list_tours,
                     list_photos,
                     delete_photo,
-                    validate_string,
                     validate_files,
-                    get_tour_transport,
-                    get_integrations,
                     get_options,
                     get_fields,
-                    get_tags,
                     fetchgsv,
+                    sync_gsv_pose,
                     add_integration,
-                    remove_integration
+                    remove_integration,
+                    get_client,
+                    set_assume_yes,
+                    load_manifest,
+                    tour_options,
+                    tour_fields,
+                    split_list,
+                    import_tree,
+                    list_files,
+                    read_files,
+                    split_tour,
+                    decimate,
+                    create_tours
                 )
-from constants import db_file, session 
+from constants import db_file, session, sync_config, tracks_config
+from jobs import enqueue, run_worker, queue_status
+from ratelimit import QuotaExceeded, report_usage
+from autotune import save_tuning
+
 
+# updatetour options and the fields that choose them when given as flags or in a manifest
+UPDATE_OPTIONS = [
+    ('edit_tour', ('description', 'tags', 'transport')),
+    ('add_photos', ('add_photos',)),
+    ('delete_photo', ('delete_photos',)),
+    ('add_integration', ('add_integrations',)),
+    ('remove_integration', ('remove_integrations',)),
+    ('delete_tour', ('delete_tour',))
+]
 
 
 @click.group()
-def cli():
+@click.option('--quiet', '-q', is_flag=True, help='Print a JSON progress summary per stage on stdout, other output on stderr')
+@click.option('--profile', type=click.Path(dir_okay=False), help='Write stage timers and a cProfile report to this file')
+@click.option('--metrics-textfile', type=click.Path(dir_okay=False), help='Write run metrics for the Prometheus textfile collector')
+@click.option('--metrics-json', type=click.Path(dir_okay=False), help='Write run metrics as a JSON summary')
+@click.option('--yes', '-y', is_flag=True, help='Answer yes to confirmations, such as the Google Street View terms')
+@click.pass_context
+def cli(ctx, quiet, profile, metrics_textfile, metrics_json, yes):
+    if quiet:
+        progress.set_quiet()
+    if yes:
+        set_assume_yes()
+    if profile:
+        profiling.start(profile)
+
     try:
         if not os.path.isfile(db_file):
             initdb()
+        else:
+            upgradedb()
     except:
         sys.exit()
 
+    metrics.command = ctx.invoked_subcommand
+    ctx.call_on_close(lambda: metrics.export(metrics_textfile, metrics_json))
+    ctx.call_on_close(report_usage)
+    ctx.call_on_close(save_tuning)
+    ctx.call_on_close(progress.finish)
+    ctx.call_on_close(profiling.finish)
+
 
 @cli.command()
 def listtours():
@@ -69,77 +118,154 @@ def status():
 
 @cli.command()
 @click.argument('tour_id')
-def updatetour(tour_id):
+@click.option('--description', help='New tour description')
+@click.option('--tags', help='New comma-separated tour tags')
+@click.option('--transport', help='New tour type as <type>-<transport>, e.g. Land-Hike, or its ID')
+@click.option('--add-photos', type=click.Path(exists=True), help='Add the photos at this path')
+@click.option('--delete-photo', 'delete_photos', multiple=True, help='Delete the photo with this ID, can be repeated')
+@click.option('--add-integration', 'add_integrations', multiple=True, help='Upload the tour to this integration: gsv, otv or explorer')
+@click.option('--remove-integration', 'remove_integrations', multiple=True, help='Delete the tour from this integration')
+@click.option('--delete-tour', 'delete', is_flag=True, help='Delete the entire tour')
+@click.option('--manifest', type=click.Path(exists=True, dir_okay=False), help='YAML or JSON file with the fields above')
+@click.option('--queue', is_flag=True, help='Queue uploads for tourer worker instead of uploading now')
+def updatetour(tour_id, description, tags, transport, add_photos, delete_photos, add_integrations,
+               remove_integrations, delete, manifest, queue):
     '''
-    Edit name, description, tags and type or add/delete photos of a given <tour_id>
+    Edit name, description, tags and type or add/delete photos of a given <tour_id>.
+    Prompts for what to do unless it is given by options or a manifest
     '''
     tour = session.query(Tour).filter(Tour.tour_id == tour_id).first()
     if not tour:
         print('There is no tour with ID {}'.format(tour_id))
+        return None
+
+    manifest = load_manifest(manifest) if manifest else {}
+    if manifest is None:
+        return None
+
+    fields = tour_options(manifest, description=description, tags=tags, transport=transport, add_photos=add_photos,
+                          delete_photos=delete_photos, add_integrations=add_integrations,
+                          remove_integrations=remove_integrations, delete_tour=delete)
+    if fields:
+        options = [option for option, keys in UPDATE_OPTIONS if any(k in fields for k in keys)]
     else:
         options = get_options()
 
-        if 'edit_tour' in options:
-            list_tours([tour])
-            edit_tour(tour)
-        
-        if 'add_photos' in options:
-            list_photos(tour_id)
-            path = click.prompt('Enter photos path')
+    if 'edit_tour' in options:
+        list_tours([tour])
+        edit_tour(tour, fields or None)
+    
+    if 'add_photos' in options:
+        list_photos(tour_id)
+        path = fields.get('add_photos') or click.prompt('Enter photos path')
+        if queue:
             validated_files = validate_files(path)
             if validated_files:
-                update_tour(tour, validated_files)
+                update_tour(tour, validated_files, queue)
+        else:
+            update_tour(tour, None, path=path)
 
-        if 'delete_photo' in options:
-            list_photos(tour_id)
-            delete_photo(tour)
-        
-        if 'add_integration' in options:
-            add_integration(tour)
+    if 'delete_photo' in options:
+        list_photos(tour_id)
+        for photo_id in split_list(fields.get('delete_photos')) or [None]:
+            delete_photo(tour, photo_id)
+    
+    if 'add_integration' in options:
+        for integration in split_list(fields.get('add_integrations')) or [None]:
+            add_integration(tour, integration)
 
-        if 'remove_integration' in options:
-            remove_integration(tour)
+    if 'remove_integration' in options:
+        for integration in split_list(fields.get('remove_integrations')) or [None]:
+            remove_integration(tour, integration)
 
-        if 'delete_tour' in options:
-            delete_tour(tour)
+    if 'delete_tour' in options:
+        delete_tour(tour)
 
 
 @cli.command()
 @click.argument('path')
-def createtour(path):
+@click.option('--name', help='Tour name')
+@click.option('--description', help='Tour description')
+@click.option('--tags', help='Comma-separated tour tags')
+@click.option('--transport', help='Tour type as <type>-<transport>, e.g. Land-Hike, or its ID')
+@click.option('--integrations', help='Comma-separated integrations to upload to: gsv, otv, explorer. Empty for none')
+@click.option('--split', is_flag=True, help='Split the photos into several tours at time gaps and distance jumps')
+@click.option('--max-gap', type=float, help='Seconds between photos that start a new tour when splitting')
+@click.option('--max-jump', type=float, help='Meters between photos that start a new tour when splitting')
+@click.option('--spacing', type=float, help='Keep one photo per this many meters along the track, 0 keeps all')
+@click.option('--manifest', type=click.Path(exists=True, dir_okay=False), help='YAML or JSON file with the fields above')
+@click.option('--queue', is_flag=True, help='Queue uploads for tourer worker instead of uploading now')
+def createtour(path, name, description, tags, transport, integrations, split, max_gap, max_jump, spacing, manifest, queue):
     '''
-    Create new tour from photos located at <path>
+    Create new tour from photos located at <path>, or several numbered tours with --split.
+    Prompts for the fields not given by options or a manifest
     '''
-    validated_files = validate_files(path)
-    name = validate_string('Tour name', click.prompt('Please enter a new tour name', type=str), 300)
-    tour = session.query(Tour).filter(Tour.name == name).first()
-    if tour:
-        print('Tour {} already exists'.format(name))
+    manifest = load_manifest(manifest) if manifest else {}
+    if manifest is None:
         return None
 
-    description = validate_string('Tour description', click.prompt('Please enter tour description', type=str), 500)
-    transport = get_tour_transport()
-    tags = get_tags()
-
-    if 'manual' in tags:
-        tags = ','.join(tags[:-1])
-        manual_tags = validate_string('Tour tags', click.prompt('Please enter tour tags, comma-separated', type=str), 500)
-        tags += ',' + manual_tags
+    if queue:
+        validated_files = validate_files(path)
+    elif os.path.exists(path):
+        validated_files = None
     else:
-        tags = ','.join(tags)
+        print('Invalid path {}'.format(path))
+        return None
 
-    status = False
-    intg_status = integrations_status(status)
-    if intg_status:
-        integrations = get_integrations()
+    options = tour_options(manifest, name=name, description=description, tags=tags, transport=transport,
+                           integrations=integrations, split=split, max_gap=max_gap, max_jump=max_jump,
+                           spacing=spacing)
+    fields = tour_fields(options)
+    if not fields:
+        return None
+
+    spacing = options.get('spacing', tracks_config['spacing'])
+    if options.get('split') or spacing:
+        if not queue:
+            validated_files = read_files(list_files(path))
+        if validated_files:
+            if options.get('split'):
+                segments = split_tour(validated_files, options.get('max_gap'), options.get('max_jump'))
+            else:
+                segments = [validated_files]
+            segments = [decimate(segment, spacing) for segment in segments]
+            create_tours(segments, fields['integrations'], fields['name'], fields['description'], fields['tags'],
+                         fields['transport'], queue)
+        return None
+
+    if queue:
+        create_tour(validated_files, fields['integrations'], fields['name'], fields['description'], fields['tags'],
+                    fields['transport'], queue)
     else:
-        integrations = []
+        create_tour(None, fields['integrations'], fields['name'], fields['description'], fields['tags'],
+                    fields['transport'], path=path)
 
-    create_tour(validated_files, integrations, name, description, tags, transport)              
+
+@cli.command()
+@click.argument('root', type=click.Path(exists=True, file_okay=False))
+@click.option('--description', help='Description of every tour, the tour name by default')
+@click.option('--tags', help='Comma-separated tags of every tour')
+@click.option('--transport', help='Tour type of every tour as <type>-<transport>, e.g. Land-Hike, or its ID')
+@click.option('--integrations', help='Comma-separated integrations to upload to: gsv, otv, explorer. Empty for none')
+@click.option('--spacing', type=float, help='Keep one photo per this many meters along the track, 0 keeps all')
+@click.option('--manifest', type=click.Path(exists=True, dir_okay=False),
+              help='YAML or JSON file with the fields above and a list of tours with their path under <root>')
+def importtree(root, description, tags, transport, integrations, spacing, manifest):
+    '''
+    Create a tour from every directory of photos under <root>, named after its path,
+    or from every tour listed in a manifest. Run it again to resume an interrupted import
+    '''
+    manifest = load_manifest(manifest) if manifest else {}
+    if manifest is None:
+        return None
+
+    import_tree(root, manifest, description=description, tags=tags, transport=transport, integrations=integrations,
+                spacing=spacing)
 
 
 @cli.command()
-def forcesync():
+@click.option('--queue', is_flag=True, help='Queue the sync for tourer worker instead of syncing now')
+def forcesync(queue):
     '''
     Pull data from modules that support pull (GET) actions
     and push data to modules that support push (PUT) actions.
@@ -147,6 +273,13 @@ def forcesync():
     status = False
     intg_status = integrations_status(status)
 
+    if queue:
+        if ('Google Street View', 'gsv') in intg_status:
+            enqueue('fetch', {}, key='fetch')
+        sync_push(intg_status, queue)
+        print('Sync queued: {}'.format(queue_summary()))
+        return None
+
     if ('Google Street View', 'gsv') in intg_status:
         print('Fetching Google Street View photo data')
         fetchgsv()
@@ -156,7 +289,37 @@ def forcesync():
         sync_push(intg_status)
     else:
         print('No integrations configured')
+
+    if ('Google Street View', 'gsv') in intg_status:
+        print('Pushing pose and connections to Google Street View')
+        sync_gsv_pose()
     
 
+def queue_summary():
+    return ', '.join('{} {}'.format(count, state) for state, count in queue_status().items())
+
+
+@cli.command()
+@click.option('--workers', '-n', default=sync_config['workers'], help='Number of concurrent workers')
+@click.option('--lease', default=1800, help='Seconds a job may run before other workers take it over')
+@click.option('--follow', is_flag=True, help='Keep waiting for new jobs instead of exiting when the queue is empty')
+def worker(workers, lease, follow):
+    '''
+    Run queued upload, move, geocode, fetch and delete jobs
+    '''
+    status = False
+    for name, short_name in integrations_status(status):
+        get_client(short_name)
+
+    print('Queue: {}'.format(queue_summary()))
+    results = run_worker(workers, lease, follow)
+    print('{} jobs done, {} failed'.format(results['done'], results['failed']))
+    print('Queue: {}'.format(queue_summary()))
+
+
 if __name__ == '__main__':
-    cli()
+    try:
+        cli()
+    except QuotaExceeded as e:
+        print(e)
+        sys.exit(1)
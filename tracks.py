@@ -0,0 +1,65 @@
+from math import radians, cos, sin, asin, sqrt
+
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    '''
+    Calculate the great circle distance between two points
+    on the earth (specified in decimal degrees)
+    '''
+    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    c = 2 * asin(sqrt(a))
+    r = 6371
+
+    distance = (c * r) * 1000
+
+    return distance
+
+
+def segment(items, point, max_gap=None, max_jump=None):
+    '''
+    Sort <items> by time and split them wherever consecutive ones were taken more than
+    <max_gap> seconds or <max_jump> meters apart. <point> returns the (time, lat, lon) of an item.
+    One pass over the sorted points, so it scales with the number of items
+    '''
+    points = [point(item) for item in items]
+    order = sorted(range(len(items)), key=lambda i: points[i][0])
+    segments = []
+    previous = None
+
+    for i in order:
+        taken, lat, lon = points[i]
+        if previous is None:
+            split = True
+        else:
+            split = bool(max_gap) and (taken - previous[0]).total_seconds() > max_gap
+            split = split or bool(max_jump) and haversine(previous[2], previous[1], lon, lat) > max_jump
+
+        if split:
+            segments.append([])
+        segments[-1].append(items[i])
+        previous = points[i]
+
+    return segments
+
+
+def decimate(items, point, spacing):
+    '''
+    Sort <items> by time and keep those taken at least <spacing> meters from the last one kept,
+    dropping the frames shot while standing still
+    '''
+    points = [point(item) for item in items]
+    order = sorted(range(len(items)), key=lambda i: points[i][0])
+    kept = []
+    last = None
+
+    for i in order:
+        taken, lat, lon = points[i]
+        if last is None or haversine(last[2], last[1], lon, lat) >= spacing:
+            kept.append(items[i])
+            last = points[i]
+
+    return kept
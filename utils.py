@@ -2,11 +2,16 @@ import os
 import sys
 import json
 import uuid
+import hashlib
 import math
+import threading
+import itertools
+import collections
 
-from datetime import datetime
-from math import radians, cos, sin, asin, sqrt
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
+import yaml
 import click
 import inquirer
 import requests
@@ -15,16 +20,28 @@ import reverse_geocode
 
 from PIL import Image, ExifTags
 from GPSPhoto import gpsphoto
-from sqlalchemy import asc
+from sqlalchemy import asc, and_, or_, inspect, text
 
 from constants import *
-from models import Base, TourType, TransportType, Tour, Photo, TourTransport
+from models import Base, TourType, TransportType, Tour, Photo, TourTransport, PhotoSync, SyncStatus, ListingCache, SkippedFile
+from tracks import haversine
 
 import openlocationcode as olc
+import jobs
+import tracks
+import retry
+import metrics
+import profiling
+import progress
+import autotune
+import pipeline
+import ratelimit
 
 
 intg_modules = []
 init = True
+# Take every confirmation as answered yes, set by tourer --yes
+assume_yes = False
 
 try:
     from modules.googlestreetview import GoogleStreetView
@@ -48,6 +65,30 @@ try:
 except:
     pass
 
+clients = {}
+clients_lock = threading.Lock()
+
+# Geocoding results by rounded coordinates, shared by all threads of the run
+geocode_cache = {}
+geocode_lock = threading.Lock()
+
+
+def get_client(short_name):
+    '''
+    Return the authenticated client of an integration, created once per process
+    '''
+    with clients_lock:
+        client = clients.get(short_name)
+        if not client:
+            if short_name == 'gsv':
+                client = GoogleStreetView()
+            elif short_name == 'otv':
+                client = OpenTrailView()
+            elif short_name == 'explorer':
+                client = Explorer()
+            clients[short_name] = client
+
+    return client
 
 
 def initdb():
@@ -102,6 +143,81 @@ def initdb():
     print('Database created')
 
 
+def upgradedb():
+    '''
+    Create the tables and columns added since the database was initialized
+    '''
+    inspector = inspect(engine)
+    ledger_exists = 'photo_sync' in inspector.get_table_names()
+    Base.metadata.create_all(engine, checkfirst=True)
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = [c['name'] for c in inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(engine.dialect)
+                with engine.begin() as conn:
+                    conn.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(table.name, column.name, column_type)))
+
+    if not ledger_exists:
+        backfill_sync_ledger()
+
+
+def backfill_sync_ledger():
+    '''
+    Seed the sync ledger from the remote IDs of photos created before it existed
+    '''
+    remote_ids = {
+        'gsv': 'street_view_photoid',
+        'otv': 'otv_pano_id',
+        'explorer': 'explorer_photo_id'
+    }
+
+    for tour in session.query(Tour).filter(Tour.integrations != None, Tour.integrations != ''):
+        for integration in tour.integrations.split(','):
+            if integration not in remote_ids:
+                continue
+            if integration == 'explorer' and not tour.explorer_tour_id:
+                continue
+
+            for photo in tour.photos:
+                if getattr(photo, remote_ids[integration]):
+                    state = SyncStatus.Uploaded
+                else:
+                    state = SyncStatus.Pending
+                session.add(PhotoSync(photo_id=photo.photo_id, integration=integration, state=state, attempts=0))
+
+    session.commit()
+
+
+def set_assume_yes():
+    global assume_yes
+    assume_yes = True
+
+
+def ask_confirm(message, abort=False):
+    '''
+    Ask for confirmation, or take it as given with --yes
+    '''
+    if assume_yes:
+        print('{} [y/N]: y'.format(message))
+        return True
+
+    return click.confirm(message, abort=abort)
+
+
+def check_string(what, value, maxlen):
+    '''
+    Return <value> if it fits in <maxlen> characters, for values that can not be prompted again
+    '''
+    value = str(value)
+    if len(value) > maxlen:
+        print('{} too long, should be no more than {} characters'.format(what, maxlen))
+        return None
+
+    return value
+
+
 def validate_string(what, value, maxlen):
     if len(value) <= maxlen:
         return value
@@ -131,23 +247,6 @@ def calculate_initial_compass_bearing(pointA, pointB):
     return compass_bearing
 
 
-def haversine(lon1, lat1, lon2, lat2):
-    '''
-    Calculate the great circle distance between two points 
-    on the earth (specified in decimal degrees)
-    '''
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-    dlon = lon2 - lon1 
-    dlat = lat2 - lat1 
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a)) 
-    r = 6371
-
-    distance = (c * r) * 1000
-
-    return distance
-
-
 def find_connection(photo_1, photo_2):
     lat1 = float(photo_1.lat)
     lon1 = float(photo_1.lon)
@@ -177,7 +276,27 @@ def find_connection(photo_1, photo_2):
     return connection
 
 
-def validate_file(path):
+def fingerprint(data):
+    '''
+    Content hash of an outgoing payload, used to skip unchanged records
+    '''
+    payload = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def load_connections(photo):
+    try:
+        return json.loads(photo.connections) if photo.connections else []
+    except ValueError:
+        return []
+
+
+@profiling.timed('Validation')
+def validate_file(path, confirm=True):
+    '''
+    Read the metadata of a photo. Invalid photos are ignored after asking to continue,
+    or right away without <confirm>
+    '''
     is_file_valid = True
     errorcase = []
     _, fext = os.path.splitext(path)
@@ -198,7 +317,11 @@ def validate_file(path):
         try:
             gpsinfo = gpsphoto.getGPSData(path)
         except:
-            click.confirm('{} will be ignored. Do you want to continue?'.format(path), abort=True)
+            metrics.inc('tourer_validation_rejects_total', reason='The photo GPS data can not be read')
+            if confirm:
+                ask_confirm('{} will be ignored. Do you want to continue?'.format(path), abort=True)
+            else:
+                print('{} has no readable GPS data and will be ignored'.format(path))
             return None
         
         if len(gpsinfo) > 0:
@@ -249,8 +372,14 @@ def validate_file(path):
     if is_file_valid:
         return {'fname': path, 'meta': exif_data, 'timestamp': timestamp, 'gpsdata': gpsinfo}
     else:
+        for reason in errorcase:
+            if not reason.startswith('Warning'):
+                metrics.inc('tourer_validation_rejects_total', reason=reason)
         errorcase = '\n'.join(errorcase)
-        click.confirm('{}. \n{} will be ignored. Do you want to continue?'.format(errorcase, path), abort=True)
+        if confirm:
+            ask_confirm('{}. \n{} will be ignored. Do you want to continue?'.format(errorcase, path), abort=True)
+        else:
+            print('{}. \n{} will be ignored'.format(errorcase, path))
 
 
 def get_tour_transport():
@@ -454,53 +583,198 @@ def integrations_status(status):
     return av_modules
         
 
-def edit_tour(tour):
-    print('Select the fields to edit:')
-    fields = get_fields()
+def load_manifest(path):
+    '''
+    Tour fields from a YAML or JSON manifest, returns None if it can not be read
+    '''
+    try:
+        with open(path, 'r') as f:
+            if path.lower().endswith(('.yaml', '.yml')):
+                manifest = yaml.safe_load(f)
+            else:
+                manifest = json.load(f)
+    except Exception as e:
+        print('Failed to read manifest {}: {}'.format(path, e))
+        return None
+
+    if not isinstance(manifest, dict):
+        print('Manifest {} should map tour fields to values'.format(path))
+        return None
+
+    return manifest
+
+
+def tour_options(manifest=None, **options):
+    '''
+    Fields of <manifest> overridden by the command line <options> that were given
+    '''
+    fields = dict(manifest or {})
+    fields.update({k: v for k, v in options.items() if v is not None and v != () and v is not False})
+    return fields
+
+
+def split_list(value):
+    if isinstance(value, str):
+        return [v.strip() for v in value.split(',') if v.strip()]
+
+    return [str(v).strip() for v in value or []]
+
 
-    if 'description' in fields:
-        print('Description: ' + tour.description)
-        descr = validate_string('Tour description', click.prompt('Please enter new description', type=str), 200)
-        tour.description = descr
+def find_transport(value):
+    '''
+    Tour transport by ID or as <type>-<transport>, e.g. Land-Hike
+    '''
+    transports = session.query(TourTransport).all()
+    if str(value).isdigit():
+        found = [t for t in transports if t.transp_id == int(value)]
     else:
-        descr = tour.description
-
-    if 'tags' in fields:
-        print('Tags: ' +  tour.tags)
-        tags = get_tags()
-        if 'manual' in tags:
-            tags = ','.join(tags[:-1])
-            manual_tags = validate_string('Tour tags', click.prompt('Please enter new tags, comma-separated', type=str), 500)
-            tags += ',' + manual_tags
-        else:
-            tags = ','.join(tags)
+        tour_type, _, tour_transport = str(value).replace(' ', '-').partition('-')
+        found = [t for t in transports if t.tour_type.name.lower() == tour_type.lower()
+                 and t.tour_transport.name.lower() == tour_transport.lower()]
 
-        tour.tags = tags
+    if not found:
+        print('There is no tour type {}, choose one of: {}'.format(
+            value, ', '.join('{}-{}'.format(t.tour_type.name, t.tour_transport.name) for t in transports)))
+        return None
+
+    return found[0]
+
+
+def find_integrations(value):
+    '''
+    Short names of active integrations, None if any of them is unknown or not configured
+    '''
+    active = [x[1] for x in integrations_status(False)]
+    integrations = split_list(value)
+    unknown = [i for i in integrations if i not in active]
+    if unknown:
+        print('Integrations not configured: {}. Active integrations: {}'.format(', '.join(unknown), ', '.join(active) or 'none'))
+        return None
+
+    return integrations
+
+
+def prompt_tags(message):
+    tags = get_tags()
+    if 'manual' in tags:
+        tags = ','.join(tags[:-1])
+        manual_tags = validate_string('Tour tags', click.prompt(message, type=str), 500)
+        tags += ',' + manual_tags
+    else:
+        tags = ','.join(tags)
+
+    return tags
+
+
+def tour_fields(fields):
+    '''
+    Name, description, tags, transport and integrations of a new tour taken from <fields>,
+    prompting for those missing. Returns None if a given value is invalid
+    '''
+    if fields.get('name') is not None:
+        name = check_string('Tour name', fields['name'], 300)
     else:
-        tags = tour.tags
+        name = validate_string('Tour name', click.prompt('Please enter a new tour name', type=str), 300)
+    if name is None:
+        return None
+
+    if session.query(Tour).filter(Tour.name == name).first():
+        print('Tour {} already exists'.format(name))
+        return None
+
+    if fields.get('description') is not None:
+        description = check_string('Tour description', fields['description'], 500)
+    else:
+        description = validate_string('Tour description', click.prompt('Please enter tour description', type=str), 500)
+    if description is None:
+        return None
 
-    if 'type' in fields:
-        tour_type = tour.transport.tour_type.name
-        transport_type = tour.transport.tour_transport.name
-        print('Tour type: {}  Tour transport: {}'.format(tour_type, transport_type))
+    if fields.get('transport') is not None:
+        transport = find_transport(fields['transport'])
+    else:
         transport = get_tour_transport()
-        tour.transport = transport
+    if not transport:
+        return None
+
+    if fields.get('tags') is not None:
+        tags = check_string('Tour tags', ','.join(split_list(fields['tags'])), 500)
     else:
-        transport = tour.transport
+        tags = prompt_tags('Please enter tour tags, comma-separated')
+    if tags is None:
+        return None
 
-    integrations = tour.integrations.split(',')
+    if 'integrations' in fields:
+        integrations = find_integrations(fields['integrations'])
+    elif integrations_status(False):
+        integrations = get_integrations()
+    else:
+        integrations = []
+    if integrations is None:
+        return None
+
+    return {
+        'name': name,
+        'description': description,
+        'tags': tags,
+        'transport': transport,
+        'integrations': integrations
+    }
+
+
+def edit_tour(tour, fields=None):
+    '''
+    Change description, tags and type of <tour> to the given <fields>, or to those prompted for
+    '''
+    if fields is None:
+        print('Select the fields to edit:')
+        edit = get_fields()
+        fields = {}
+
+        if 'description' in edit:
+            print('Description: ' + tour.description)
+            fields['description'] = validate_string('Tour description', click.prompt('Please enter new description', type=str), 200)
+
+        if 'tags' in edit:
+            print('Tags: ' +  tour.tags)
+            fields['tags'] = prompt_tags('Please enter new tags, comma-separated')
+
+        if 'type' in edit:
+            tour_type = tour.transport.tour_type.name
+            transport_type = tour.transport.tour_transport.name
+            print('Tour type: {}  Tour transport: {}'.format(tour_type, transport_type))
+            fields['transport'] = get_tour_transport()
+
+    if fields.get('description') is not None:
+        description = check_string('Tour description', fields['description'], 200)
+        if description is None:
+            return None
+        tour.description = description
+
+    if fields.get('tags') is not None:
+        tags = check_string('Tour tags', ','.join(split_list(fields['tags'])), 500)
+        if tags is None:
+            return None
+        tour.tags = tags
+
+    if fields.get('transport') is not None:
+        transport = fields['transport']
+        if not isinstance(transport, TourTransport):
+            transport = find_transport(transport)
+        if not transport:
+            return None
+        tour.transport = transport
+
+    integrations = tour.integrations.split(',') if tour.integrations else []
 
     if 'explorer' in integrations:
-        explorer = Explorer()
-        tour_type = transport.tour_type.name.lower()
-        transport_type = transport.tour_transport.name.lower()
-        tags = tour.tags.replace(',', ', ')
-        explorer.update_tour(tour.explorer_tour_id, tour.tour_id, descr, tags, tour_type, transport_type, None)
+        explorer = get_client('explorer')
+        push_explorer_tour(explorer, tour)
         
     session.add(tour)
     session.commit()
 
 
+@profiling.timed('Connections')
 def set_tour_connections(tour):
     sorted_photos = session.query(Photo).filter(Photo.tour_id == tour.tour_id).order_by(asc(Photo.taken)).all()
     previous_photo = None
@@ -545,13 +819,21 @@ def set_tour_connections(tour):
         session.add(x)
         session.commit()
 
+    enqueue_explorer_changes([x.photo_id for x in sorted_photos])
+
+
+def update_connections(photos, db=None):
+    db = db or session
+    photo_ids = [x['tourer[photo_id]'] for x in photos]
+    local_photos = {}
+    for i in range(0, len(photo_ids), 500):
+        for photo in db.query(Photo).filter(Photo.photo_id.in_(photo_ids[i:i + 500])):
+            local_photos[photo.photo_id] = photo
 
-def update_connections(photos):
     for x in photos:
-        photo_id = x['tourer[photo_id]']
-        photo = session.query(Photo).filter(Photo.photo_id == photo_id).first()
+        photo = local_photos[x['tourer[photo_id]']]
         x['tourer[heading_degrees]'] = photo.photo_heading
-        connections = json.loads(photo.connections)
+        connections = load_connections(photo)
         for i, y in enumerate(connections):
             con = {
                 'tourer[connections][{}][photo_id]'.format(i): y['photo_id'],
@@ -564,8 +846,351 @@ def update_connections(photos):
             x.update(con)
 
 
-def upload_photos(tour, validated_files, integrations, mode='basic'):
-    photos = []
+def explorer_fingerprint(photo_data):
+    return fingerprint({k: v for k, v in photo_data.items() if k not in ('explorer_photo_id', 'tourer[version]')})
+
+
+def push_explorer_tour(explorer, tour):
+    '''
+    Update the tour fields on Explorer if they changed since the last push
+    '''
+    tags = tour.tags.replace(',', ', ')
+    tour_type = tour.transport.tour_type.name.lower()
+    transport_type = tour.transport.tour_transport.name.lower()
+    fields = [tour.tour_id, tour.description, tags, tour_type, transport_type]
+
+    tour_fingerprint = fingerprint(fields)
+    if tour_fingerprint == tour.explorer_fingerprint:
+        return None
+
+    if explorer.update_tour(tour.explorer_tour_id, *fields):
+        tour.explorer_fingerprint = tour_fingerprint
+
+
+def save_explorer_photo_ids(explorer_photo_ids, fingerprints=None, db=None):
+    '''
+    Write explorer photo IDs, keyed by tourer photo ID, back in one transaction
+    along with the fingerprints of the payloads that were pushed
+    '''
+    db = db or session
+    if not explorer_photo_ids:
+        return None
+
+    photo_ids = list(explorer_photo_ids.keys())
+    updates = []
+    for i in range(0, len(photo_ids), 500):
+        photos = db.query(Photo.id, Photo.photo_id).filter(Photo.photo_id.in_(photo_ids[i:i + 500])).all()
+        for p in photos:
+            update = {'id': p.id, 'explorer_photo_id': explorer_photo_ids[p.photo_id]}
+            if fingerprints:
+                update['explorer_fingerprint'] = fingerprints.get(p.photo_id)
+            updates.append(update)
+
+    db.bulk_update_mappings(Photo, updates)
+    db.commit()
+
+
+def photo_file(photo):
+    return {
+        'timestamp': photo.taken,
+        'fname': photo.fullpath,
+        'place_id': photo.place_id,
+        'gpsdata': {
+            'Latitude': photo.lat,
+            'Longitude': photo.lon,
+            'Altitude': photo.elevation
+        }
+    }
+
+
+def set_sync_state(photo_ids, integration, state, errors=None, db=None):
+    '''
+    Record the sync state of photos for an integration in the sync ledger
+    '''
+    db = db or session
+    if not photo_ids:
+        return None
+
+    errors = errors or {}
+    now = datetime.now()
+    photo_ids = list(photo_ids)
+    rows = {}
+    for i in range(0, len(photo_ids), 500):
+        for row in db.query(PhotoSync).filter(PhotoSync.integration == integration,
+                                                   PhotoSync.photo_id.in_(photo_ids[i:i + 500])):
+            rows[row.photo_id] = row
+
+    for photo_id in photo_ids:
+        row = rows.get(photo_id)
+        if not row:
+            row = PhotoSync(photo_id=photo_id, integration=integration, attempts=0, created=now)
+            db.add(row)
+
+        if state == SyncStatus.Pending:
+            row.attempts = 0
+        elif state == SyncStatus.Uploading:
+            row.attempts = (row.attempts or 0) + 1
+
+        row.state = state
+        row.last_error = errors.get(photo_id)
+        row.updated = now
+
+    db.commit()
+
+
+def delete_sync_state(photo_ids):
+    for i in range(0, len(photo_ids), 500):
+        session.query(PhotoSync).filter(PhotoSync.photo_id.in_(photo_ids[i:i + 500])).delete(synchronize_session=False)
+
+
+def pending_sync(integration, db=None):
+    '''
+    Photos waiting to be synced to an integration, including failed ones
+    that have attempts left
+    '''
+    db = db or session
+    return db.query(Photo).join(PhotoSync, PhotoSync.photo_id == Photo.photo_id).filter(
+                PhotoSync.integration == integration,
+                or_(PhotoSync.state == SyncStatus.Pending,
+                    and_(PhotoSync.state.in_([SyncStatus.Uploading, SyncStatus.Failed]),
+                         PhotoSync.attempts < sync_config['max_attempts']))).all()
+
+
+def enqueue_explorer_changes(photo_ids, db=None):
+    '''
+    Queue photos whose Explorer payload may have changed for the next push
+    '''
+    db = db or session
+    photo_ids = list(photo_ids)
+    linked = []
+    for i in range(0, len(photo_ids), 500):
+        linked += [p.photo_id for p in db.query(Photo.photo_id).join(Tour, Tour.tour_id == Photo.tour_id).filter(
+                        Tour.explorer_tour_id != None, Photo.photo_id.in_(photo_ids[i:i + 500]))]
+
+    set_sync_state(linked, 'explorer', SyncStatus.Pending, db=db)
+
+
+def gsv_photo_fields(fl, uploaded_photo):
+    return {
+        'street_view_photoid': uploaded_photo.photo_id.id,
+        'street_view_download_url': uploaded_photo.download_url,
+        'street_view_sharelink': uploaded_photo.share_link,
+        'street_view_thumbnail_url': uploaded_photo.thumbnail_url,
+        'street_view_capture_time': str(fl['timestamp']),
+        'street_view_lat': str(fl['gpsdata']['Latitude']),
+        'street_view_lon': str(fl['gpsdata']['Longitude']),
+        'street_view_altitude': str(fl['gpsdata']['Altitude'])
+    }
+
+
+@profiling.timed('Google Street View upload')
+def upload_gsv(gsv, photos, db=None):
+    '''
+    Upload photos to Google Street View, recording the results in the sync ledger.
+    Raises QuotaExceeded once the uploads that finished are recorded
+    '''
+    db = db or session
+    photo_ids = [p.photo_id for p in photos]
+    progress.counter(gsv.name, len(photo_ids))
+    set_sync_state(photo_ids, 'gsv', SyncStatus.Uploading, db=db)
+    uploaded = []
+    errors = {}
+    quota_error = None
+
+    fls = [photo_file(p) for p in photos]
+    results = gsv.upload_photos(fls, autotune.upload_workers())
+
+    for photo, fl, uploaded_photo in zip(photos, fls, results):
+        # Photos cut off by the quota stay Uploading and are retried by the next sync
+        if isinstance(uploaded_photo, ratelimit.QuotaExceeded):
+            quota_error = quota_error or uploaded_photo
+            continue
+
+        if isinstance(uploaded_photo, Exception):
+            errors[photo.photo_id] = str(uploaded_photo)
+            continue
+
+        if uploaded_photo and uploaded_photo.photo_id.id:
+            for key, value in gsv_photo_fields(fl, uploaded_photo).items():
+                setattr(photo, key, value)
+            db.add(photo)
+            uploaded.append(photo.photo_id)
+        else:
+            errors[photo.photo_id] = 'Upload failed'
+
+    db.commit()
+    set_sync_state(uploaded, 'gsv', SyncStatus.Uploaded, db=db)
+    set_sync_state(list(errors.keys()), 'gsv', SyncStatus.Failed, errors, db=db)
+    enqueue_explorer_changes(uploaded, db=db)
+
+    if quota_error:
+        raise quota_error
+    return errors
+
+
+@profiling.timed('Open Trail View upload')
+def upload_otv(otv, tour, photos, db=None, move=True):
+    '''
+    Upload photos of a tour to Open Trail View, recording the results in the sync ledger.
+    Without <move> the panoramas are left where Open Trail View placed them, moves that
+    fail are queued as jobs. Raises QuotaExceeded once the uploads that finished are recorded
+    '''
+    db = db or session
+    photo_ids = [p.photo_id for p in photos]
+    progress.counter(otv.name, len(photo_ids))
+    set_sync_state(photo_ids, 'otv', SyncStatus.Uploading, db=db)
+    pano_ids, unmoved = otv.upload_photos([photo_file(p) for p in photos], tour.tour_id, autotune.upload_workers(), move)
+
+    uploaded = []
+    errors = {}
+    quota_error = None
+    for photo, pano_id in zip(photos, pano_ids):
+        # Photos cut off by the quota stay Uploading and are retried by the next sync
+        if isinstance(pano_id, ratelimit.QuotaExceeded):
+            quota_error = quota_error or pano_id
+            continue
+
+        if isinstance(pano_id, Exception):
+            errors[photo.photo_id] = str(pano_id)
+        elif not pano_id:
+            errors[photo.photo_id] = 'Upload failed'
+        else:
+            photo.otv_pano_id = pano_id
+            db.add(photo)
+            uploaded.append(photo.photo_id)
+            if pano_id in unmoved:
+                jobs.enqueue('move', {'pano_id': pano_id, 'lat': photo.lat, 'lon': photo.lon},
+                             key='move:{}'.format(pano_id), db=db)
+
+    db.commit()
+    set_sync_state(uploaded, 'otv', SyncStatus.Uploaded, db=db)
+    set_sync_state(list(errors.keys()), 'otv', SyncStatus.Failed, errors, db=db)
+    enqueue_explorer_changes(uploaded, db=db)
+
+    if quota_error:
+        raise quota_error
+    return errors
+
+
+@profiling.timed('Trek View Explorer upload')
+def push_explorer_photos(explorer, tour, photos, db=None):
+    '''
+    Create or update the changed photos of a tour on Explorer,
+    recording the results in the sync ledger
+    '''
+    db = db or session
+    photo_list = [set_photo_data(p) for p in photos]
+    update_connections(photo_list, db=db)
+
+    pushed = {p.photo_id: p.explorer_fingerprint for p in photos}
+    fingerprints = {}
+    changed_photos = []
+    for photo_data in photo_list:
+        photo_id = photo_data['tourer[photo_id]']
+        fingerprints[photo_id] = explorer_fingerprint(photo_data)
+        if not photo_data['explorer_photo_id'] or fingerprints[photo_id] != pushed[photo_id]:
+            changed_photos.append(photo_data)
+
+    changed_ids = [p['tourer[photo_id]'] for p in changed_photos]
+    set_sync_state(changed_ids, 'explorer', SyncStatus.Uploading, db=db)
+    explorer_photo_ids = {}
+    sync_errors = {}
+    if changed_photos:
+        progress.counter(explorer.name, len(changed_photos))
+        explorer_photo_ids, sync_errors = explorer.sync_photos(tour.explorer_tour_id, changed_photos, autotune.upload_workers())
+        save_explorer_photo_ids(explorer_photo_ids, fingerprints, db=db)
+
+    # Photos cut off by the quota stay Uploading and are retried by the next sync
+    quota_errors = {photo_id: e for photo_id, e in sync_errors.items() if isinstance(e, ratelimit.QuotaExceeded)}
+    failed = [photo_id for photo_id in changed_ids if photo_id not in explorer_photo_ids and photo_id not in quota_errors]
+    set_sync_state([p.photo_id for p in photos if p.photo_id not in failed and p.photo_id not in quota_errors],
+                   'explorer', SyncStatus.Uploaded, db=db)
+    errors = {photo_id: str(sync_errors.get(photo_id) or 'Sync failed') for photo_id in failed}
+    set_sync_state(failed, 'explorer', SyncStatus.Failed, errors, db=db)
+
+    if quota_errors:
+        raise next(iter(quota_errors.values()))
+    return errors
+
+
+@profiling.timed('Geocoding')
+def geocode_place(latitude, longitude):
+    '''
+    Look up the Google place of a location, returns its ID and address components
+    '''
+    place = {}
+    if not auth_config[3]['key']:
+        return place
+
+    key = (round(float(latitude), GEOCODE_PRECISION), round(float(longitude), GEOCODE_PRECISION))
+    with geocode_lock:
+        if key in geocode_cache:
+            return dict(geocode_cache[key])
+
+    place_url = '{}?latlng={},{}&key={}&result_type=locality'.format(
+                        endpoints_config['geocode_url'], latitude, longitude, auth_config[3]['key'])
+
+    r = retry.send(requests, 'GET', place_url, limiter=ratelimit.get_limiter('geocode'))
+    results = r.json()['results']
+    if results:
+        place['place_id'] = results[0].get('place_id')
+        for x in results[0]['address_components']:
+            for component in ('postal_code', 'administrative_area_level_1', 'administrative_area_level_2',
+                              'administrative_area_level_3', 'locality'):
+                if component in x['types']:
+                    place[component] = x['long_name']
+                    break
+
+    with geocode_lock:
+        geocode_cache[key] = place
+    return dict(place)
+
+
+def photo_fields(fl, geocode=True):
+    '''
+    Photo columns of a validated file, looking up its Google place if <geocode>
+    '''
+    latitude = fl['gpsdata']['Latitude']
+    longitude = fl['gpsdata']['Longitude']
+    crd = (latitude, longitude), (31.76, 35.21)
+    with profiling.timer('Reverse geocoding'):
+        geolocator = reverse_geocode.search(crd)[0]
+    path, filename = os.path.split(fl['fname'])
+    place = geocode_place(latitude, longitude) if geocode else {}
+
+    return {
+        'filename': filename,
+        'filepath': path,
+        'fullpath': fl['fname'],
+        'country_code': geolocator['country_code'],
+        'country': geolocator['country'],
+        'lat': latitude,
+        'lon': longitude,
+        'elevation': str(fl['gpsdata'].get('Altitude', None)),
+        'location_code': olc.encode(latitude, longitude),
+        'camera_make': fl['meta'].get('Make', None),
+        'camera_model': fl['meta'].get('Model', None),
+        'photo_id': str(uuid.uuid4())[:8],
+        'taken': fl['timestamp'],
+        'locality': place.get('locality'),
+        'administrative_area_level_1': place.get('administrative_area_level_1'),
+        'administrative_area_level_2': place.get('administrative_area_level_2'),
+        'administrative_area_level_3': place.get('administrative_area_level_3'),
+        'place_id': place.get('place_id'),
+        'postal_code': place.get('postal_code'),
+        'uploaded': True
+    }
+
+
+def gsv_terms():
+    terms = ask_confirm('Google Street View: Do you agree to Google’s Terms of Service? https://policies.google.com/terms')
+    if not terms:
+        print('Google Street View: We can not upload files without your agreement')
+
+    return terms
+
+
+def upload_photos(tour, validated_files, integrations, mode='basic', queue=False):
     integrations_list = []
 
     if validated_files:
@@ -574,87 +1199,19 @@ def upload_photos(tour, validated_files, integrations, mode='basic'):
             if mode == 'integration':
                 photo = session.query(Photo).filter(Photo.photo_id == fl['photo_id']).first()
             else:
-                capture_time = fl['timestamp']
-                latitude = fl['gpsdata']['Latitude']
-                longitude = fl['gpsdata']['Longitude']
-                altitude = fl['gpsdata'].get('Altitude', None)
-                camera_make = fl['meta'].get('Make', None)
-                camera_model = fl['meta'].get('Model', None)
-                crd = (latitude, longitude), (31.76, 35.21)
-                geolocator = reverse_geocode.search(crd)[0]
-                country = geolocator['country']
-                country_code = geolocator['country_code']
-                lc = olc.encode(latitude, longitude)
-                path, filename = os.path.split(fl['fname'])
-                photo_id = str(uuid.uuid4())[:8]
-                place_id = None
-                postal_code = None
-                administrative_area_level_1 = None
-                administrative_area_level_2 = None
-                administrative_area_level_3 = None
-                locality = None
-
-                if auth_config[3]['key']:
-                    place_url = 'https://maps.googleapis.com/maps/api/geocode/json?latlng={},{}&key={}&result_type=locality'.format(
-                                        latitude, longitude, auth_config[3]['key'])
-                                        
-                    r = requests.get(place_url)
-                    if r.json()['results']:
-                        place = r.json()['results'][0]
-                        place_id = place.get('place_id')
-                        postal_code = None
-                        for x in place['address_components']:
-                            if 'postal_code' in x['types']:
-                                postal_code = x['long_name']
-                            elif 'administrative_area_level_1' in x['types']:
-                                administrative_area_level_1 = x['long_name']
-                            elif 'administrative_area_level_2' in x['types']:
-                                administrative_area_level_2 = x['long_name']
-                            elif 'administrative_area_level_3' in x['types']:
-                                administrative_area_level_3 = x['long_name']
-                            elif 'locality' in x['types']:
-                                locality = x['long_name']
-
-                photo = Photo(
-                    tour=tour,
-                    filename=filename,
-                    filepath=path,
-                    fullpath=fl['fname'],
-                    country_code=country_code, 
-                    country=country,
-                    lat=latitude,
-                    lon=longitude,
-                    elevation=str(altitude),
-                    location_code=lc,
-                    camera_make=camera_make,
-                    camera_model=camera_model,
-                    photo_id=photo_id,
-                    taken=capture_time,
-                    locality=locality,
-                    administrative_area_level_1=administrative_area_level_1,
-                    administrative_area_level_2=administrative_area_level_2,
-                    administrative_area_level_3=administrative_area_level_3,
-                    place_id=place_id,
-                    postal_code=postal_code,
-                    uploaded=True
-                )
-
+                photo = Photo(tour=tour, **photo_fields(fl, not queue))
                 session.add(photo)
                 session.commit()
     
-                print('New photo created, photo ID: {}'.format(photo_id))
-
-            if 'explorer' in integrations:
-                photo_data = set_photo_data(photo)
-                photos.append(photo_data)
+                print('New photo created, photo ID: {}'.format(photo.photo_id))
+                if queue and auth_config[3]['key']:
+                    jobs.enqueue('geocode', {'photo_id': photo.photo_id}, key='geocode:{}'.format(photo.photo_id))
 
     if mode != 'integration':
         set_tour_connections(tour)
 
     if 'gsv' in integrations:
-        terms = click.confirm('Google Street View: Do you agree to Google’s Terms of Service? https://policies.google.com/terms')
-        if not terms:
-            print('Google Street View: We can not upload files without your agreement')
+        if not gsv_terms():
             return None
 
         integrations_list.append('gsv')
@@ -663,78 +1220,38 @@ def upload_photos(tour, validated_files, integrations, mode='basic'):
             session.add(tour)
             session.commit()
 
-        photos = []
-        for photo in tour.photos:
-            if mode == 'integration':
-                old_photo = session.query(Photo).filter(Photo.photo_id == photo.photo_id).first()
-                photo = old_photo
-
-            fl = {
-                'timestamp': photo.taken,
-                'fname': photo.fullpath,
-                'place_id': photo.place_id,
-                'gpsdata': {
-                    'Latitude': photo.lat,
-                    'Longitude': photo.lon,
-                    'Altitude': photo.elevation
-                }
-            }
-            gsv = GoogleStreetView()
-            uploaded_photo = gsv.upload_photo(fl)
-            photo.street_view_photoid = uploaded_photo.photo_id.id
-            if photo.street_view_photoid:
-                photo.street_view_download_url = uploaded_photo.download_url
-                photo.street_view_sharelink = uploaded_photo.share_link
-                photo.street_view_thumbnail_url = uploaded_photo.thumbnail_url
-                photo.street_view_capture_time = str(fl['timestamp'])
-                photo.street_view_lat = str(fl['gpsdata']['Latitude'])
-                photo.street_view_lon = str(fl['gpsdata']['Longitude'])
-                photo.street_view_altitude = str(fl['gpsdata']['Altitude'])
-                session.add(photo)
-                session.commit()
-
-            if 'explorer' in integrations:
-                photo_data = set_photo_data(photo)
-                photos.append(photo_data)
-
+        if queue:
+            enqueue_upload('gsv', tour)
+        else:
+            gsv = get_client('gsv')
+            upload_gsv(gsv, [p for p in tour.photos if not p.street_view_photoid])
+            sync_gsv_pose(tour)
         print('Google Street View: Your tour is now being uploaded to Google. It can take up to 72 hours for them to be published.')
 
     if 'otv' in integrations:
-        otv = OpenTrailView()
         integrations_list.append('otv')
         if mode != 'integration':
             tour.integrations = ','.join(integrations_list)
             session.add(tour)
             session.commit()
 
-        photos = []
-        for photo in tour.photos:
-            fl = {
-                'timestamp': photo.taken,
-                'fname': photo.fullpath,
-                'gpsdata': {
-                    'Latitude': photo.lat,
-                    'Longitude': photo.lon,
-                    'Altitude': photo.elevation
-                }
-            }
-            photo.otv_pano_id = otv.upload_photo(fl, tour.tour_id)
-            session.add(photo)
-            session.commit()
-
-            if 'explorer' in integrations:
-                photo_data = set_photo_data(photo)
-                photos.append(photo_data)
+        if queue:
+            enqueue_upload('otv', tour)
+        else:
+            upload_otv(get_client('otv'), tour, [p for p in tour.photos if not p.otv_pano_id])
         
     if 'explorer' in integrations:
-        explorer = Explorer()
+        explorer = get_client('explorer')
         tour_type = tour.transport.tour_type.name.lower()
         transport_type = tour.transport.tour_transport.name.lower()
         tags = tour.tags.replace(',', ', ')
-        update_connections(photos)
+        new_photos = [p for p in tour.photos if not p.explorer_photo_id]
 
         if mode == 'update':
-            explorer.update_tour(tour.explorer_tour_id, photos=photos)
+            if queue:
+                enqueue_upload('explorer', tour)
+            else:
+                push_explorer_photos(explorer, tour, new_photos)
         else:
             explorer_tour_id = explorer.create_tour(tour.name, tour.description, tags, tour_type,
                                                     transport_type, tour.tour_id)
@@ -746,13 +1263,10 @@ def upload_photos(tour, validated_files, integrations, mode='basic'):
                 session.add(tour)
                 session.commit()
                 
-                for photo in photos:
-                    explorer_photo_id = explorer.add_photo(explorer_tour_id, photo)
-                    photo_id = photo['tourer[photo_id]']
-                    photo = session.query(Photo).filter(Photo.photo_id == photo_id).first()
-                    photo.explorer_photo_id = explorer_photo_id
-                    session.add(photo)
-                    session.commit()
+                if queue:
+                    enqueue_upload('explorer', tour)
+                else:
+                    push_explorer_photos(explorer, tour, new_photos)
 
             else:
                 if mode == 'integration':
@@ -771,7 +1285,408 @@ def upload_photos(tour, validated_files, integrations, mode='basic'):
     return tour
 
 
-def create_tour(validated_files, integrations, name, description, tags, transport):
+def ingest(tour, path, integrations, mode='basic'):
+    '''
+    Create the photos found at <path> and upload them while the rest are still being read
+    '''
+    files = list_files(path)
+    if files is None:
+        return None
+
+    if 'gsv' in integrations and not gsv_terms():
+        return None
+
+    return ingest_tours([(tour, files, integrations)], mode)[0]
+
+
+def ingest_tours(imports, mode='basic'):
+    '''
+    Create the photos of (tour, files, integrations) <imports>, paths or validated files,
+    and upload them while the rest
+    are still being read. Metadata, geocoding, saving and each upload run as their own worker
+    group connected by bounded queues, shared by all tours. Connections, poses and Explorer
+    are synced per tour once all photos are in. Returns the tours
+    '''
+    tour_integrations = {}
+    for tour, files, integrations in imports:
+        # Tours saved before, e.g. resumed imports, keep their integrations
+        if mode != 'update' and tour.id is None:
+            tour.integrations = ','.join(i for i in integrations if i != 'explorer')
+        session.add(tour)
+        tour_integrations[tour.tour_id] = integrations
+    session.commit()
+
+    workers = sync_config['workers']
+    source_paths = {tour.tour_id: tour.source_path for tour, files, integrations in imports}
+    wanted = set(i for integrations in tour_integrations.values() for i in integrations)
+    items = [(tour.tour_id, fname) for tour, files, integrations in imports for fname in files]
+
+    def read(db, item):
+        tour_id, fl = item
+        if isinstance(fl, dict):
+            return tour_id, fl
+
+        fname = fl
+        fl = validate_file(fname, confirm=False)
+        if fl:
+            return tour_id, fl
+        # Files of an imported folder that fail validation are not read again on resume
+        if source_paths.get(tour_id):
+            db.add(SkippedFile(source_path=source_paths[tour_id], fullpath=fname))
+            db.commit()
+
+    def geocode(db, item):
+        tour_id, fl = item
+        return tour_id, photo_fields(fl)
+
+    def persist(db, item):
+        tour_id, fields = item
+        photo = Photo(tour_id=tour_id, **fields)
+        db.add(photo)
+        # Ledger rows go in with the photo, so uploads cut short are retried by sync
+        now = datetime.now()
+        for short_name in tour_integrations[tour_id]:
+            if short_name in ['gsv', 'otv']:
+                db.add(PhotoSync(photo_id=photo.photo_id, integration=short_name, state=SyncStatus.Uploading,
+                                 attempts=1, created=now, updated=now))
+        db.commit()
+        print('New photo created, photo ID: {}'.format(fields['photo_id']))
+        return tour_id, dict(fields, id=photo.id)
+
+    # Upload results waiting to be written, as (integration, photo ID, remote fields, error)
+    results = []
+    results_lock = threading.Lock()
+
+    def flush(db, batch):
+        db.bulk_update_mappings(Photo, [fields for integration, photo_id, fields, error in batch if fields])
+        db.commit()
+        for short_name in set(r[0] for r in batch):
+            errors = {photo_id: error for integration, photo_id, fields, error in batch if integration == short_name and error}
+            set_sync_state([photo_id for integration, photo_id, fields, error in batch if integration == short_name and not error],
+                           short_name, SyncStatus.Uploaded, db=db)
+            set_sync_state(list(errors.keys()), short_name, SyncStatus.Failed, errors, db=db)
+        enqueue_explorer_changes([photo_id for integration, photo_id, fields, error in batch if not error], db=db)
+
+    def record(db, result):
+        with results_lock:
+            results.append(result)
+            if len(results) < UPLOAD_BATCH:
+                return None
+            batch = results[:]
+            del results[:]
+        flush(db, batch)
+
+    def uploader(short_name, upload):
+        def run(db, item):
+            tour_id, fields = item
+            if short_name not in tour_integrations[tour_id]:
+                return None
+            try:
+                remote = upload(db, tour_id, photo_file(Photo(**fields)))
+            except ratelimit.QuotaExceeded:
+                raise
+            except Exception as e:
+                record(db, (short_name, fields['photo_id'], None, str(e) or 'Upload failed'))
+                raise
+            if not remote:
+                record(db, (short_name, fields['photo_id'], None, 'Upload failed'))
+                raise RuntimeError('Upload failed')
+            record(db, (short_name, fields['photo_id'], dict(remote, id=fields['id']), None))
+        return run
+
+    def upload_gsv_photo(db, tour_id, fl):
+        progress.counter(gsv.name, 1)
+        uploaded_photo = gsv.tuner.run(os.stat(fl['fname']).st_size, gsv.upload_photo, fl)
+        if uploaded_photo and uploaded_photo.photo_id.id:
+            return gsv_photo_fields(fl, uploaded_photo)
+
+    def upload_otv_photo(db, tour_id, fl):
+        progress.counter(otv.name, 1)
+        pano_id = otv.tuner.run(os.stat(fl['fname']).st_size, otv.upload_photo, fl, tour_id, move=False)
+        if not pano_id:
+            return None
+
+        # The panorama is uploaded either way, a failed move is retried as a job
+        lat, lon = fl['gpsdata']['Latitude'], fl['gpsdata']['Longitude']
+        try:
+            moved = otv.move_photo(pano_id, lat, lon)
+        except Exception as e:
+            print('{}: Failed to move panorama {}, {}'.format(otv.name, pano_id, e))
+            moved = False
+        if not moved:
+            jobs.enqueue('move', {'pano_id': pano_id, 'lat': lat, 'lon': lon}, key='move:{}'.format(pano_id), db=db)
+        return {'otv_pano_id': pano_id}
+
+    metadata = pipeline.Stage('Metadata', read, os.cpu_count() or 1)
+    metadata.counter.add_total(len(items))
+    geocoding = pipeline.Stage('Geocoding', geocode, workers)
+    save = pipeline.Stage('Database', persist)
+    stages = [metadata, geocoding, save]
+
+    if 'gsv' in wanted:
+        gsv = get_client('gsv')
+        stages.append(pipeline.Stage('Google Street View', uploader('gsv', upload_gsv_photo),
+                                     autotune.upload_workers(), counted=False))
+    if 'otv' in wanted:
+        otv = get_client('otv')
+        stages.append(pipeline.Stage('Open Trail View', uploader('otv', upload_otv_photo),
+                                     autotune.upload_workers(), counted=False))
+
+    metadata.feeds(geocoding)
+    geocoding.feeds(save)
+    save.feeds(*stages[3:])
+
+    try:
+        stats = pipeline.run(items, stages)
+    finally:
+        flush(session, results)
+
+    for name, counts in stats.items():
+        print('{}: {} done, {} failed'.format(name, counts['processed'] - counts['dropped'], counts['failed'] + counts['dropped']))
+
+    session.expire_all()
+    for tour, files, integrations in imports:
+        set_tour_connections(tour)
+        if 'gsv' in integrations:
+            sync_gsv_pose(tour)
+            print('Google Street View: Your tour is now being uploaded to Google. It can take up to 72 hours for them to be published.')
+
+        if 'explorer' in integrations:
+            explorer = get_client('explorer')
+            if not tour.explorer_tour_id:
+                tour.explorer_tour_id = explorer.create_tour(tour.name, tour.description, tour.tags.replace(',', ', '),
+                                                             tour.transport.tour_type.name.lower(),
+                                                             tour.transport.tour_transport.name.lower(), tour.tour_id)
+                if tour.explorer_tour_id and mode != 'update':
+                    tour.integrations = ','.join(integrations)
+                session.commit()
+
+            if tour.explorer_tour_id:
+                push_explorer_photos(explorer, tour, [p for p in tour.photos if not p.explorer_photo_id])
+
+    return [tour for tour, files, integrations in imports]
+
+
+def read_files(files):
+    '''
+    Validate <files> on all cores, returns the valid ones
+    '''
+    counter = progress.counter('Validation', len(files))
+
+    def read(fname):
+        fl = validate_file(fname, confirm=False)
+        counter.update(failed=0 if fl else 1)
+        return fl
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        return [fl for fl in executor.map(read, files) if fl]
+
+
+def taken_at(fl):
+    timestamp = fl['timestamp']
+    if isinstance(timestamp, str):
+        timestamp = datetime.strptime(timestamp, '%Y:%m:%d %H:%M:%S')
+
+    return timestamp, float(fl['gpsdata']['Latitude']), float(fl['gpsdata']['Longitude'])
+
+
+def split_tour(validated_files, max_gap=None, max_jump=None):
+    '''
+    Split validated files into tours at time gaps over <max_gap> seconds
+    and distance jumps over <max_jump> meters, as configured by default
+    '''
+    max_gap = tracks_config['max_gap'] if max_gap is None else max_gap
+    max_jump = tracks_config['max_jump'] if max_jump is None else max_jump
+    validated_files = [fl for fl in validated_files if fl]
+    with profiling.timer('Segmentation'):
+        segments = tracks.segment(validated_files, taken_at, max_gap, max_jump)
+
+    print('{} photos split into {} tours'.format(len(validated_files), len(segments)))
+    return segments
+
+
+def decimate(validated_files, spacing=None, photos=()):
+    '''
+    Keep validated files taken at least <spacing> meters apart along the track, as configured by default.
+    Saved <photos> count as kept but are never returned
+    '''
+    spacing = tracks_config['spacing'] if spacing is None else spacing
+    validated_files = [fl for fl in validated_files if fl]
+    if not spacing:
+        return validated_files
+
+    saved = [{'timestamp': p.taken, 'gpsdata': {'Latitude': p.lat, 'Longitude': p.lon}}
+             for p in photos if p.taken and p.lat and p.lon]
+    new = set(id(fl) for fl in validated_files)
+    with profiling.timer('Decimation'):
+        kept = [fl for fl in tracks.decimate(saved + validated_files, taken_at, spacing) if id(fl) in new]
+
+    metrics.inc('tourer_decimated_total', len(validated_files) - len(kept))
+    print('{} of {} photos kept at {} m spacing'.format(len(kept), len(validated_files), spacing))
+    return kept
+
+
+def create_tours(segments, integrations, name, description, tags, transport, queue=False):
+    '''
+    Create a tour from each list of validated files in <segments>, numbering their names
+    '''
+    names = [name] if len(segments) == 1 else ['{} {}'.format(name, i + 1) for i in range(len(segments))]
+    for tour_name in names:
+        if check_string('Tour name', tour_name, 300) is None:
+            return None
+        if session.query(Tour).filter(Tour.name == tour_name).first():
+            print('Tour {} already exists'.format(tour_name))
+            return None
+
+    if queue:
+        for tour_name, segment in zip(names, segments):
+            create_tour(segment, integrations, tour_name, description, tags, transport, queue)
+        return None
+
+    if 'gsv' in integrations and not gsv_terms():
+        return None
+
+    imports = [(Tour(name=tour_name, description=description, tags=tags, transport=transport,
+                     tour_id=str(uuid.uuid4())[:8]), segment, integrations)
+               for tour_name, segment in zip(names, segments)]
+    for tour in ingest_tours(imports):
+        print('New tour created, tour ID: {}  Name: {}  Photos: {}'.format(tour.tour_id, tour.name, len(tour.photos)))
+
+
+def find_tour_dirs(root):
+    '''
+    Directories under <root> that hold photos, in path order
+    '''
+    dirs = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        if any(os.path.splitext(f)[1].lower() in SUPPORTED_FORMATS for f in filenames):
+            dirs.append(dirpath)
+
+    return dirs
+
+
+def resume_uploads(tour, integrations):
+    '''
+    Upload the photos of <tour> that an interrupted import saved but did not upload
+    '''
+    if 'gsv' in integrations:
+        photos = [p for p in tour.photos if not p.street_view_photoid]
+        if photos:
+            upload_gsv(get_client('gsv'), photos)
+
+    if 'otv' in integrations:
+        photos = [p for p in tour.photos if not p.otv_pano_id]
+        if photos:
+            upload_otv(get_client('otv'), tour, photos)
+
+
+def tour_synced(tour, integrations):
+    remote_ids = {'gsv': 'street_view_photoid', 'otv': 'otv_pano_id', 'explorer': 'explorer_photo_id'}
+    if 'explorer' in integrations and not tour.explorer_tour_id:
+        return False
+
+    return all(getattr(p, remote_ids[i]) for p in tour.photos for i in integrations if i in remote_ids)
+
+
+def import_tree(root, manifest=None, **options):
+    '''
+    Create a tour from every directory of photos under <root>, or from every tour of <manifest>,
+    and ingest them all through one pipeline. Tours an earlier run of the same directories
+    created are resumed, skipping the photos already saved. Returns the tours
+    '''
+    root = os.path.abspath(root)
+    manifest = manifest or {}
+    defaults = tour_options({k: v for k, v in manifest.items() if k != 'tours'}, **options)
+
+    if 'tours' in manifest:
+        specs = []
+        for t in manifest['tours']:
+            if not t.get('path'):
+                print('Manifest tour {} has no path'.format(t.get('name', '')))
+                return None
+            specs.append(dict(defaults, **dict(t, path=os.path.abspath(os.path.join(root, t['path'])))))
+    else:
+        specs = [dict(defaults, path=path) for path in find_tour_dirs(root)]
+
+    if not specs:
+        print('No photos found under {}'.format(root))
+        return None
+
+    imports = []
+    resumed = []
+    names = set()
+    for spec in specs:
+        path = spec['path']
+        if not os.path.isdir(path):
+            print('Invalid path {}'.format(path))
+            continue
+
+        files = sorted(f for f in list_files(path) if os.path.splitext(f)[1].lower() in SUPPORTED_FORMATS)
+        spacing = spec.get('spacing', tracks_config['spacing'])
+        tour = session.query(Tour).filter(Tour.source_path == path).first()
+        skipped = set(f for (f,) in session.query(SkippedFile.fullpath).filter(SkippedFile.source_path == path))
+
+        if tour:
+            if 'integrations' in spec:
+                integrations = find_integrations(spec['integrations'])
+            else:
+                integrations = tour.integrations.split(',') if tour.integrations else []
+            if integrations is None:
+                continue
+
+            saved = set(p.fullpath for p in tour.photos)
+            files = [f for f in files if f not in saved and f not in skipped]
+            if not files and tour_synced(tour, integrations):
+                print('Tour {} already imported'.format(tour.name))
+                continue
+
+            print('Tour {}: resuming with {} new photos'.format(tour.name, len(files)))
+            resumed.append((tour, integrations))
+        else:
+            name = spec.get('name') or (os.path.relpath(path, root).replace(os.sep, ' - ') if path != root else os.path.basename(root))
+            if name in names:
+                print('Tour {} is listed twice, skipping {}'.format(name, path))
+                continue
+
+            fields = tour_fields(dict(spec, name=name, description=spec.get('description') or name))
+            if not fields:
+                print('Tour {} skipped'.format(name))
+                continue
+
+            tour = Tour(name=fields['name'], description=fields['description'], tags=fields['tags'],
+                        transport=fields['transport'], tour_id=str(uuid.uuid4())[:8], source_path=path)
+            integrations = fields['integrations']
+            session.query(SkippedFile).filter(SkippedFile.source_path == path).delete()
+
+        if spacing and files:
+            validated_files = decimate(read_files(files), spacing, tour.photos if tour.id else ())
+            kept = set(fl['fname'] for fl in validated_files)
+            # Files that failed validation or were decimated are not read again on resume
+            session.add_all(SkippedFile(source_path=path, fullpath=f) for f in files if f not in kept)
+            session.commit()
+            files = validated_files
+
+        names.add(tour.name)
+        imports.append((tour, files, integrations))
+
+    if not imports:
+        return None
+
+    if any('gsv' in integrations for tour, files, integrations in imports) and not gsv_terms():
+        return None
+
+    for tour, integrations in resumed:
+        resume_uploads(tour, integrations)
+
+    tours = ingest_tours(imports)
+    for tour in tours:
+        print('Tour {}: {} photos, tour ID {}'.format(tour.name, len(tour.photos), tour.tour_id))
+
+    return tours
+
+
+def create_tour(validated_files, integrations, name, description, tags, transport, queue=False, path=None):
     tour_id = str(uuid.uuid4())[:8]
     tour = Tour(
                 name=name,
@@ -781,7 +1696,12 @@ def create_tour(validated_files, integrations, name, description, tags, transpor
                 tour_id=tour_id
             )
 
-    tour_inst = upload_photos(tour, validated_files, integrations)
+    if path:
+        tour_inst = ingest(tour, path, integrations)
+    else:
+        tour_inst = upload_photos(tour, validated_files, integrations, queue=queue)
+    if not tour_inst:
+        return None
    
     session.add(tour_inst)
     session.commit()
@@ -789,79 +1709,116 @@ def create_tour(validated_files, integrations, name, description, tags, transpor
     print('New tour created, tour ID: {}'.format(tour_id))
 
 
-def update_tour(tour, validated_files):
-    integrations = tour.integrations.split(',')
-    tour_inst = upload_photos(tour, validated_files, integrations, 'update')
+def update_tour(tour, validated_files, queue=False, path=None):
+    integrations = tour.integrations.split(',') if tour.integrations else []
+    if path:
+        tour_inst = ingest(tour, path, integrations, 'update')
+    else:
+        tour_inst = upload_photos(tour, validated_files, integrations, 'update', queue)
 
     print('Tour {} updated'.format(tour.name))
     
 
+@profiling.timed('Delete tour')
 def delete_tour(tour, integration=None):
-    delete = True
-    
     if integration:
         integrations = integration
     else:
-        confirm = click.prompt('Please type DELETE to delete tour', type=str)
-        if not confirm == 'DELETE':
+        typed = 'DELETE' if assume_yes else click.prompt('Please type DELETE to delete tour', type=str)
+        if not typed == 'DELETE':
             print('Confirmation failed')
             return None
-        integrations = tour.integrations.split(',')
+        integrations = tour.integrations.split(',') if tour.integrations else []
+
+    photos = list(tour.photos)
+    photo_ids = [p.photo_id for p in photos]
+    workers = sync_config['workers']
+    deletions = []
 
     if 'gsv' in integrations:
-        gsv = GoogleStreetView()
-        for p in tour.photos:
-            if hasattr(p, 'street_view_photoid'):
-                gsv_photo_id = p.street_view_photoid
-                success = gsv.delete_photo(gsv_photo_id)
-                if not success:
-                    confirm = click.confirm('This photo cannot be deleted this time. Do you still want to continue with delete? This will mean you cannot delete this photo later using tourer',
-                                            abort=True)
-                    if not confirm:
-                        sys.exit()
-            else:
-                delete = False
-                print('Google Street View is out of sync, run forcesync to sync, then run delete')
-                break
-   
+        gsv = get_client('gsv')
+        gsv_photo_ids = [p.street_view_photoid for p in photos if p.street_view_photoid]
+        deletions.append(('Google Street View', 'gsv', gsv.delete_photos, gsv_photo_ids))
+
     if 'otv' in integrations:
-        otv = OpenTrailView()
-        for p in tour.photos:
-            if hasattr(p, 'otv_pano_id'):
-                otv_pano_id = p.otv_pano_id
-                success = otv.delete_photo(otv_pano_id)
-                if not success:
-                    delete = False
-                    return None
-            else:
-                delete = False
-                print('Open Trail View is out of sync, run forcesync to sync, then run delete')
-                break
+        otv = get_client('otv')
+        pano_ids = [p.otv_pano_id for p in photos if p.otv_pano_id]
+        deletions.append(('Open Trail View', 'otv', otv.delete_photos, pano_ids))
+
+    if 'explorer' in integrations and tour.explorer_tour_id:
+        explorer = get_client('explorer')
+
+        def delete_explorer_tour(explorer_tour_ids, workers):
+            if explorer.delete_tour(explorer_tour_ids[0]):
+                return {}
+            return {explorer_tour_ids[0]: 'Failed to delete tour'}
+
+        deletions.append(('Trek View Explorer', 'explorer', delete_explorer_tour, [tour.explorer_tour_id]))
+
+    report = []
+    if deletions:
+        with ThreadPoolExecutor(max_workers=len(deletions)) as executor:
+            futures = [(name, short_name, len(ids), executor.submit(func, ids, workers))
+                       for name, short_name, func, ids in deletions]
+            report = [(name, short_name, count, future.result()) for name, short_name, count, future in futures]
+
+    failed = False
+    for name, short_name, count, failures in report:
+        print('{}: {} of {} deleted'.format(name, count - len(failures), count))
+        for remote_id, error in failures.items():
+            print('    {}: {}'.format(remote_id, error))
+        failed = failed or bool(failures)
 
-    if 'explorer' in integrations:
-        explorer = Explorer()
-        explorer_tour_id = tour.explorer_tour_id        
-        success = explorer.delete_tour(explorer_tour_id)
-        if not success:
-            delete = False
-            return None
+    if integration:
+        for name, short_name, count, failures in report:
+            for remote_id in failures:
+                jobs.enqueue('delete', {'integration': short_name, 'remote_id': remote_id},
+                             key='delete:{}:{}'.format(short_name, remote_id))
+        clear_remote_ids(tour, integration[0])
+        set_sync_state(photo_ids, integration[0], SyncStatus.Deleted)
+        return not failed
+
+    if failed:
+        delete = ask_confirm('Some items could not be deleted remotely. Do you still want to delete the tour locally? '
+                             'Their deletion will be retried by tourer worker')
+        if not delete:
+            print('Tour {} cannot be deleted'.format(tour.name))
+            return False
 
-    if not integration:
-        if delete:
-            for photo in tour.photos:
-                session.delete(photo)
-                session.commit()
+        for name, short_name, count, failures in report:
+            for remote_id in failures:
+                jobs.enqueue('delete', {'integration': short_name, 'remote_id': remote_id},
+                             key='delete:{}:{}'.format(short_name, remote_id))
 
-            session.delete(tour)
-            session.commit()
-            print('Tour {} deleted'.format(tour.name))
-        else:
-            print('Tour {} cannot be deleted'.format(tour.name))
+    delete_sync_state(photo_ids)
+    session.query(Photo).filter(Photo.tour_id == tour.tour_id).delete(synchronize_session=False)
+    session.expire(tour, ['photos'])
+    session.delete(tour)
+    session.commit()
+    print('Tour {} deleted'.format(tour.name))
+    return True
 
 
-def delete_photo(tour):
+def clear_remote_ids(tour, integration):
+    '''
+    Forget what <integration> returned for <tour> and its photos, so that adding it again uploads them
+    '''
+    for photo in tour.photos:
+        for field in REMOTE_FIELDS.get(integration, []):
+            setattr(photo, field, None)
+
+    if integration == 'explorer':
+        tour.explorer_tour_id = None
+        tour.explorer_fingerprint = None
+        tour.explorer_pulled = None
+
+    session.commit()
+
+
+def delete_photo(tour, photo_id=None):
     delete = True
-    photo_id = click.prompt('Enter photo ID', type=str)
+    if not photo_id:
+        photo_id = click.prompt('Enter photo ID', type=str)
     photo = session.query(Photo).filter(Photo.photo_id == photo_id).first()
     if not photo:
         print('There is no photo with ID {}'.format(photo_id))
@@ -870,27 +1827,28 @@ def delete_photo(tour):
     integrations = tour.integrations.split(',')
 
     if 'gsv' in integrations:
-        gsv = GoogleStreetView()
+        gsv = get_client('gsv')
         success = gsv.delete_photo(photo.street_view_photoid)
         if not success:
             delete = False
-            confirm = click.confirm('This photo cannot be deleted this time. Do you still want to continue with delete? This will mean you cannot delete this photo later using tourer', abort=True)
-            if not confirm:
+            confirmed = ask_confirm('This photo cannot be deleted this time. Do you still want to continue with delete? This will mean you cannot delete this photo later using tourer', abort=True)
+            if not confirmed:
                 sys.exit()
         
     if 'otv' in integrations:
-        otv = OpenTrailView()
+        otv = get_client('otv')
         success = otv.delete_photo(photo.otv_pano_id)
         if not success:
             delete = False
 
     if 'explorer' in integrations:
-        explorer = Explorer()
+        explorer = get_client('explorer')
         success = explorer.delete_photo(tour.explorer_tour_id, photo.explorer_photo_id)
         if not success:
             delete = False
 
     if delete:          
+        delete_sync_state([photo.photo_id])
         session.delete(photo)
         session.commit()
         set_tour_connections(tour)
@@ -922,34 +1880,118 @@ def list_photos(tour_id):
         print('There is no tour with ID {}'.format(tour_id))
 
 
-def fetchgsv():
-    gsv = GoogleStreetView()
-    photos = session.query(Photo).all()
-    gsv_photo_ids = []
-    for photo in photos:
-        if photo.street_view_photoid:
-            gsv_photo_ids.append(photo.street_view_photoid)
-    
-    info_batch = gsv.get_photo_info(gsv_photo_ids)
-
-    if info_batch:
-        for info in info_batch:
-            if not info.status:
-                photo.street_view_sharelink = info.share_link
-                photo.street_view_lat = info.pose.lat_lng_pair.latitude
-                photo.street_view_lon = info.pose.lat_lng_pair.latitude
-                photo.street_view_altitude = info.pose.altitude
-                photo.street_view_heading = info.pose.heading
-                photo.street_view_pitch = info.pose.pitch
-                photo.street_view_roll = info.pose.roll
-                photo.street_view_level = str(info.pose.level)
-                
-                session.add(photo)
-                session.commit()
+@profiling.timed('Google Street View fetch')
+def fetchgsv(db=None):
+    db = db or session
+    gsv = get_client('gsv')
+    fetched = datetime.now()
+    stale = fetched - timedelta(hours=sync_config['gsv_fetch_max_age'])
+    photos = db.query(Photo.id, Photo.photo_id, Photo.street_view_photoid).filter(
+                Photo.street_view_photoid != None,
+                or_(Photo.street_view_publish_status == None,
+                    Photo.street_view_publish_status.notin_(GSV_FINAL_STATUSES),
+                    Photo.street_view_fetched == None,
+                    Photo.street_view_fetched < stale)).all()
+
+    if not photos:
+        print('Google Street View: Photo data is up to date')
+        return None
+
+    info = gsv.get_photos_info([p.street_view_photoid for p in photos], sync_config['workers'])
+
+    if info:
+        updates = []
+        for photo in photos:
+            gsv_photo = info.get(photo.street_view_photoid)
+            if not gsv_photo:
+                continue
+
+            updates.append({
+                'id': photo.id,
+                'street_view_sharelink': gsv_photo.share_link,
+                'street_view_lat': str(gsv_photo.pose.lat_lng_pair.latitude),
+                'street_view_lon': str(gsv_photo.pose.lat_lng_pair.longitude),
+                'street_view_altitude': str(gsv_photo.pose.altitude),
+                'street_view_heading': str(gsv_photo.pose.heading),
+                'street_view_pitch': str(gsv_photo.pose.pitch),
+                'street_view_roll': str(gsv_photo.pose.roll),
+                'street_view_level': str(gsv_photo.pose.level),
+                'street_view_view_count': str(gsv_photo.view_count),
+                'street_view_publish_status': gsv.publish_status(gsv_photo),
+                'street_view_fetched': fetched
+            })
+
+        db.bulk_update_mappings(Photo, updates)
+        db.commit()
+        enqueue_explorer_changes([p.photo_id for p in photos if p.street_view_photoid in info], db=db)
+        print('Google Street View: Fetched data of {} photos'.format(len(updates)))
     else:
         print('Google Street View: Failed to get photo data')
 
 
+@profiling.timed('Google Street View pose')
+def sync_gsv_pose(tour=None, db=None):
+    '''
+    Push locally computed pose and connections of changed photos to Google Street View
+    '''
+    db = db or session
+    gsv = get_client('gsv')
+    query = db.query(Photo).filter(Photo.street_view_photoid != None)
+    if tour:
+        query = query.filter(Photo.tour_id == tour.tour_id)
+    photos = query.all()
+
+    gsv_ids = {p.photo_id: p.street_view_photoid for p in photos}
+    poses = []
+    updates = {}
+
+    for photo in photos:
+        connections = [gsv_ids[c['photo_id']] for c in load_connections(photo) if gsv_ids.get(c['photo_id'])]
+        pose = {
+            'photo_id': photo.street_view_photoid,
+            'heading': float(photo.photo_heading) if photo.photo_heading else None,
+            'lat': float(photo.lat),
+            'lon': float(photo.lon),
+            'altitude': float(photo.elevation) if photo.elevation not in (None, 'None') else 0,
+            'connections': connections
+        }
+
+        pose_fingerprint = fingerprint(pose)
+        if pose_fingerprint != photo.street_view_fingerprint:
+            poses.append(pose)
+            updates[photo.street_view_photoid] = {
+                'id': photo.id,
+                'photo_id': photo.photo_id,
+                'street_view_heading': photo.photo_heading,
+                'street_view_connections': json.dumps(connections),
+                'street_view_fingerprint': pose_fingerprint
+            }
+
+    if not poses:
+        return None
+
+    updated = [updates[u] for u in gsv.update_poses(poses, sync_config['workers']) if u in updates]
+    db.bulk_update_mappings(Photo, updated)
+    db.commit()
+    enqueue_explorer_changes([u['photo_id'] for u in updated], db=db)
+    print('Google Street View: Pose and connections updated for {} of {} photos'.format(len(updated), len(poses)))
+
+
+def list_files(path):
+    '''
+    Photo paths at <path>, a single file or the files of a directory
+    '''
+    if os.path.isfile(path):
+        print('Single file: {}'.format(path))
+        return [path]
+    elif os.path.isdir(path):
+        print('Directory: {}'.format(path))
+        return [os.path.abspath(os.path.join(path, f)) for f in os.listdir(path) if not f.startswith('.')]
+    else:
+        print('Invalid path {}'.format(path))
+        return None
+
+
 def validate_files(path):
     is_valid_path = True
     single_file = False
@@ -968,12 +2010,14 @@ def validate_files(path):
     if single_file:
         validated_files.append(validate_file(path))
     else:
-        for f in os.listdir(path):
-            if not f.startswith('.'):
-                f = os.path.abspath(os.path.join(path,f))
-                valid_file = validate_file(f)
-                if valid_file:
-                    validated_files.append(valid_file)
+        files = [f for f in os.listdir(path) if not f.startswith('.')]
+        counter = progress.counter('Validation', len(files))
+        for f in files:
+            f = os.path.abspath(os.path.join(path,f))
+            valid_file = validate_file(f)
+            counter.update(failed=0 if valid_file else 1)
+            if valid_file:
+                validated_files.append(valid_file)
             
     return validated_files
 
@@ -1005,11 +2049,11 @@ def set_photo_data(photo):
         'streetview[lat]': photo.street_view_lat,
         'streetview[lon]': photo.street_view_lon,
         'streetview[altitude]': photo.street_view_altitude,
-        'streetview[heading]': '0',
-        'streetview[pitch]': '0',
-        'streetview[roll]': '0',
-        'streetview[level]': None,
-        'streetview[connections]': None,
+        'streetview[heading]': photo.street_view_heading or '0',
+        'streetview[pitch]': photo.street_view_pitch or '0',
+        'streetview[roll]': photo.street_view_roll or '0',
+        'streetview[level]': photo.street_view_level,
+        'streetview[connections]': photo.street_view_connections,
         'opentrailview[photo_id]': photo.otv_pano_id,
         'tourer[photo_id]': photo.photo_id,
     }
@@ -1027,14 +2071,13 @@ def set_local_tour(local_tour, ed):
     local_tour.transport = transport
 
     session.add(local_tour)
-    session.commit()
 
     
 def set_local_photo(local_photo, ed):
     local_photo.filename = ed['filename']
     local_photo.taken = datetime.strptime(ed['taken_at'], '%Y-%m-%dT%H:%M:%S.%fZ')
-    local_photo.latitude = ed['latitude']
-    local_photo.longitude = ed['longitude']
+    local_photo.lat = str(ed['latitude'])
+    local_photo.lon = str(ed['longitude'])
     local_photo.elevation = ed['elevation_meters']
     local_photo.locality = ed['address']['locality']
     local_photo.administrative_area_level_3 = ed['address']['administrative_area_level_3']
@@ -1058,117 +2101,242 @@ def set_local_photo(local_photo, ed):
     local_photo.street_view_roll = ed['streetview']['roll']                               
     local_photo.street_view_level = ed['streetview']['level']                         
     local_photo.street_view_connections = ed['streetview']['connections']
-    local_photo.connections = str(ed['tourer']['connections'])
+    local_photo.connections = json.dumps(ed['tourer']['connections'])
                                                                    
     session.add(local_photo)
+
+
+def bounded_map(func, items, workers):
+    '''
+    Map <func> over <items> on a thread pool, in order, keeping only a few
+    calls in flight so long inputs are streamed rather than held in memory
+    '''
+    workers = max(workers, 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def chunked(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return None
+        yield chunk
+
+
+def load_listing_cache():
+    return {c.url: {'etag': c.etag, 'last_page': c.last_page} for c in session.query(ListingCache)}
+
+
+def save_listing_cache(etags):
+    '''
+    Store the listing validators in <etags>, dropping the others
+    '''
+    cached = {c.url: c for c in session.query(ListingCache)}
+    for url, entry in cached.items():
+        if url not in etags:
+            session.delete(entry)
+
+    for url, validator in etags.items():
+        entry = cached.get(url) or ListingCache(url=url)
+        entry.etag = validator['etag']
+        entry.last_page = validator['last_page']
+        session.add(entry)
+
     session.commit()
 
 
+@profiling.timed('Trek View Explorer pull')
 def sync_pull():
-    explorer = Explorer()
+    explorer = get_client('explorer')
     user_id = explorer.get_user_id()
-    if user_id:
-        tours = explorer.list_tours(user_id)
-        for tour in tours:
-            explorer_tour_id = tour['id']
-            local_tour = session.query(Tour).filter(Tour.explorer_tour_id == explorer_tour_id).first()
-            if local_tour:
-                set_local_tour(local_tour, tour)
-                photos = explorer.list_photos(explorer_tour_id)
-                for photo in photos:
-                    explorer_photo_id = photo['id']
-                    local_photo = session.query(Photo).filter(Photo.explorer_photo_id == explorer_photo_id).first()
-                    if local_photo:
-                        set_local_photo(local_photo, photo)
-  
-
-def sync_push(intg_status):
-    tours = session.query(Tour).all()
-    for tour in tours:
-        if tour.integrations:
-            tour_intg = tour.integrations.split(',')
-        else:
-            tour_intg = []
-        
-        if ('Google Street View', 'gsv') in intg_status and 'gsv' in tour_intg:
-            gsv = GoogleStreetView()
-            for photo in tour.photos:
-                if not photo.street_view_photoid:
-                    fl = {
-                        'timestamp': photo.taken,
-                        'fname': photo.fullpath,
-                        'place_id': photo.place_id,
-                        'gpsdata': {
-                            'Latitude': photo.lat,
-                            'Longitude': photo.lon,
-                            'Altitude': photo.elevation
-                        }
-                    }
-                    uploaded_photo = gsv.upload_photo(fl)
-                    photo.street_view_photoid = uploaded_photo.photo_id.id
-                    if photo.street_view_photoid:
-                        photo.street_view_download_url = uploaded_photo.download_url
-                        photo.street_view_sharelink = uploaded_photo.share_link
-                        photo.street_view_thumbnail_url = uploaded_photo.thumbnail_url
-                        photo.street_view_capture_time = str(fl['timestamp'])
-                        photo.street_view_lat = str(fl['gpsdata']['Latitude'])
-                        photo.street_view_lon = str(fl['gpsdata']['Longitude'])
-                        photo.street_view_altitude = str(fl['gpsdata']['Altitude'])
-                        session.add(photo)
-                        session.commit()
-
-        if ('Open Trail View', 'otv') in intg_status and 'otv' in tour_intg:
-            otv = OpenTrailView()
-            for photo in tour.photos:
-                if not photo.otv_pano_id:
-                    fl = {
-                        'timestamp': photo.taken,
-                        'fname': photo.fullpath,
-                        'gpsdata': {
-                            'Latitude': photo.lat,
-                            'Longitude': photo.lon,
-                            'Altitude': photo.elevation
-                        }
-                    }
-                
-                    photo.otv_pano_id = otv.upload_photo(fl, tour.tour_id)
-                    session.add(photo)
-                    session.commit()
-
-        photos = session.query(Photo).filter(Photo.tour_id == tour.tour_id)
-        explorer_tour_id = tour.explorer_tour_id
-        update_photo_list = []
-        for photo in tour.photos:
-            photo_data = set_photo_data(photo)
-            update_photo_list.append(photo_data)
-            
-        if explorer_tour_id and ('Trek View Explorer', 'explorer') in intg_status:
-            explorer = Explorer()
-            name = tour.name
-            description = tour.description
-            tags = tour.tags.replace(',', ', ')
-            tour_type = tour.transport.tour_type.name.lower()
-            transport_type = tour.transport.tour_transport.name.lower()
-               
-            update_connections(update_photo_list)
-            for photo_data in update_photo_list:
-                explorer_photo_id = photo_data.get('explorer_photo_id')
-                if explorer_photo_id:
-                    explorer.update_photo(photo_data, explorer_tour_id, explorer_photo_id)
-                else:
-                    explorer_photo_id = explorer.add_photo(explorer_tour_id, photo_data)
-                    if explorer_photo_id:
-                        photo_id = photo_data['tourer[photo_id]']
-                        photo = session.query(Photo).filter(Photo.photo_id == photo_id).first()
-                        photo.explorer_photo_id = explorer_photo_id
-                        session.add(photo)
-                        session.commit()
-
-            explorer.update_tour(explorer_tour_id, tour.tour_id, description, tags, tour_type, transport_type, None)
-  
-
-def add_integration(tour):
-    intg = get_available_integrations(tour, 'exclude')
+    if not user_id:
+        return None
+
+    explorer.etags = load_listing_cache()
+    explorer.visited = set()
+    pulled = datetime.now()
+
+    try:
+        for tours in chunked(explorer.iter_tours(user_id), 500):
+            explorer_tour_ids = [t['id'] for t in tours]
+            local_tours = {t.explorer_tour_id: t for t in session.query(Tour).filter(Tour.explorer_tour_id.in_(explorer_tour_ids))}
+            for tour in tours:
+                if tour['id'] in local_tours:
+                    set_local_tour(local_tours[tour['id']], tour)
+    except requests.exceptions.RequestException:
+        print('Trek View Explorer: Failed to list tours')
+
+    def fetch_photos(pull):
+        explorer_tour_id, updated_since = pull
+        try:
+            return explorer_tour_id, list(explorer.iter_photos(explorer_tour_id, updated_since))
+        except requests.exceptions.RequestException:
+            print('Trek View Explorer: Failed to list photos of tour {}'.format(explorer_tour_id))
+            return explorer_tour_id, None
+
+    local_tours = {t.explorer_tour_id: t for t in session.query(Tour).filter(Tour.explorer_tour_id != None)}
+    pulls = [(t.explorer_tour_id, t.explorer_pulled) for t in local_tours.values()]
+
+    for explorer_tour_id, photos in bounded_map(fetch_photos, pulls, sync_config['workers']):
+        if photos is None:
+            continue
+
+        local_tour = local_tours[explorer_tour_id]
+        if photos:
+            local_photos = {p.explorer_photo_id: p for p in local_tour.photos}
+            for photo in photos:
+                local_photo = local_photos.get(photo['id'])
+                if local_photo:
+                    set_local_photo(local_photo, photo)
+
+        local_tour.explorer_pulled = pulled
+        session.add(local_tour)
+
+    session.commit()
+    # Pages no longer requested belong to deleted tours or shorter listings
+    save_listing_cache({url: explorer.etags[url] for url in explorer.visited if url in explorer.etags})
+
+
+def sync_push(intg_status, queue=False):
+    if queue:
+        for name, short_name in intg_status:
+            for tour_id, tour_photos in group_by_tour(pending_sync(short_name)):
+                enqueue_upload(short_name, tour_photos[0].tour)
+        return None
+
+    if ('Google Street View', 'gsv') in intg_status:
+        photos = pending_sync('gsv')
+        if photos:
+            upload_gsv(get_client('gsv'), photos)
+
+    if ('Open Trail View', 'otv') in intg_status:
+        photos = pending_sync('otv')
+        if photos:
+            otv = get_client('otv')
+            for tour_id, tour_photos in group_by_tour(photos):
+                upload_otv(otv, tour_photos[0].tour, tour_photos)
+
+    if ('Trek View Explorer', 'explorer') in intg_status:
+        explorer = get_client('explorer')
+        for tour_id, tour_photos in group_by_tour(pending_sync('explorer')):
+            tour = tour_photos[0].tour
+            if tour.explorer_tour_id:
+                push_explorer_photos(explorer, tour, tour_photos)
+
+        for tour in session.query(Tour).filter(Tour.explorer_tour_id != None):
+            push_explorer_tour(explorer, tour)
+        session.commit()
+
+
+def group_by_tour(photos):
+    tours = {}
+    for photo in photos:
+        tours.setdefault(photo.tour_id, []).append(photo)
+
+    return tours.items()
+
+
+def enqueue_upload(integration, tour, db=None):
+    '''
+    Queue the upload of the photos of a tour that are missing from an integration
+    '''
+    return jobs.enqueue('upload', {'integration': integration, 'tour_id': tour.tour_id},
+                        key='upload:{}:{}'.format(integration, tour.tour_id), db=db)
+
+
+@jobs.handler('upload')
+def upload_job(db, payload):
+    integration = payload['integration']
+    tour = db.query(Tour).filter(Tour.tour_id == payload['tour_id']).first()
+    if not tour:
+        return None
+
+    if integration == 'gsv':
+        photos = [p for p in tour.photos if not p.street_view_photoid]
+        errors = {}
+        for batch in chunked(photos, UPLOAD_BATCH):
+            errors.update(upload_gsv(get_client('gsv'), batch, db))
+        sync_gsv_pose(tour, db)
+    elif integration == 'otv':
+        photos = [p for p in tour.photos if not p.otv_pano_id]
+        errors = {}
+        for batch in chunked(photos, UPLOAD_BATCH):
+            errors.update(upload_otv(get_client('otv'), tour, batch, db, move=False))
+            for photo in batch:
+                if photo.otv_pano_id:
+                    jobs.enqueue('move', {'pano_id': photo.otv_pano_id, 'lat': photo.lat, 'lon': photo.lon},
+                                 key='move:{}'.format(photo.otv_pano_id), db=db)
+    elif integration == 'explorer':
+        if not tour.explorer_tour_id:
+            raise jobs.JobError('Tour {} has no Explorer tour'.format(tour.tour_id))
+        photos = tour.photos
+        explorer = get_client('explorer')
+        errors = push_explorer_photos(explorer, tour, photos, db)
+        push_explorer_tour(explorer, tour)
+        db.commit()
+    else:
+        raise jobs.JobError('Unknown integration {}'.format(integration))
+
+    if integration != 'explorer' and tour.explorer_tour_id:
+        enqueue_upload('explorer', tour, db)
+
+    if errors:
+        raise jobs.JobError('{} of {} photos failed'.format(len(errors), len(photos)))
+
+
+@jobs.handler('move')
+def move_job(db, payload):
+    if not get_client('otv').move_photo(payload['pano_id'], payload['lat'], payload['lon']):
+        raise jobs.JobError('Failed to move panorama {}'.format(payload['pano_id']))
+
+
+@jobs.handler('geocode')
+def geocode_job(db, payload):
+    photo = db.query(Photo).filter(Photo.photo_id == payload['photo_id']).first()
+    if not photo:
+        return None
+
+    for field, value in geocode_place(photo.lat, photo.lon).items():
+        setattr(photo, field, value)
+    db.commit()
+    enqueue_explorer_changes([photo.photo_id], db=db)
+
+
+@jobs.handler('fetch')
+def fetch_job(db, payload):
+    fetchgsv(db)
+    sync_gsv_pose(db=db)
+
+
+@jobs.handler('delete')
+def delete_job(db, payload):
+    integration = payload['integration']
+    remote_id = payload['remote_id']
+    client = get_client(integration)
+    if integration == 'explorer':
+        failures = {} if client.delete_tour(remote_id) else {remote_id: 'Failed to delete tour'}
+    else:
+        failures = client.delete_photos([remote_id])
+
+    if failures:
+        raise jobs.JobError(', '.join(failures.values()))
+
+
+def add_integration(tour, integration=None):
+    if integration:
+        added = tour.integrations.split(',') if tour.integrations else []
+        intg = next((x for x in integrations_status(False) if x[1] == integration and x[1] not in added), None)
+    else:
+        intg = get_available_integrations(tour, 'exclude')
     if intg:
         validated_files = []
         for p in tour.photos:
@@ -1190,8 +2358,12 @@ def add_integration(tour):
         print('You do not have integrations available')
 
 
-def remove_integration(tour):
-    intg = get_available_integrations(tour, 'include')
+def remove_integration(tour, integration=None):
+    if integration:
+        added = tour.integrations.split(',') if tour.integrations else []
+        intg = next((x for x in intg_modules if x[1] == integration and x[1] in added), None)
+    else:
+        intg = get_available_integrations(tour, 'include')
     if intg:
         delete_tour(tour, [intg[1]])
         intg_list = tour.integrations.split(',')